@@ -2,12 +2,16 @@
 # -*- coding: utf-8 -*-
 
 import os
+import sys
 import io
 import pickle
 import tempfile
+import threading
+import uuid
+from collections import OrderedDict
 import numpy as np
 import pandas as pd
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, send_file
 from flask_cors import CORS
 import matplotlib.pyplot as plt
 import base64
@@ -17,6 +21,7 @@ import traceback
 import logging
 import matplotlib
 matplotlib.use('Agg')  # Use non-interactive backend
+from cycle_columns import CycleColumns, nan_to_none
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, 
@@ -67,24 +72,64 @@ app.json_encoder = NumpyEncoder
 
 # Configure upload settings
 UPLOAD_FOLDER = tempfile.mkdtemp()
-ALLOWED_EXTENSIONS = {'pkl', 'csv'}
+ALLOWED_EXTENSIONS = {'pkl', 'csv', 'bcell'}
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 50 MB max upload
 
+# The RUL predictor and the columnar cell reader live with the models
+MODELS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'models')
+RUL_DIR = os.path.join(MODELS_DIR, 'RUL')
+sys.path.append(RUL_DIR)
+sys.path.append(MODELS_DIR)
+
+
+def load_rul_predictor():
+    """
+    Load the RUL model and its scalers once at process start.
+    The checkpoint folder can be set with the RUL_MODEL_PATH environment variable.
+    Concurrent requests are run together in batches of up to RUL_MAX_BATCH_SIZE requests,
+    waiting at most RUL_MAX_WAIT_MS milliseconds for a batch to fill.
+    Returns the predictor and the error message if it cannot be loaded.
+    """
+    try:
+        from rul_predictor import RULPredictor, DEFAULT_MODEL_PATH
+        model_path = os.environ.get('RUL_MODEL_PATH', DEFAULT_MODEL_PATH)
+        max_batch_size = int(os.environ.get('RUL_MAX_BATCH_SIZE', 16))
+        max_wait_ms = float(os.environ.get('RUL_MAX_WAIT_MS', 5))
+        predictor = RULPredictor(model_path, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+        logger.info(f"Loaded {predictor.model_type} RUL model from {model_path}")
+        return predictor, None
+    except Exception as e:
+        logger.warning(f"RUL prediction is disabled: {str(e)}")
+        return None, str(e)
+
+
+rul_predictor, rul_predictor_error = load_rul_predictor()
+
+# Numeric results of recent analyses, kept so that their plots can be rendered on demand
+ANALYSIS_CACHE_SIZE = int(os.environ.get('ANALYSIS_CACHE_SIZE', 32))
+analysis_cache = OrderedDict()  # analysis_id -> {'result': analytics result, 'plots': {plot_name: PNG bytes}}
+analysis_cache_lock = threading.Lock()
+# pyplot keeps global state, so figures are created and saved one at a time
+plot_lock = threading.Lock()
+
 
 def allowed_file(filename):
     """Check if the file extension is allowed."""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
-def fig_to_base64(fig):
-    """Convert a matplotlib figure to a base64 encoded string."""
+def fig_to_png(fig):
+    """Convert a matplotlib figure to PNG bytes."""
     buf = BytesIO()
     fig.savefig(buf, format='png', dpi=100, bbox_inches='tight')
-    buf.seek(0)
-    img_str = base64.b64encode(buf.read()).decode('utf-8')
     plt.close(fig)
-    return img_str
+    return buf.getvalue()
+
+
+def fig_to_base64(fig):
+    """Convert a matplotlib figure to a base64 encoded string."""
+    return base64.b64encode(fig_to_png(fig)).decode('utf-8')
 
 
 def load_pickle_data(file_path):
@@ -97,6 +142,19 @@ def load_pickle_data(file_path):
         raise ValueError(f"Invalid pickle file format: {str(e)}")
 
 
+def load_columnar_data(file_path):
+    """
+    Load data from a columnar .bcell file (see models/data_provider/columnar_cell.py).
+    The signals of each cycle are numpy views of the memory-mapped file.
+    """
+    try:
+        from data_provider.columnar_cell import ColumnarCell
+        return ColumnarCell(file_path).to_dict()
+    except Exception as e:
+        logger.error(f"Error loading columnar file: {str(e)}")
+        raise ValueError(f"Invalid columnar file format: {str(e)}")
+
+
 def load_csv_data(file_paths):
     """
     Load data from CSV files. Expects either:
@@ -225,11 +283,43 @@ def validate_battery_data(data):
     return True
 
 
+def save_uploaded_files(files):
+    """Save the uploaded files to the temp location and return their paths."""
+    file_paths = []
+    for file in files:
+        file_path = os.path.join(app.config['UPLOAD_FOLDER'], file.filename)
+        file.save(file_path)
+        file_paths.append(file_path)
+    return file_paths
+
+
+def load_battery_data(file_paths):
+    """Load battery data from a .pkl file, a columnar .bcell file or a set of .csv files."""
+    if len(file_paths) == 1 and file_paths[0].endswith('.pkl'):
+        return load_pickle_data(file_paths[0])
+    if len(file_paths) == 1 and file_paths[0].endswith('.bcell'):
+        return load_columnar_data(file_paths[0])
+    # Filter for CSV files
+    csv_paths = [path for path in file_paths if path.endswith('.csv')]
+    return load_csv_data(csv_paths)
+
+
+def get_cell_name(data, file_paths):
+    """Get the cell name from the data or the uploaded file name."""
+    if isinstance(data.get('cell_id'), str):
+        return data['cell_id']
+    file_name = os.path.splitext(os.path.basename(file_paths[0]))[0]
+    for suffix in ['_cycles', '_metadata', '_metrics']:
+        if file_name.endswith(suffix):
+            return file_name[:-len(suffix)]
+    return file_name
+
+
 @app.route('/api/upload', methods=['POST'])
 def upload_file():
     """
     API endpoint for uploading battery data files.
-    Accepts .pkl files or sets of .csv files.
+    Accepts .pkl files, columnar .bcell files or sets of .csv files.
     """
     if 'file' not in request.files:
         return jsonify({'error': 'No file part in the request'}), 400
@@ -244,31 +334,30 @@ def upload_file():
             return jsonify({'error': f'File type not allowed: {file.filename}'}), 400
     
     # Save files to temp location
-    file_paths = []
-    for file in files:
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], file.filename)
-        file.save(file_path)
-        file_paths.append(file_path)
+    file_paths = save_uploaded_files(files)
     
     try:
         # Load data based on file type
-        data = None
-        if len(file_paths) == 1 and file_paths[0].endswith('.pkl'):
-            data = load_pickle_data(file_paths[0])
-        else:
-            # Filter for CSV files
-            csv_paths = [path for path in file_paths if path.endswith('.csv')]
-            data = load_csv_data(csv_paths)
+        data = load_battery_data(file_paths)
         
         # Validate the data structure
         validate_battery_data(data)
         
-        # Process the data
-        analytics_result = process_battery_data(data)
+        # Process the data. With ?plots=false only the numeric results are returned
+        # and the plots are rendered on demand by /api/plots/<analysis_id>/<plot_name>
+        render_plots = request.args.get('plots', 'true').lower() not in ('false', '0', 'no')
+        analytics_result = process_battery_data(data, render_plots=render_plots)
         
         # Convert NumPy types to Python native types
         analytics_result = convert_numpy_types(analytics_result)
         
+        if not render_plots:
+            analysis_id = store_analysis(analytics_result)
+            analytics_result['analysis_id'] = analysis_id
+            analytics_result['plot_urls'] = {
+                plot_name: f'/api/plots/{analysis_id}/{plot_name}' for plot_name in PLOTS
+            }
+        
         # Clean up temporary files
         for file_path in file_paths:
             try:
@@ -291,18 +380,68 @@ def upload_file():
         return jsonify({'error': str(e)}), 400
 
 
-def process_battery_data(data):
+@app.route('/api/predict_rul', methods=['POST'])
+def predict_rul():
+    """
+    API endpoint for predicting the cycle life of one cell.
+    Accepts a .pkl file, a columnar .bcell file or a set of .csv files. The optional 'seen_cycles' form field
+    sets how many early cycles the model sees (all available early cycles by default).
+    """
+    if rul_predictor is None:
+        return jsonify({'error': f'RUL model is not available: {rul_predictor_error}'}), 503
+    
+    if 'file' not in request.files:
+        return jsonify({'error': 'No file part in the request'}), 400
+    
+    files = request.files.getlist('file')
+    if not files or all(file.filename == '' for file in files):
+        return jsonify({'error': 'No files selected'}), 400
+    
+    # Check file types
+    for file in files:
+        if not allowed_file(file.filename):
+            return jsonify({'error': f'File type not allowed: {file.filename}'}), 400
+    
+    # Save files to temp location
+    file_paths = save_uploaded_files(files)
+    
+    try:
+        data = load_battery_data(file_paths)
+        validate_battery_data(data)
+        
+        seen_cycles = request.form.get('seen_cycles', type=int)
+        result = rul_predictor.predict(data, cell_name=get_cell_name(data, file_paths), seen_cycles=seen_cycles)
+        return jsonify(convert_numpy_types(result))
+    
+    except Exception as e:
+        logger.error(f"Error predicting RUL: {str(e)}")
+        logger.error(traceback.format_exc())
+        return jsonify({'error': str(e)}), 400
+    
+    finally:
+        # Clean up temporary files
+        for file_path in file_paths:
+            try:
+                os.remove(file_path)
+            except:
+                pass
+
+
+def process_battery_data(data, render_plots=True):
     """
     Process battery data and return analytics results.
     This function orchestrates all the different analysis methods.
+    If render_plots is False, the plot fields are left as None.
+    The cycle signals are converted to columns once and shared by the analyses.
     """
+    columns = CycleColumns(data['cycle_data'])
     result = {
         'metadata': extract_metadata(data),
-        'capacity_fade': analyze_capacity_fade(data),
-        'voltage_profile': analyze_voltage_profiles(data),
-        'temperature_analysis': analyze_temperature(data),
-        'statistical_metrics': calculate_statistical_metrics(data),
-        'battery_health': assess_battery_health(data)
+        'capacity_fade': analyze_capacity_fade(data, render_plots, columns),
+        'voltage_profile': analyze_voltage_profiles(data, render_plots, columns),
+        'temperature_analysis': analyze_temperature(data, render_plots, columns),
+        'statistical_metrics': calculate_statistical_metrics(data, columns),
+        'battery_health': assess_battery_health(data, columns)
     }
     
     return result
@@ -344,7 +483,7 @@ def extract_metadata(data):
     # Extract temperature if available in first cycle
     if data['cycle_data'] and 'temperature_in_C' in data['cycle_data'][0]:
         temps = data['cycle_data'][0]['temperature_in_C']
-        if temps:
+        if temps is not None and len(temps) > 0:
             metadata['test_temperature_C'] = float(np.mean(temps))
     
     # Try to extract temperature from cell_id if not found in data
@@ -360,7 +499,19 @@ def extract_metadata(data):
     return metadata
 
 
-def analyze_capacity_fade(data):
+def coulombic_efficiency(charge_caps, discharge_caps):
+    """
+    Coulombic efficiency (%) of each cycle from its charge and discharge capacities.
+    NaN where a capacity is missing, the charge capacity is not positive or the discharge capacity is zero.
+    """
+    efficiencies = np.full(len(charge_caps), np.nan)
+    with np.errstate(invalid='ignore'):
+        valid = (charge_caps > 0) & (discharge_caps != 0) & ~np.isnan(discharge_caps)
+    efficiencies[valid] = (discharge_caps[valid] / charge_caps[valid]) * 100
+    return efficiencies
+
+
+def analyze_capacity_fade(data, render_plots=True, columns=None):
     """
     Analyze capacity fade over battery cycles.
     Returns capacity metrics and fade rate.
@@ -376,31 +527,25 @@ def analyze_capacity_fade(data):
         'capacity_plot': None
     }
     
-    # Extract cycle data
-    for cycle in data['cycle_data']:
-        cycle_num = cycle.get('cycle_number')
-        
-        # Skip if no cycle number
-        if cycle_num is None:
-            continue
-        
-        # Get charge and discharge capacities
-        charge_cap = max(cycle.get('charge_capacity_in_Ah', [0])) if cycle.get('charge_capacity_in_Ah') else None
-        discharge_cap = max(cycle.get('discharge_capacity_in_Ah', [0])) if cycle.get('discharge_capacity_in_Ah') else None
-        
-        # Skip cycle if no capacity data
-        if charge_cap is None and discharge_cap is None:
-            continue
-        
-        # Calculate coulombic efficiency
-        coulombic_efficiency = None
-        if charge_cap and discharge_cap and charge_cap > 0:
-            coulombic_efficiency = (discharge_cap / charge_cap) * 100
-        
-        result['cycle_numbers'].append(cycle_num)
-        result['charge_capacities'].append(charge_cap)
-        result['discharge_capacities'].append(discharge_cap)
-        result['coulombic_efficiencies'].append(coulombic_efficiency)
+    if columns is None:
+        columns = CycleColumns(data['cycle_data'])
+    
+    # Get charge and discharge capacities of every cycle
+    charge_caps = columns.cycle_max('charge_capacity_in_Ah')
+    discharge_caps = columns.cycle_max('discharge_capacity_in_Ah')
+    has_charge = ~np.isnan(charge_caps)
+    has_discharge = ~np.isnan(discharge_caps)
+    
+    # Skip cycles without cycle number or capacity data
+    keep = columns.has_cycle_number & (has_charge | has_discharge)
+    
+    # Calculate coulombic efficiency
+    coulombic_efficiencies = coulombic_efficiency(charge_caps, discharge_caps)
+    
+    result['cycle_numbers'] = [columns.cycle_numbers[i] for i in np.flatnonzero(keep)]
+    result['charge_capacities'] = nan_to_none(charge_caps[keep])
+    result['discharge_capacities'] = nan_to_none(discharge_caps[keep])
+    result['coulombic_efficiencies'] = nan_to_none(coulombic_efficiencies[keep])
     
     # Calculate capacity fade metrics if we have enough data
     if len(result['cycle_numbers']) > 1:
@@ -420,41 +565,50 @@ def analyze_capacity_fade(data):
                     result['capacity_fade_rate_per_cycle'] = fade_percentage / cycle_range
     
     # Generate capacity fade plot
-    if len(result['cycle_numbers']) > 1:
-        fig = plt.figure(figsize=(10, 8))
-        
-        # Plot capacities
-        ax1 = fig.add_subplot(2, 1, 1)
-        
-        if all(cap is not None for cap in result['charge_capacities']):
-            ax1.plot(result['cycle_numbers'], result['charge_capacities'], 'b-o', label='Charge Capacity')
-        
-        if all(cap is not None for cap in result['discharge_capacities']):
-            ax1.plot(result['cycle_numbers'], result['discharge_capacities'], 'r-o', label='Discharge Capacity')
-        
-        ax1.set_xlabel('Cycle Number')
-        ax1.set_ylabel('Capacity (Ah)')
-        ax1.set_title('Capacity Fade Analysis')
-        ax1.legend()
-        ax1.grid(True)
-        
-        # Plot coulombic efficiency
-        if all(eff is not None for eff in result['coulombic_efficiencies']):
-            ax2 = fig.add_subplot(2, 1, 2)
-            ax2.plot(result['cycle_numbers'], result['coulombic_efficiencies'], 'g-o')
-            ax2.set_xlabel('Cycle Number')
-            ax2.set_ylabel('Coulombic Efficiency (%)')
-            ax2.set_title('Coulombic Efficiency')
-            ax2.set_ylim([min(80, min(result['coulombic_efficiencies']) - 5), 105])
-            ax2.grid(True)
-        
-        plt.tight_layout()
-        result['capacity_plot'] = fig_to_base64(fig)
+    if render_plots:
+        result['capacity_plot'] = render_plot('capacity_plot', result)
     
     return result
 
 
-def analyze_voltage_profiles(data):
+def create_capacity_plot(capacity_fade):
+    """Create the capacity fade figure. Returns None if there is not enough data."""
+    result = capacity_fade
+    if len(result['cycle_numbers']) <= 1:
+        return None
+    
+    fig = plt.figure(figsize=(10, 8))
+    
+    # Plot capacities
+    ax1 = fig.add_subplot(2, 1, 1)
+    
+    if all(cap is not None for cap in result['charge_capacities']):
+        ax1.plot(result['cycle_numbers'], result['charge_capacities'], 'b-o', label='Charge Capacity')
+    
+    if all(cap is not None for cap in result['discharge_capacities']):
+        ax1.plot(result['cycle_numbers'], result['discharge_capacities'], 'r-o', label='Discharge Capacity')
+    
+    ax1.set_xlabel('Cycle Number')
+    ax1.set_ylabel('Capacity (Ah)')
+    ax1.set_title('Capacity Fade Analysis')
+    ax1.legend()
+    ax1.grid(True)
+    
+    # Plot coulombic efficiency
+    if all(eff is not None for eff in result['coulombic_efficiencies']):
+        ax2 = fig.add_subplot(2, 1, 2)
+        ax2.plot(result['cycle_numbers'], result['coulombic_efficiencies'], 'g-o')
+        ax2.set_xlabel('Cycle Number')
+        ax2.set_ylabel('Coulombic Efficiency (%)')
+        ax2.set_title('Coulombic Efficiency')
+        ax2.set_ylim([min(80, min(result['coulombic_efficiencies']) - 5), 105])
+        ax2.grid(True)
+    
+    fig.tight_layout()
+    return fig
+
+
+def analyze_voltage_profiles(data, render_plots=True, columns=None):
     """
     Analyze voltage profiles across battery cycles.
     Returns voltage curve metrics and visualizations.
@@ -470,6 +624,9 @@ def analyze_voltage_profiles(data):
         'differential_voltage_plot': None
     }
     
+    if columns is None:
+        columns = CycleColumns(data['cycle_data'])
+    
     # Extract all voltages across all cycles
     all_voltages = []
     
@@ -491,8 +648,8 @@ def analyze_voltage_profiles(data):
             cycle_num = cycle.get('cycle_number', idx + 1)
             
             # Extract voltages
-            voltages = cycle.get('voltage_in_V', [])
-            all_voltages.extend(voltages)
+            voltages = columns.cycle_signal('voltage_in_V', idx)
+            all_voltages.append(voltages)
             
             # Process charge and discharge voltage curves
             if 'voltage_in_V' in cycle:
@@ -503,99 +660,113 @@ def analyze_voltage_profiles(data):
                 }
                 
                 # Charge data
-                if 'charge_capacity_in_Ah' in cycle and len(cycle['charge_capacity_in_Ah']) == len(cycle['voltage_in_V']):
+                charge_caps = columns.cycle_signal('charge_capacity_in_Ah', idx)
+                if 'charge_capacity_in_Ah' in cycle and len(charge_caps) == len(voltages):
                     cycle_data['charge_data'] = {
-                        'capacities': cycle['charge_capacity_in_Ah'],
-                        'voltages': cycle['voltage_in_V']
+                        'capacities': charge_caps.tolist(),
+                        'voltages': voltages.tolist()
                     }
                 
                 # Discharge data
-                if 'discharge_capacity_in_Ah' in cycle and len(cycle['discharge_capacity_in_Ah']) == len(cycle['voltage_in_V']):
+                discharge_caps = columns.cycle_signal('discharge_capacity_in_Ah', idx)
+                if 'discharge_capacity_in_Ah' in cycle and len(discharge_caps) == len(voltages):
                     # Filter out zero discharge capacity points
-                    non_zero_indices = [i for i, cap in enumerate(cycle['discharge_capacity_in_Ah']) if cap > 0]
-                    if non_zero_indices:
+                    non_zero = discharge_caps > 0
+                    if non_zero.any():
                         cycle_data['discharge_data'] = {
-                            'capacities': [cycle['discharge_capacity_in_Ah'][i] for i in non_zero_indices],
-                            'voltages': [cycle['voltage_in_V'][i] for i in non_zero_indices]
+                            'capacities': discharge_caps[non_zero].tolist(),
+                            'voltages': voltages[non_zero].tolist()
                         }
                 
                 result['voltage_curves'].append(cycle_data)
     
     # Calculate voltage statistics
-    if all_voltages:
-        result['voltage_stats']['min_voltage'] = min(all_voltages)
-        result['voltage_stats']['max_voltage'] = max(all_voltages)
-        result['voltage_stats']['avg_voltage'] = sum(all_voltages) / len(all_voltages)
-    
-    # Generate voltage profile plot
-    if result['voltage_curves']:
-        fig = plt.figure(figsize=(10, 6))
-        ax = fig.add_subplot(1, 1, 1)
-        
-        for cycle_data in result['voltage_curves']:
-            cycle_num = cycle_data['cycle_number']
-            
-            # Plot charge curve
-            if cycle_data['charge_data']:
-                ax.plot(cycle_data['charge_data']['capacities'], 
-                        cycle_data['charge_data']['voltages'],
-                        label=f'Cycle {cycle_num} (Charge)')
-            
-            # Plot discharge curve
-            if cycle_data['discharge_data']:
-                ax.plot(cycle_data['discharge_data']['capacities'], 
-                        cycle_data['discharge_data']['voltages'],
-                        linestyle='--', 
-                        label=f'Cycle {cycle_num} (Discharge)')
+    all_voltages = np.concatenate(all_voltages) if all_voltages else np.zeros(0)
+    if all_voltages.size:
+        result['voltage_stats']['min_voltage'] = float(all_voltages.min())
+        result['voltage_stats']['max_voltage'] = float(all_voltages.max())
+        result['voltage_stats']['avg_voltage'] = float(all_voltages.mean())
+    
+    # Generate voltage profile and differential voltage (dV/dQ) plots
+    if render_plots:
+        result['voltage_profile_plot'] = render_plot('voltage_profile_plot', result)
+        result['differential_voltage_plot'] = render_plot('differential_voltage_plot', result)
+    
+    return result
+
+
+def create_voltage_profile_plot(voltage_profile):
+    """Create the voltage profile figure. Returns None if there are no voltage curves."""
+    if not voltage_profile['voltage_curves']:
+        return None
+    
+    fig = plt.figure(figsize=(10, 6))
+    ax = fig.add_subplot(1, 1, 1)
+    
+    for cycle_data in voltage_profile['voltage_curves']:
+        cycle_num = cycle_data['cycle_number']
         
-        ax.set_xlabel('Capacity (Ah)')
-        ax.set_ylabel('Voltage (V)')
-        ax.set_title('Voltage Profiles')
-        ax.legend()
-        ax.grid(True)
+        # Plot charge curve
+        if cycle_data['charge_data']:
+            ax.plot(cycle_data['charge_data']['capacities'], 
+                    cycle_data['charge_data']['voltages'],
+                    label=f'Cycle {cycle_num} (Charge)')
         
-        plt.tight_layout()
-        result['voltage_profile_plot'] = fig_to_base64(fig)
+        # Plot discharge curve
+        if cycle_data['discharge_data']:
+            ax.plot(cycle_data['discharge_data']['capacities'], 
+                    cycle_data['discharge_data']['voltages'],
+                    linestyle='--', 
+                    label=f'Cycle {cycle_num} (Discharge)')
+    
+    ax.set_xlabel('Capacity (Ah)')
+    ax.set_ylabel('Voltage (V)')
+    ax.set_title('Voltage Profiles')
+    ax.legend()
+    ax.grid(True)
+    
+    fig.tight_layout()
+    return fig
+
+
+def create_differential_voltage_plot(voltage_profile):
+    """Create the differential voltage analysis (dV/dQ) figure. Returns None if there are no voltage curves."""
+    if not voltage_profile['voltage_curves']:
+        return None
+    
+    fig = plt.figure(figsize=(10, 6))
+    ax = fig.add_subplot(1, 1, 1)
+    
+    for cycle_data in voltage_profile['voltage_curves']:
+        cycle_num = cycle_data['cycle_number']
         
-        # Generate differential voltage analysis plot (dV/dQ)
-        try:
-            fig2 = plt.figure(figsize=(10, 6))
-            ax2 = fig2.add_subplot(1, 1, 1)
+        # Calculate differential voltage for discharge
+        if cycle_data['discharge_data'] and len(cycle_data['discharge_data']['capacities']) > 2:
+            cap = np.array(cycle_data['discharge_data']['capacities'])
+            volt = np.array(cycle_data['discharge_data']['voltages'])
             
-            for cycle_data in result['voltage_curves']:
-                cycle_num = cycle_data['cycle_number']
-                
-                # Calculate differential voltage for discharge
-                if cycle_data['discharge_data'] and len(cycle_data['discharge_data']['capacities']) > 2:
-                    cap = np.array(cycle_data['discharge_data']['capacities'])
-                    volt = np.array(cycle_data['discharge_data']['voltages'])
-                    
-                    # Calculate dV/dQ using gradient
-                    dv = np.gradient(volt)
-                    dq = np.gradient(cap)
-                    dvdq = dv / dq
-                    
-                    # Filter out extreme values and smooth
-                    dvdq = np.clip(dvdq, -10, 10)  # Limit to reasonable range
-                    
-                    # Plot
-                    ax2.plot(cap, dvdq, label=f'Cycle {cycle_num}')
+            # Calculate dV/dQ using gradient
+            dv = np.gradient(volt)
+            dq = np.gradient(cap)
+            dvdq = dv / dq
             
-            ax2.set_xlabel('Capacity (Ah)')
-            ax2.set_ylabel('dV/dQ (V/Ah)')
-            ax2.set_title('Differential Voltage Analysis')
-            ax2.legend()
-            ax2.grid(True)
+            # Filter out extreme values and smooth
+            dvdq = np.clip(dvdq, -10, 10)  # Limit to reasonable range
             
-            plt.tight_layout()
-            result['differential_voltage_plot'] = fig_to_base64(fig2)
-        except Exception as e:
-            logger.warning(f"Could not generate differential voltage plot: {str(e)}")
+            # Plot
+            ax.plot(cap, dvdq, label=f'Cycle {cycle_num}')
     
-    return result
+    ax.set_xlabel('Capacity (Ah)')
+    ax.set_ylabel('dV/dQ (V/Ah)')
+    ax.set_title('Differential Voltage Analysis')
+    ax.legend()
+    ax.grid(True)
+    
+    fig.tight_layout()
+    return fig
 
 
-def analyze_temperature(data):
+def analyze_temperature(data, render_plots=True, columns=None):
     """
     Analyze temperature effects on battery performance.
     If temperature data is available, correlate with performance metrics.
@@ -605,35 +776,25 @@ def analyze_temperature(data):
         'average_temperature': None,
         'temperature_range': None,
         'temperature_vs_capacity_plot': None,
-        'temperature_stats': {}
+        'temperature_stats': {},
+        'temperature_capacity_series': None
     }
     
+    if columns is None:
+        columns = CycleColumns(data['cycle_data'])
+    
     # Check if we have temperature data in any cycle
-    temp_data_found = False
-    all_temps = []
-    cycle_temps = []  # Average temp for each cycle
-    cycle_capacities = []  # Discharge capacity for each cycle
-    cycle_numbers = []  # Cycle numbers
-    
-    for cycle in data['cycle_data']:
-        cycle_num = cycle.get('cycle_number')
-        
-        # Check if cycle has temperature data
-        if 'temperature_in_C' in cycle and cycle['temperature_in_C']:
-            temp_data_found = True
-            cycle_temps_array = np.array(cycle['temperature_in_C'])
-            all_temps.extend(cycle_temps_array)
-            
-            # Get average temperature for this cycle
-            avg_temp = np.mean(cycle_temps_array)
-            
-            # Get max discharge capacity for this cycle
-            discharge_cap = max(cycle.get('discharge_capacity_in_Ah', [0])) if cycle.get('discharge_capacity_in_Ah') else None
-            
-            if cycle_num is not None and discharge_cap is not None:
-                cycle_temps.append(avg_temp)
-                cycle_capacities.append(discharge_cap)
-                cycle_numbers.append(cycle_num)
+    all_temps = columns.signal('temperature_in_C')
+    temp_data_found = all_temps.size > 0
+    
+    # Average temperature and max discharge capacity of the cycles with temperature data
+    avg_temps = columns.cycle_mean('temperature_in_C')
+    discharge_caps = columns.cycle_max('discharge_capacity_in_Ah')
+    keep = (columns.lengths('temperature_in_C') > 0) & columns.has_cycle_number & ~np.isnan(discharge_caps)
+    
+    cycle_temps = avg_temps[keep].tolist()  # Average temp for each cycle
+    cycle_capacities = discharge_caps[keep].tolist()  # Discharge capacity for each cycle
+    cycle_numbers = [columns.cycle_numbers[i] for i in np.flatnonzero(keep)]  # Cycle numbers
     
     # If no direct temperature data, try to get from metadata
     test_temp = None
@@ -677,30 +838,47 @@ def analyze_temperature(data):
             'p90': test_temp
         }
     
-    # Generate temperature vs capacity plot if we have both data
+    # Keep the per-cycle series so the temperature vs capacity plot can be rendered later
     if temp_data_found and cycle_temps and cycle_capacities:
-        fig = plt.figure(figsize=(10, 6))
-        ax = fig.add_subplot(1, 1, 1)
-        
-        # Create scatter plot colored by cycle number
-        scatter = ax.scatter(cycle_temps, cycle_capacities, c=cycle_numbers, cmap='viridis')
-        
-        # Add colorbar
-        cbar = plt.colorbar(scatter)
-        cbar.set_label('Cycle Number')
-        
-        ax.set_xlabel('Temperature (°C)')
-        ax.set_ylabel('Discharge Capacity (Ah)')
-        ax.set_title('Temperature vs. Discharge Capacity')
-        ax.grid(True)
-        
-        plt.tight_layout()
-        result['temperature_vs_capacity_plot'] = fig_to_base64(fig)
+        result['temperature_capacity_series'] = {
+            'cycle_numbers': cycle_numbers,
+            'temperatures': cycle_temps,
+            'discharge_capacities': cycle_capacities
+        }
+    
+    # Generate temperature vs capacity plot if we have both data
+    if render_plots:
+        result['temperature_vs_capacity_plot'] = render_plot('temperature_vs_capacity_plot', result)
     
     return result
 
 
-def calculate_statistical_metrics(data):
+def create_temperature_plot(temperature_analysis):
+    """Create the temperature vs discharge capacity figure. Returns None without per-cycle temperatures."""
+    series = temperature_analysis.get('temperature_capacity_series')
+    if not series:
+        return None
+    
+    fig = plt.figure(figsize=(10, 6))
+    ax = fig.add_subplot(1, 1, 1)
+    
+    # Create scatter plot colored by cycle number
+    scatter = ax.scatter(series['temperatures'], series['discharge_capacities'], c=series['cycle_numbers'], cmap='viridis')
+    
+    # Add colorbar
+    cbar = fig.colorbar(scatter, ax=ax)
+    cbar.set_label('Cycle Number')
+    
+    ax.set_xlabel('Temperature (°C)')
+    ax.set_ylabel('Discharge Capacity (Ah)')
+    ax.set_title('Temperature vs. Discharge Capacity')
+    ax.grid(True)
+    
+    fig.tight_layout()
+    return fig
+
+
+def calculate_statistical_metrics(data, columns=None):
     """
     Calculate various statistical metrics from the battery data.
     """
@@ -711,42 +889,26 @@ def calculate_statistical_metrics(data):
         'cycle_life_projection': None
     }
     
-    # Collect data across all cycles
-    all_charge_caps = []
-    all_discharge_caps = []
-    all_currents = []
-    all_voltages = []
-    cycle_numbers = []
-    discharge_capacities = []
+    if columns is None:
+        columns = CycleColumns(data['cycle_data'])
     
-    for cycle in data['cycle_data']:
-        cycle_num = cycle.get('cycle_number')
-        
-        # Get charge and discharge capacities
-        charge_cap = max(cycle.get('charge_capacity_in_Ah', [0])) if cycle.get('charge_capacity_in_Ah') else None
-        discharge_cap = max(cycle.get('discharge_capacity_in_Ah', [0])) if cycle.get('discharge_capacity_in_Ah') else None
-        
-        # Collect data
-        if charge_cap is not None:
-            all_charge_caps.append(charge_cap)
-        
-        if discharge_cap is not None:
-            all_discharge_caps.append(discharge_cap)
-        
-        # Collect current and voltage data
-        if 'current_in_A' in cycle:
-            all_currents.extend(cycle['current_in_A'])
-        
-        if 'voltage_in_V' in cycle:
-            all_voltages.extend(cycle['voltage_in_V'])
-        
-        # Collect cycle numbers and discharge capacities for trend analysis
-        if cycle_num is not None and discharge_cap is not None:
-            cycle_numbers.append(cycle_num)
-            discharge_capacities.append(discharge_cap)
+    # Get charge and discharge capacities across all cycles
+    charge_caps = columns.cycle_max('charge_capacity_in_Ah')
+    discharge_caps = columns.cycle_max('discharge_capacity_in_Ah')
+    all_charge_caps = charge_caps[~np.isnan(charge_caps)]
+    all_discharge_caps = discharge_caps[~np.isnan(discharge_caps)]
+    
+    # Current and voltage data across all cycles
+    all_currents = columns.signal('current_in_A')
+    all_voltages = columns.signal('voltage_in_V')
+    
+    # Collect cycle numbers and discharge capacities for trend analysis
+    keep = columns.has_cycle_number & ~np.isnan(discharge_caps)
+    cycle_numbers = [columns.cycle_numbers[i] for i in np.flatnonzero(keep)]
+    discharge_capacities = discharge_caps[keep].tolist()
     
     # Calculate statistics and convert to Python types
-    if all_charge_caps:
+    if all_charge_caps.size:
         result['charge_discharge_stats']['charge_capacity'] = {
             'mean': float(np.mean(all_charge_caps)),
             'median': float(np.median(all_charge_caps)),
@@ -755,7 +917,7 @@ def calculate_statistical_metrics(data):
             'std_dev': float(np.std(all_charge_caps))
         }
     
-    if all_discharge_caps:
+    if all_discharge_caps.size:
         result['charge_discharge_stats']['discharge_capacity'] = {
             'mean': float(np.mean(all_discharge_caps)),
             'median': float(np.median(all_discharge_caps)),
@@ -764,7 +926,7 @@ def calculate_statistical_metrics(data):
             'std_dev': float(np.std(all_discharge_caps))
         }
     
-    if all_currents:
+    if all_currents.size:
         result['current_stats'] = {
             'mean': float(np.mean(all_currents)),
             'median': float(np.median(all_currents)),
@@ -773,7 +935,7 @@ def calculate_statistical_metrics(data):
             'std_dev': float(np.std(all_currents))
         }
     
-    if all_voltages:
+    if all_voltages.size:
         result['voltage_stats'] = {
             'mean': float(np.mean(all_voltages)),
             'median': float(np.median(all_voltages)),
@@ -817,7 +979,7 @@ def calculate_statistical_metrics(data):
     return result
 
 
-def assess_battery_health(data):
+def assess_battery_health(data, columns=None):
     """
     Assess overall battery health based on various metrics.
     """
@@ -828,22 +990,20 @@ def assess_battery_health(data):
         'degradation_indicators': []
     }
     
+    if columns is None:
+        columns = CycleColumns(data['cycle_data'])
+    
     # Extract first and last discharge capacities
     first_discharge_cap = None
     last_discharge_cap = None
     
-    if data['cycle_data']:
-        # Get first cycle with discharge capacity
-        for cycle in data['cycle_data']:
-            if 'discharge_capacity_in_Ah' in cycle and cycle['discharge_capacity_in_Ah']:
-                first_discharge_cap = max(cycle['discharge_capacity_in_Ah'])
-                break
-        
-        # Get last cycle with discharge capacity
-        for cycle in reversed(data['cycle_data']):
-            if 'discharge_capacity_in_Ah' in cycle and cycle['discharge_capacity_in_Ah']:
-                last_discharge_cap = max(cycle['discharge_capacity_in_Ah'])
-                break
+    charge_caps = columns.cycle_max('charge_capacity_in_Ah')
+    discharge_caps = columns.cycle_max('discharge_capacity_in_Ah')
+    cycles_with_discharge = np.flatnonzero(~np.isnan(discharge_caps))
+    if cycles_with_discharge.size:
+        # Get first and last cycles with discharge capacity
+        first_discharge_cap = float(discharge_caps[cycles_with_discharge[0]])
+        last_discharge_cap = float(discharge_caps[cycles_with_discharge[-1]])
     
     # Calculate capacity retention
     if first_discharge_cap and last_discharge_cap and first_discharge_cap > 0:
@@ -871,32 +1031,21 @@ def assess_battery_health(data):
             result['degradation_indicators'].append('Capacity Fade')
     
     # Check for other health indicators
-    coulombic_efficiencies = []
-    for cycle in data['cycle_data']:
-        # Get charge and discharge capacities
-        charge_cap = max(cycle.get('charge_capacity_in_Ah', [0])) if cycle.get('charge_capacity_in_Ah') else None
-        discharge_cap = max(cycle.get('discharge_capacity_in_Ah', [0])) if cycle.get('discharge_capacity_in_Ah') else None
-        
-        # Calculate coulombic efficiency
-        if charge_cap and discharge_cap and charge_cap > 0:
-            ce = (discharge_cap / charge_cap) * 100
-            coulombic_efficiencies.append(ce)
+    coulombic_efficiencies = coulombic_efficiency(charge_caps, discharge_caps)
+    coulombic_efficiencies = coulombic_efficiencies[~np.isnan(coulombic_efficiencies)]
     
     # Check coulombic efficiency
-    if coulombic_efficiencies:
+    if coulombic_efficiencies.size:
         avg_ce = np.mean(coulombic_efficiencies)
         if avg_ce < 98:
             result['degradation_indicators'].append('Low Coulombic Efficiency')
     
     # Check voltage indicators (simplified version)
-    all_voltages = []
-    for cycle in data['cycle_data']:
-        if 'voltage_in_V' in cycle:
-            all_voltages.extend(cycle['voltage_in_V'])
+    all_voltages = columns.signal('voltage_in_V')
     
-    if all_voltages:
-        max_voltage = max(all_voltages)
-        min_voltage = min(all_voltages)
+    if all_voltages.size:
+        max_voltage = all_voltages.max()
+        min_voltage = all_voltages.min()
         
         # Check for extreme voltage values
         if 'max_voltage_limit_in_V' in data and max_voltage > data['max_voltage_limit_in_V']:
@@ -908,6 +1057,72 @@ def assess_battery_health(data):
     return result
 
 
+# Plot name -> (analytics result section it is drawn from, figure factory)
+PLOTS = {
+    'capacity_plot': ('capacity_fade', create_capacity_plot),
+    'voltage_profile_plot': ('voltage_profile', create_voltage_profile_plot),
+    'differential_voltage_plot': ('voltage_profile', create_differential_voltage_plot),
+    'temperature_vs_capacity_plot': ('temperature_analysis', create_temperature_plot)
+}
+
+
+def render_plot_png(plot_name, section):
+    """
+    Render one plot from its analytics result section.
+    Returns the PNG bytes, or None if there is not enough data or the plot fails.
+    """
+    try:
+        with plot_lock:
+            fig = PLOTS[plot_name][1](section)
+            return fig_to_png(fig) if fig is not None else None
+    except Exception as e:
+        logger.warning(f"Could not generate {plot_name}: {str(e)}")
+        return None
+
+
+def render_plot(plot_name, section):
+    """Render one plot as a base64 encoded PNG string, or None."""
+    png = render_plot_png(plot_name, section)
+    return base64.b64encode(png).decode('utf-8') if png is not None else None
+
+
+def store_analysis(analytics_result):
+    """Keep an analytics result in the cache, dropping the oldest one when full. Returns its analysis_id."""
+    analysis_id = uuid.uuid4().hex
+    with analysis_cache_lock:
+        analysis_cache[analysis_id] = {'result': analytics_result, 'plots': {}}
+        while len(analysis_cache) > ANALYSIS_CACHE_SIZE:
+            analysis_cache.popitem(last=False)
+    return analysis_id
+
+
+@app.route('/api/plots/<analysis_id>/<plot_name>', methods=['GET'])
+def get_plot(analysis_id, plot_name):
+    """
+    API endpoint that renders one plot of an analysis returned by /api/upload?plots=false.
+    The PNG is cached with the analysis, so it is only rendered once.
+    """
+    if plot_name not in PLOTS:
+        return jsonify({'error': f'Unknown plot: {plot_name}. Available plots: {", ".join(PLOTS)}'}), 404
+    
+    with analysis_cache_lock:
+        entry = analysis_cache.get(analysis_id)
+        if entry is not None:
+            analysis_cache.move_to_end(analysis_id)
+    if entry is None:
+        return jsonify({'error': f'Unknown or expired analysis_id: {analysis_id}'}), 404
+    
+    png = entry['plots'].get(plot_name)
+    if png is None:
+        section = entry['result'][PLOTS[plot_name][0]]
+        png = render_plot_png(plot_name, section)
+        if png is None:
+            return jsonify({'error': f'Not enough data to generate {plot_name}'}), 404
+        entry['plots'][plot_name] = png
+    
+    return send_file(BytesIO(png), mimetype='image/png')
+
+
 @app.route('/')
 def home():
     """Root endpoint that provides basic API information."""
@@ -915,8 +1130,11 @@ def home():
         "name": "Battery Analytics API",
         "version": "1.0",
         "endpoints": {
-            "/api/upload": "Upload battery data files for analysis (POST)"
+            "/api/upload": "Upload battery data files for analysis (POST), add ?plots=false to skip the plots",
+            "/api/plots/<analysis_id>/<plot_name>": "Render one plot of an analysis uploaded with ?plots=false (GET)",
+            "/api/predict_rul": "Upload one cell to predict its cycle life (POST)"
         },
+        "rul_model_loaded": rul_predictor is not None,
         "status": "running"
     })
 
@@ -930,6 +1148,7 @@ if __name__ == '__main__':
     print(f"Local access only: http://localhost:{port}")
     print(f"Health check: http://localhost:{port}/")
     print(f"Upload endpoint: http://localhost:{port}/api/upload")
+    print(f"RUL prediction endpoint: http://localhost:{port}/api/predict_rul")
     print(f"To upload a file, use: python battery_analytics_client.py --file mock_battery_data.pkl")
     print("Note: This server is only accessible from localhost for security.")
     
@@ -11,6 +11,10 @@ def load_pickle(file_path):
     with open(file_path, 'rb') as f:
         return pickle.load(f)
 
+def has_samples(cycle, key):
+    """Whether a cycle has samples of a signal. The signals can be lists or numpy arrays."""
+    return cycle.get(key) is not None and len(cycle[key]) > 0
+
 def export_to_csv(data, file_name, output_dir="exported_data"):
     """Export battery data to CSV format."""
     # Create output directory if it doesn't exist
@@ -51,12 +55,12 @@ def export_to_csv(data, file_name, output_dir="exported_data"):
             cycle_num = cycle.get('cycle_number', None)
             
             # Get max voltage and current
-            max_voltage = max(cycle.get('voltage_in_V', [0])) if cycle.get('voltage_in_V') else None
-            max_current = max(cycle.get('current_in_A', [0])) if cycle.get('current_in_A') else None
+            max_voltage = max(cycle['voltage_in_V']) if has_samples(cycle, 'voltage_in_V') else None
+            max_current = max(cycle['current_in_A']) if has_samples(cycle, 'current_in_A') else None
             
             # Get charge and discharge capacities
-            charge_cap = max(cycle.get('charge_capacity_in_Ah', [0])) if cycle.get('charge_capacity_in_Ah') else None
-            discharge_cap = max(cycle.get('discharge_capacity_in_Ah', [0])) if cycle.get('discharge_capacity_in_Ah') else None
+            charge_cap = max(cycle['charge_capacity_in_Ah']) if has_samples(cycle, 'charge_capacity_in_Ah') else None
+            discharge_cap = max(cycle['discharge_capacity_in_Ah']) if has_samples(cycle, 'discharge_capacity_in_Ah') else None
             
             # Calculate coulombic efficiency if both charge and discharge capacity are available
             coulombic_efficiency = None
@@ -116,8 +120,8 @@ def plot_battery_metrics(file_path, output_dir="plots"):
         cycle_numbers.append(cycle_num)
         
         # Get charge and discharge capacities
-        charge_cap = max(cycle.get('charge_capacity_in_Ah', [0])) if cycle.get('charge_capacity_in_Ah') else 0
-        discharge_cap = max(cycle.get('discharge_capacity_in_Ah', [0])) if cycle.get('discharge_capacity_in_Ah') else 0
+        charge_cap = max(cycle['charge_capacity_in_Ah']) if has_samples(cycle, 'charge_capacity_in_Ah') else 0
+        discharge_cap = max(cycle['discharge_capacity_in_Ah']) if has_samples(cycle, 'discharge_capacity_in_Ah') else 0
         
         charge_capacities.append(charge_cap)
         discharge_capacities.append(discharge_cap)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Columnar view of battery cycle data used by the analytics API.
+Each signal is concatenated into one float array with cycle offsets, so the analyses
+use vectorized reductions instead of looping over Python lists.
+"""
+
+import numpy as np
+
+# Per-sample signals that the analyses read
+SIGNAL_KEYS = [
+    'current_in_A', 'voltage_in_V', 'charge_capacity_in_Ah',
+    'discharge_capacity_in_Ah', 'temperature_in_C'
+]
+
+
+class CycleColumns:
+    """
+    Built once per upload from data['cycle_data'].
+    The samples of a signal in cycle i are values[key][offsets[key][i]:offsets[key][i + 1]].
+    The signals of a cycle can be lists or numpy arrays (e.g. read from a columnar .bcell file).
+    Cycles without a signal (missing key, None or empty) have no samples.
+    Per-cycle reductions are NaN for cycles without samples.
+    """
+
+    def __init__(self, cycle_data):
+        self.num_cycles = len(cycle_data)
+        self.cycle_numbers = [cycle.get('cycle_number') for cycle in cycle_data]
+        self.has_cycle_number = np.array([number is not None for number in self.cycle_numbers], dtype=bool)
+        self.values = {}
+        self.offsets = {}
+        self.cycle_max_cache = {}
+        self.cycle_mean_cache = {}
+
+        for key in SIGNAL_KEYS:
+            signals = [cycle.get(key) if cycle.get(key) is not None else [] for cycle in cycle_data]
+            lengths = np.array([len(signal) for signal in signals], dtype=np.int64)
+            offsets = np.zeros(self.num_cycles + 1, dtype=np.int64)
+            np.cumsum(lengths, out=offsets[1:])
+            if offsets[-1] > 0:
+                values = np.concatenate([np.asarray(signal, dtype=float) for signal in signals if len(signal) > 0])
+            else:
+                values = np.zeros(0)
+            self.values[key] = values
+            self.offsets[key] = offsets
+
+    def signal(self, key):
+        """All the samples of a signal across the cycles"""
+        return self.values[key]
+
+    def lengths(self, key):
+        """Number of samples of a signal in each cycle"""
+        return np.diff(self.offsets[key])
+
+    def cycle_signal(self, key, cycle_index):
+        """The samples of a signal in one cycle"""
+        offsets = self.offsets[key]
+        return self.values[key][offsets[cycle_index]:offsets[cycle_index + 1]]
+
+    def reduce_cycles(self, ufunc, key):
+        """Apply ufunc.reduceat over the cycles that have samples, NaN for the other cycles"""
+        result = np.full(self.num_cycles, np.nan)
+        non_empty = self.lengths(key) > 0
+        if non_empty.any():
+            result[non_empty] = ufunc.reduceat(self.values[key], self.offsets[key][:-1][non_empty])
+        return result
+
+    def cycle_max(self, key):
+        """Maximum of a signal in each cycle (e.g. the charge or discharge capacity of the cycle)"""
+        if key not in self.cycle_max_cache:
+            self.cycle_max_cache[key] = self.reduce_cycles(np.maximum, key)
+        return self.cycle_max_cache[key]
+
+    def cycle_mean(self, key):
+        """Mean of a signal in each cycle"""
+        if key not in self.cycle_mean_cache:
+            with np.errstate(invalid='ignore'):
+                self.cycle_mean_cache[key] = self.reduce_cycles(np.add, key) / self.lengths(key)
+        return self.cycle_mean_cache[key]
+
+
+def nan_to_none(values):
+    """Convert an array to a list of Python floats with None in place of NaN"""
+    return [None if np.isnan(value) else value for value in values.tolist()]
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+Slim RUL runtime for the graphs written by export_model.py
+Only NumPy and torch (TorchScript) or onnxruntime (ONNX) are imported, so a scoring job or a worker starts without
+the model code, accelerate, deepspeed or transformers
+
+Usage:
+    python RUL/exported_predictor.py --export_path <checkpoint folder>/export --curves curves.npy
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+
+RUNTIME_CONFIG_NAME = 'runtime.json'
+GRAPH_NAMES = {'torchscript': 'model.pt', 'onnx': 'model.onnx'}
+
+
+class ExportedRULPredictor:
+    """
+    Predicts the cycle life of cells from their resampled curves with an exported graph.
+    The predictions are the same as the ones of RULPredictor on the checkpoint the graph was exported from.
+    """
+
+    def __init__(self, export_path, num_threads=None):
+        with open(os.path.join(export_path, RUNTIME_CONFIG_NAME), 'r') as f:
+            self.config = json.load(f)
+        self.export_path = export_path
+        self.model_type = self.config['model']
+        self.format = self.config['format']
+        self.early_cycle_threshold = self.config['early_cycle_threshold']
+        self.charge_discharge_length = self.config['charge_discharge_length']
+        self.std = float(np.sqrt(self.config['label_var']))
+        self.mean_value = float(self.config['label_mean'])
+
+        graph_file = os.path.join(export_path, GRAPH_NAMES[self.format])
+        if self.format == 'torchscript':
+            import torch
+            if num_threads is not None:
+                torch.set_num_threads(num_threads)
+            self.torch = torch
+            self.model = torch.jit.load(graph_file, map_location='cpu')
+            self.model.eval()
+        else:
+            import onnxruntime
+            options = onnxruntime.SessionOptions()
+            if num_threads is not None:
+                options.intra_op_num_threads = num_threads
+            self.session = onnxruntime.InferenceSession(graph_file, options, providers=['CPUExecutionProvider'])
+            # The inputs the model does not use (e.g. the mask of CPMLP) are dropped from the graph
+            self.input_names = [graph_input.name for graph_input in self.session.get_inputs()]
+
+    def run(self, cycle_curve_data, curve_attn_mask):
+        """
+        Run the graph on a batch
+        :param cycle_curve_data: float32 [B, early_cycle_threshold, 3, charge_discharge_length], the unseen cycles are zeros
+        :param curve_attn_mask: float32 [B, early_cycle_threshold]
+        :return: the scaled predictions [B, output_num]
+        """
+        if self.format == 'torchscript':
+            with self.torch.inference_mode():
+                outputs = self.model(self.torch.from_numpy(cycle_curve_data), self.torch.from_numpy(curve_attn_mask))
+            return outputs.numpy()
+        inputs = {'cycle_curve_data': cycle_curve_data, 'curve_attn_mask': curve_attn_mask}
+        return self.session.run(None, {name: inputs[name] for name in self.input_names})[0]
+
+    def predict_batch(self, curves, seen_cycles):
+        """
+        Predict the cycle life (EOL) of a batch of cells
+        :param curves: [B, early_cycle_threshold, 3, charge_discharge_length] resampled curves of the early cycles
+        :param seen_cycles: [B] number of early cycles the model sees for each cell
+        :return: [B] predicted EOL
+        """
+        seen_cycles = np.asarray(seen_cycles, dtype=np.int64).reshape(-1)
+        if np.any(seen_cycles < 1) or np.any(seen_cycles > self.early_cycle_threshold):
+            raise ValueError(f"seen_cycles must be between 1 and {self.early_cycle_threshold}")
+        curve_attn_mask = (np.arange(self.early_cycle_threshold)[None, :] < seen_cycles[:, None]).astype(np.float32)
+        cycle_curve_data = np.array(curves, dtype=np.float32) * curve_attn_mask[:, :, None, None] # set the unseen data as zeros
+        outputs = self.run(cycle_curve_data, curve_attn_mask)
+        return outputs.reshape(len(seen_cycles), -1)[:, 0] * self.std + self.mean_value
+
+    def predict_curves(self, curves, seen_cycles, last_cycle, cell_name='CALB'):
+        """
+        Predict the cycle life (EOL) of one cell from its [early_cycle_threshold, 3, charge_discharge_length] curves
+        The RUL is counted from last_cycle, the number of cycles in the cell, like RULPredictor.predict
+        """
+        start_time = time.time()
+        predicted_eol = float(self.predict_batch(np.asarray(curves)[None], [seen_cycles])[0])
+        return {
+            'cell_id': cell_name,
+            'model': self.model_type,
+            'seen_cycles': int(seen_cycles),
+            'last_cycle': int(last_cycle),
+            'predicted_eol': predicted_eol,
+            'predicted_rul': max(predicted_eol - last_cycle, 0.0),
+            'latency_ms': (time.time() - start_time) * 1000
+        }
+
+    def predict(self, cell_data, cell_name=None, seen_cycles=None):
+        """
+        Predict the cycle life (EOL) of one cell from its raw battery data, see RULPredictor.predict
+        The curve extraction only needs NumPy, so it is imported from data_provider on the first call
+        """
+        sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        from data_provider.curve_extraction import extract_cell_curves
+        if 'nominal_capacity_in_Ah' not in cell_data:
+            raise ValueError("Missing 'nominal_capacity_in_Ah' in battery data")
+        if cell_name is None:
+            cell_name = str(cell_data.get('cell_id', 'CALB'))
+        cycle_data = cell_data['cycle_data']
+        curves = extract_cell_curves(cell_name, cycle_data, float(cell_data['nominal_capacity_in_Ah']),
+                                     self.early_cycle_threshold, self.charge_discharge_length)
+        if np.any(np.isnan(curves)):
+            raise ValueError(f"The curves of {cell_name} contain NaN")
+        available_cycles = min(len(cycle_data), self.early_cycle_threshold)
+        if seen_cycles is None:
+            seen_cycles = available_cycles
+        if seen_cycles < 1 or seen_cycles > available_cycles:
+            raise ValueError(f"seen_cycles must be between 1 and {available_cycles}")
+        return self.predict_curves(curves, seen_cycles, len(cycle_data), cell_name)
+
+
+def main():
+    start_time = time.time()
+    parser = argparse.ArgumentParser(description='Predict the cycle life of cells with a graph written by export_model.py')
+    parser.add_argument('--export_path', type=str, required=True, help='the folder with runtime.json and the exported graph')
+    parser.add_argument('--curves', type=str, required=True, help='.npy file of [N, early_cycle, 3, charge_discharge_length] resampled curves')
+    parser.add_argument('--seen_cycles', type=int, nargs='+', default=None,
+                        help='the seen cycles of each cell; defaults to the cycles up to the last non-zero one')
+    parser.add_argument('--num_threads', type=int, default=None)
+    args = parser.parse_args()
+
+    predictor = ExportedRULPredictor(args.export_path, num_threads=args.num_threads)
+    curves = np.load(args.curves)
+    if curves.ndim == 3:
+        curves = curves[None]
+    if args.seen_cycles is None:
+        nonzero_cycles = np.any(curves.reshape(curves.shape[0], curves.shape[1], -1) != 0, axis=-1) # [N, early_cycle]
+        seen_cycles = curves.shape[1] - np.argmax(nonzero_cycles[:, ::-1], axis=1)
+    else:
+        seen_cycles = np.array(args.seen_cycles if len(args.seen_cycles) > 1 else args.seen_cycles * len(curves))
+    predicted_eol = predictor.predict_batch(curves, seen_cycles)
+    # The curves only hold the early cycles, so the remaining cycles are counted from the last seen one and not from
+    # the last cycle of the cell
+    for i, (eol, seen) in enumerate(zip(predicted_eol, seen_cycles)):
+        print(json.dumps({'cell': i, 'seen_cycles': int(seen), 'predicted_eol': float(eol),
+                          'rul_from_last_seen_cycle': max(float(eol) - int(seen), 0.0)}))
+    print(f'{len(curves)} cells in {(time.time() - start_time) * 1000:.0f} ms since start-up', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Dynamic micro-batching for concurrent RUL inference requests
+The queued requests run as one batch when the batch is full or when the oldest request has waited long enough
+"""
+
+import time
+import queue
+import threading
+from concurrent.futures import Future
+import torch
+
+
+class MicroBatcher:
+    """
+    Coalesce the inputs of concurrent requests into batches for batch_fn.
+    Each request submits tensors of the same shape (e.g. [L, 3, charge_discharge_len] curves and an [L] mask),
+    which are stacked along a new batch dimension. The i-th row of the batch output is returned to the i-th request.
+    """
+
+    def __init__(self, batch_fn, max_batch_size=16, max_wait_ms=5.0):
+        """
+        :param batch_fn: function mapping the stacked inputs to outputs whose first dimension is the batch
+        :param max_batch_size: flush the batch when it has this many requests
+        :param max_wait_ms: flush the batch when its oldest request has waited this long
+        """
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.requests = queue.Queue()
+        self.closed = False
+        self.worker = threading.Thread(target=self.run, name='rul-micro-batcher', daemon=True)
+        self.worker.start()
+
+    def submit(self, *inputs):
+        """Queue one request and return a Future of its output"""
+        if self.closed:
+            raise RuntimeError('The micro batcher is closed')
+        future = Future()
+        self.requests.put((inputs, future))
+        return future
+
+    def __call__(self, *inputs):
+        """Run one request and wait for its output"""
+        return self.submit(*inputs).result()
+
+    def collect_batch(self):
+        """Wait for the first request, then keep collecting until the batch is full or the deadline passes"""
+        first_request = self.requests.get()
+        if first_request is None:
+            return []
+        batch = [first_request]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                # Stop after this batch
+                self.requests.put(None)
+                break
+            batch.append(request)
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.collect_batch()
+            if not batch:
+                break
+            inputs, futures = zip(*batch)
+            try:
+                stacked_inputs = [torch.stack(tensors) for tensors in zip(*inputs)]
+                outputs = self.batch_fn(*stacked_inputs)
+                for i, future in enumerate(futures):
+                    future.set_result(outputs[i])
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+
+    def close(self):
+        """Run the queued requests and stop the worker"""
+        self.closed = True
+        self.requests.put(None)
+        self.worker.join()
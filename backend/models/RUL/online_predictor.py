@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Online RUL updates for fleets of cells whose cycles arrive one at a time
+The recurrent models (CPLSTM, CPBiLSTM, CPBiGRU) keep a streaming state per cell, so a new cycle costs one
+recurrent step instead of a forward pass over all the seen cycles
+"""
+
+import threading
+from collections import OrderedDict
+import torch
+from rul_predictor import RULPredictor, DEFAULT_MODEL_PATH
+
+
+class StreamStateStore:
+    """
+    Bounded store of the streaming states of the cells with LRU eviction.
+    Each entry is (state, seen_cycles), where state is a tuple of tensors without the batch dimension.
+    """
+
+    def __init__(self, max_cells=10000):
+        self.max_cells = max_cells
+        self.entries = OrderedDict()
+
+    def get(self, cell_id):
+        """The entry of the cell, None if the cell is unknown or was evicted"""
+        entry = self.entries.get(cell_id)
+        if entry is not None:
+            self.entries.move_to_end(cell_id)
+        return entry
+
+    def put(self, cell_id, state, seen_cycles):
+        """Store the entry of the cell and evict the least recently used cells beyond max_cells"""
+        self.entries[cell_id] = (state, seen_cycles)
+        self.entries.move_to_end(cell_id)
+        while len(self.entries) > self.max_cells:
+            self.entries.popitem(last=False)
+
+    def pop(self, cell_id):
+        return self.entries.pop(cell_id, None)
+
+    def __contains__(self, cell_id):
+        return cell_id in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class OnlineRULPredictor(RULPredictor):
+    """
+    Keeps the streaming state of each cell in a StreamStateStore and advances it by one cycle per update.
+    The updates of many cells are run as one batch.
+    A cell that is unknown or was evicted starts again from its first cycle, which shows in seen_cycles.
+    """
+
+    def __init__(self, model_path=DEFAULT_MODEL_PATH, device=None, max_cells=10000, quantized=False):
+        super().__init__(model_path, device=device, quantized=quantized)
+        if not hasattr(self.model, 'stream_step'):
+            raise ValueError(f"{self.model_type} does not support streaming updates")
+        self.store = StreamStateStore(max_cells)
+        self.lock = threading.Lock()
+
+    def update(self, cycle_curves):
+        """
+        Add the next cycle of each cell
+        :param cycle_curves: {cell_id: [3, charge_discharge_length] resampled curves of the next cycle of the cell}
+        :return: {cell_id: prediction} given all the cycles of the cell seen so far
+        """
+        cell_ids = list(cycle_curves)
+        if not cell_ids:
+            return {}
+        cycle_curve_data = torch.stack([torch.as_tensor(cycle_curves[cell_id], dtype=torch.float32) for cell_id in cell_ids]).to(self.device)
+        with self.lock, torch.inference_mode():
+            entries = [self.store.get(cell_id) for cell_id in cell_ids]
+            for cell_id, entry in zip(cell_ids, entries):
+                if entry is not None and entry[1] >= self.early_cycle_threshold:
+                    raise ValueError(f"{cell_id} has already reached the {self.early_cycle_threshold} cycles seen by the model")
+
+            # Cells without a state start from the initial state
+            init_state = self.model.init_stream_state(len(cell_ids))
+            state = tuple(torch.stack([entry[0][k] if entry is not None else init_state[k][i] for i, entry in enumerate(entries)])
+                          for k in range(len(init_state)))
+            outputs, state = self.model.stream_step(cycle_curve_data, state)
+
+            results = {}
+            outputs = outputs.cpu()
+            for i, (cell_id, entry) in enumerate(zip(cell_ids, entries)):
+                seen_cycles = (entry[1] if entry is not None else 0) + 1
+                self.store.put(cell_id, tuple(s[i].clone() for s in state), seen_cycles)
+                predicted_eol = float(outputs[i].reshape(-1)[0].item() * self.std + self.mean_value)
+                results[cell_id] = {
+                    'cell_id': cell_id,
+                    'model': self.model_type,
+                    'seen_cycles': seen_cycles,
+                    'predicted_eol': predicted_eol,
+                    'predicted_rul': max(predicted_eol - seen_cycles, 0.0)
+                }
+        return results
+
+    def start(self, cell_id, cycle_curves):
+        """
+        (Re)start the stream of a cell from the curves of its seen cycles, e.g. after it was evicted
+        :param cycle_curves: [N, 3, charge_discharge_length]
+        :return: the prediction after the last cycle
+        """
+        with self.lock:
+            self.store.pop(cell_id)
+        result = None
+        for cycle_curve in cycle_curves:
+            result = self.update({cell_id: cycle_curve})[cell_id]
+        return result
+
+    def reset(self, cell_id):
+        """Forget the state of a cell"""
+        with self.lock:
+            self.store.pop(cell_id)
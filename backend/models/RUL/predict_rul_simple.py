@@ -17,11 +17,12 @@ import joblib
 from transformers import AutoTokenizer
 from models import CPTransformer, CPBiLSTM, CPBiGRU, CPLSTM, CPMLP
 from data_provider.data_factory import data_provider_evaluate
+from utils.tools import predict_prefixes_baseline
 from accelerate import Accelerator, DeepSpeedPlugin, load_checkpoint_in_model
 from accelerate import DistributedDataParallelKwargs
 from tqdm import tqdm
 import argparse
-from sklearn.metrics import mean_absolute_error, mean_squared_error, mean_absolute_percentage_error
+from utils.metrics import mean_absolute_error, mean_squared_error, mean_absolute_percentage_error
 import warnings
 warnings.filterwarnings('ignore')
 
@@ -174,7 +175,7 @@ def analyze_predictions_in_detail(predictions, ground_truth, dataset_ids, seen_u
     
     return df
 
-def load_model_and_predict(model_path, dataset='CALB', model_type='CPTransformer', eval_cycle_min=1, eval_cycle_max=100):
+def load_model_and_predict(model_path, dataset='CALB', model_type='CPTransformer', eval_cycle_min=1, eval_cycle_max=100, batched_prefix_inference=False):
     """Load model and make RUL predictions on test data"""
     
     print(f"LOADING MODEL AND MAKING RUL PREDICTIONS")
@@ -284,34 +285,39 @@ def load_model_and_predict(model_path, dataset='CALB', model_type='CPTransformer
         total_seen_cycles = []
         
         model.eval()
-        with torch.no_grad():
-            for i, batch_data in tqdm(enumerate(test_loader), total=len(test_loader)):
-                cycle_curve_data, curve_attn_mask, labels, life_class, scaled_life_class, weights, dataset_ids, seen_unseen_ids = batch_data
-                
-                cycle_curve_data = cycle_curve_data.float().to(accelerator.device)
-                curve_attn_mask = curve_attn_mask.float().to(accelerator.device)
-                labels = labels.float().to(accelerator.device)
-                seen_number_of_cycles = torch.sum(curve_attn_mask, dim=1)
-                
-                # Get RUL predictions
-                outputs = model(cycle_curve_data, curve_attn_mask)
-                
-                # Transform back to original scale (actual RUL values)
-                transformed_preds = outputs * std + mean_value
-                transformed_labels = labels * std + mean_value
-                
-                # Gather results
-                gathered = accelerator.gather_for_metrics((
-                    transformed_preds, transformed_labels, dataset_ids, 
-                    seen_unseen_ids, seen_number_of_cycles
-                ))
-                
-                total_preds.extend(gathered[0].detach().cpu().numpy().reshape(-1).tolist())
-                total_references.extend(gathered[1].detach().cpu().numpy().reshape(-1).tolist())
-                total_dataset_ids.extend(gathered[2].detach().cpu().numpy().reshape(-1).tolist())
-                total_seen_unseen_ids.extend(gathered[3].detach().cpu().numpy().reshape(-1).tolist())
-                total_seen_cycles.extend(gathered[4].detach().cpu().numpy().reshape(-1).tolist())
-        
+        if batched_prefix_inference:
+            # Predict all the prefix lengths of a cell in one pass
+            gathered = predict_prefixes_baseline(accelerator, model, test_data)
+            total_preds, total_references, total_dataset_ids, total_seen_unseen_ids, total_seen_cycles = [i.tolist() for i in gathered]
+        else:
+            with torch.no_grad():
+                for i, batch_data in tqdm(enumerate(test_loader), total=len(test_loader)):
+                    cycle_curve_data, curve_attn_mask, labels, life_class, scaled_life_class, weights, dataset_ids, seen_unseen_ids = batch_data
+                    
+                    cycle_curve_data = cycle_curve_data.float().to(accelerator.device)
+                    curve_attn_mask = curve_attn_mask.float().to(accelerator.device)
+                    labels = labels.float().to(accelerator.device)
+                    seen_number_of_cycles = torch.sum(curve_attn_mask, dim=1)
+                    
+                    # Get RUL predictions
+                    outputs = model(cycle_curve_data, curve_attn_mask)
+                    
+                    # Transform back to original scale (actual RUL values)
+                    transformed_preds = outputs * std + mean_value
+                    transformed_labels = labels * std + mean_value
+                    
+                    # Gather results
+                    gathered = accelerator.gather_for_metrics((
+                        transformed_preds, transformed_labels, dataset_ids, 
+                        seen_unseen_ids, seen_number_of_cycles
+                    ))
+                    
+                    total_preds.extend(gathered[0].detach().cpu().numpy().reshape(-1).tolist())
+                    total_references.extend(gathered[1].detach().cpu().numpy().reshape(-1).tolist())
+                    total_dataset_ids.extend(gathered[2].detach().cpu().numpy().reshape(-1).tolist())
+                    total_seen_unseen_ids.extend(gathered[3].detach().cpu().numpy().reshape(-1).tolist())
+                    total_seen_cycles.extend(gathered[4].detach().cpu().numpy().reshape(-1).tolist())
+            
         print("RUL predictions complete!")
         print()
         
@@ -342,6 +348,7 @@ def main():
                        help='Model architecture type')
     parser.add_argument('--eval_cycle_min', type=int, default=1, help='Minimum evaluation cycle')
     parser.add_argument('--eval_cycle_max', type=int, default=100, help='Maximum evaluation cycle')
+    parser.add_argument('--batched_prefix_inference', action='store_true', help='Predict all the prefix lengths of a cell in one pass')
     
     args = parser.parse_args()
     
@@ -353,7 +360,8 @@ def main():
         dataset=args.dataset,
         model_type=args.model_type,
         eval_cycle_min=args.eval_cycle_min,
-        eval_cycle_max=args.eval_cycle_max
+        eval_cycle_max=args.eval_cycle_max,
+        batched_prefix_inference=args.batched_prefix_inference
     )
     
     if results is not None:
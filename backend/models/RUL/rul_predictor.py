@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+Battery RUL (Remaining Useful Life) predictor for serving
+Loads a trained checkpoint and its scalers once, then predicts the cycle life of single cells
+"""
+
+import sys
+import os
+# Add this and the parent directory to path so we can import modules
+RUL_DIR = os.path.dirname(os.path.abspath(__file__))
+MODELS_DIR = os.path.dirname(RUL_DIR)
+sys.path.append(RUL_DIR)
+sys.path.append(MODELS_DIR)
+
+import json
+import time
+import numpy as np
+import torch
+import joblib
+from models import CPTransformer, CPBiLSTM, CPBiGRU, CPLSTM, CPMLP
+from data_provider.curve_extraction import extract_cell_curves
+from micro_batcher import MicroBatcher
+from utils.quantization import load_quantized_model
+
+DEFAULT_MODEL_PATH = os.path.join(MODELS_DIR, 'checkpoints/CALB_CPTransformer/CPTransformer_sl1_lr0.0001_dm128_nh4_el6_dl2_df256_lradjconstant_datasetCALB_lossMSE_wd0.0_wlFalse_bs16_s2021-CALB_CPTransformer')
+
+MODEL_CLASSES = {
+    'CPTransformer': CPTransformer,
+    'CPBiLSTM': CPBiLSTM,
+    'CPBiGRU': CPBiGRU,
+    'CPLSTM': CPLSTM,
+    'CPMLP': CPMLP
+}
+
+
+class Args:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def load_model_weights(model, model_path):
+    """Load the parameters saved by accelerator.save_model (or torch.save) into the model"""
+    safetensors_file = os.path.join(model_path, 'model.safetensors')
+    bin_file = os.path.join(model_path, 'pytorch_model.bin')
+    state_dict_file = os.path.join(model_path, 'checkpoint')
+    if os.path.exists(safetensors_file):
+        from safetensors.torch import load_file
+        state_dict = load_file(safetensors_file)
+    elif os.path.exists(bin_file):
+        state_dict = torch.load(bin_file, map_location='cpu')
+    elif os.path.exists(state_dict_file):
+        state_dict = torch.load(state_dict_file, map_location='cpu')
+    else:
+        raise FileNotFoundError(f"No model weights (model.safetensors, pytorch_model.bin or checkpoint) found in {model_path}")
+    model.load_state_dict(state_dict)
+
+
+class RULPredictor:
+    """
+    Keeps a trained model and its scalers in memory.
+    Only the uploaded cell goes through the curve extraction, so a prediction takes a single forward pass.
+    With max_batch_size > 1, concurrent predictions are coalesced into batches by a MicroBatcher.
+    With quantized, the int8 weights written by quantize_model.py are served on the CPU.
+    """
+
+    def __init__(self, model_path=DEFAULT_MODEL_PATH, device=None, max_batch_size=1, max_wait_ms=5.0, quantized=False):
+        with open(os.path.join(model_path, 'args.json'), 'r') as f:
+            self.args = Args(**json.load(f))
+        if self.args.model not in MODEL_CLASSES:
+            raise ValueError(f"Unsupported model type: {self.args.model}")
+
+        self.model_path = model_path
+        self.model_type = self.args.model
+        self.early_cycle_threshold = self.args.early_cycle_threshold
+        self.charge_discharge_length = self.args.charge_discharge_length
+        self.device = torch.device(device if device is not None else ('cuda' if torch.cuda.is_available() and not quantized else 'cpu'))
+        if quantized and self.device.type != 'cpu':
+            raise ValueError("The quantized model only runs on the CPU")
+
+        self.model = MODEL_CLASSES[self.model_type].Model(self.args).float()
+        if quantized:
+            self.model = load_quantized_model(self.model, model_path)
+        else:
+            load_model_weights(self.model, model_path)
+        self.model.to(self.device)
+        self.model.eval()
+
+        self.label_scaler = joblib.load(os.path.join(model_path, 'label_scaler'))
+        self.life_class_scaler = joblib.load(os.path.join(model_path, 'life_class_scaler'))
+        self.std = np.sqrt(self.label_scaler.var_[-1])
+        self.mean_value = self.label_scaler.mean_[-1]
+
+        self.warmup()
+        self.batcher = MicroBatcher(self.predict_batch, max_batch_size, max_wait_ms) if max_batch_size > 1 else None
+
+    def warmup(self):
+        """Run one dummy forward pass so that the first request does not pay the initialization cost"""
+        cycle_curve_data = torch.zeros(1, self.early_cycle_threshold, 3, self.charge_discharge_length, device=self.device)
+        curve_attn_mask = torch.ones(1, self.early_cycle_threshold, device=self.device)
+        with torch.inference_mode():
+            self.model(cycle_curve_data, curve_attn_mask)
+
+    def predict_batch(self, cycle_curve_data, curve_attn_mask):
+        """
+        Predict the scaled labels of a batch
+        :param cycle_curve_data: [B, L, 3, charge_discharge_length], the unseen cycles are zeros
+        :param curve_attn_mask: [B, L]
+        :return: [B, output_num] on the CPU
+        """
+        with torch.inference_mode():
+            outputs = self.model(cycle_curve_data.to(self.device), curve_attn_mask.to(self.device))
+        return outputs.cpu()
+
+    def get_cell_curves(self, cell_data, cell_name):
+        """
+        Resample the early charge and discharge curves of one cell
+        :return: (curves, available early cycles, cycles in the cell)
+        """
+        if 'nominal_capacity_in_Ah' not in cell_data:
+            raise ValueError("Missing 'nominal_capacity_in_Ah' in battery data")
+        cycle_data = cell_data['cycle_data']
+        curves = extract_cell_curves(cell_name, cycle_data, float(cell_data['nominal_capacity_in_Ah']),
+                                     self.early_cycle_threshold, self.charge_discharge_length)
+        if np.any(np.isnan(curves)):
+            raise ValueError(f"The curves of {cell_name} contain NaN")
+        return curves, min(len(cycle_data), self.early_cycle_threshold), len(cycle_data)
+
+    def predict(self, cell_data, cell_name=None, seen_cycles=None):
+        """
+        Predict the cycle life (EOL) of one cell
+        :param cell_data: battery data dict with 'cycle_data' and 'nominal_capacity_in_Ah'
+        :param cell_name: decides whether the cycles start with charging or discharging (e.g. CALB_0_B182)
+        :param seen_cycles: number of early cycles the model sees. Defaults to all the available early cycles
+        The RUL is counted from the last cycle of the cell, not from the cycles the model sees
+        """
+        start_time = time.time()
+        if cell_name is None:
+            cell_name = str(cell_data.get('cell_id', 'CALB'))
+        curves, available_cycles, last_cycle = self.get_cell_curves(cell_data, cell_name)
+        if seen_cycles is None:
+            seen_cycles = available_cycles
+        if seen_cycles < 1 or seen_cycles > available_cycles:
+            raise ValueError(f"seen_cycles must be between 1 and {available_cycles}")
+
+        curve_attn_mask = np.zeros(self.early_cycle_threshold)
+        curve_attn_mask[:seen_cycles] = 1
+        curves[seen_cycles:] = 0 # set the unseen data as zeros
+        cycle_curve_data = torch.Tensor(curves)
+        curve_attn_mask = torch.Tensor(curve_attn_mask)
+        if self.batcher is None:
+            outputs = self.predict_batch(cycle_curve_data.unsqueeze(0), curve_attn_mask.unsqueeze(0))[0]
+        else:
+            outputs = self.batcher(cycle_curve_data, curve_attn_mask)
+        predicted_eol = float(outputs.reshape(-1)[0].item() * self.std + self.mean_value)
+
+        return {
+            'cell_id': cell_name,
+            'model': self.model_type,
+            'seen_cycles': int(seen_cycles),
+            'last_cycle': int(last_cycle),
+            'predicted_eol': predicted_eol,
+            'predicted_rul': max(predicted_eol - last_cycle, 0.0),
+            'latency_ms': (time.time() - start_time) * 1000
+        }
@@ -16,13 +16,14 @@ The script prints a human-readable summary and can save a JSON report.
 """
 import argparse
 import os
-import pickle
 import json
 from typing import Optional, Dict, Any, List, Tuple
 
 import numpy as np
 from sklearn.linear_model import LinearRegression
 
+from data_provider.columnar_cell import load_cell
+
 
 def compute_soh_list(data: Dict[str, Any], file_name: Optional[str] = None) -> Tuple[List[float], float]:
     """Compute SOH list per cycle and return (soh_list, nominal_capacity)
@@ -125,8 +126,8 @@ def summarize_from_pkl(pkl_path: str, save_json: Optional[str] = None) -> Dict[s
         raise FileNotFoundError(pkl_path)
 
     file_name = os.path.basename(pkl_path)
-    with open(pkl_path, 'rb') as f:
-        data = pickle.load(f)
+    # Only the discharge capacities are read from a columnar .bcell file
+    data = load_cell(pkl_path, keys=['discharge_capacity_in_Ah'])
 
     soh_list, nominal_capacity = compute_soh_list(data, file_name)
     eol_info = estimate_eol_from_soh_list(soh_list)
@@ -189,7 +190,7 @@ def human_print_report(report: Dict[str, Any]):
 
 def main():
     parser = argparse.ArgumentParser(description='Compute SOH/EOL/RUL from a battery .pkl file')
-    parser.add_argument('pkl', type=str, help='Path to the .pkl file for a single battery')
+    parser.add_argument('pkl', type=str, help='Path to the .pkl (or columnar .bcell) file for a single battery')
     parser.add_argument('--save-json', type=str, default=None, help='Optional path to save JSON report')
     args = parser.parse_args()
 
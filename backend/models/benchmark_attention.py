@@ -0,0 +1,110 @@
+'''
+Benchmark the attention backends of CPTransformer (--attention_backend full or fused).
+The intra-cycle part of the model does not depend on the backend, so only the inter-cycle Transformer is timed,
+on random cycle embeddings with random numbers of seen cycles. Each run is made in a fresh process so that the
+peak memory of one run does not hide the one of the next. On CPU, the peak memory is the growth of the peak RSS.
+
+Usage:
+    python benchmark_attention.py --device cpu --batch_sizes 16 64 256 512
+    python benchmark_attention.py --device cuda --train
+'''
+import time
+import resource
+import argparse
+import multiprocessing
+from types import SimpleNamespace
+import torch
+
+BACKENDS = ['full', 'fused']
+
+
+def get_configs(args, backend):
+    return SimpleNamespace(d_ff=args.d_ff, d_model=args.d_model, charge_discharge_length=args.charge_discharge_length,
+                           early_cycle_threshold=args.early_cycle_threshold, dropout=args.dropout, e_layers=1,
+                           d_layers=args.d_layers, factor=3, n_heads=args.n_heads, activation='relu', output_num=1,
+                           attention_backend=backend)
+
+
+def run_one(args, backend, batch_size):
+    '''
+    :return: seconds per batch, peak memory in MB and the predictions of the first batch
+    '''
+    from models.CPTransformer import Model
+    device = torch.device(args.device)
+    torch.manual_seed(args.seed) # the same weights and inputs for both backends
+    model = Model(get_configs(args, backend)).to(device)
+    model.train(args.train)
+    L = args.early_cycle_threshold
+    embeddings = torch.randn(batch_size, L, args.d_model, device=device)
+    prefix_lengths = torch.randint(1, L + 1, (batch_size, 1), device=device)
+    curve_attn_mask = (torch.arange(L, device=device).unsqueeze(0) < prefix_lengths).float()
+
+    def step():
+        if args.train:
+            model.zero_grad(set_to_none=True)
+            preds, _ = model.inter_cycle_modelling(embeddings, curve_attn_mask)
+            preds.mean().backward()
+        else:
+            with torch.no_grad():
+                preds, _ = model.inter_cycle_modelling(embeddings, curve_attn_mask)
+        return preds
+
+    def synchronize():
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+        base_memory = torch.cuda.memory_allocated(device)
+    else:
+        base_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    preds = step().detach().cpu()
+    for _ in range(args.warmup):
+        step()
+    synchronize()
+    start = time.perf_counter()
+    for _ in range(args.repeats):
+        step()
+    synchronize()
+    seconds = (time.perf_counter() - start) / args.repeats
+    if device.type == 'cuda':
+        peak_memory = torch.cuda.max_memory_allocated(device) - base_memory
+    else:
+        peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 - base_memory
+    return seconds, peak_memory / 2**20, preds
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the attention backends of CPTransformer')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[16, 32, 64, 128, 256, 512])
+    parser.add_argument('--train', action='store_true', default=False, help='time a forward and backward pass instead of inference')
+    parser.add_argument('--d_model', type=int, default=128)
+    parser.add_argument('--d_ff', type=int, default=256)
+    parser.add_argument('--n_heads', type=int, default=4)
+    parser.add_argument('--d_layers', type=int, default=2)
+    parser.add_argument('--dropout', type=float, default=0.0)
+    parser.add_argument('--early_cycle_threshold', type=int, default=100)
+    parser.add_argument('--charge_discharge_length', type=int, default=300)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--repeats', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=2021)
+    args = parser.parse_args()
+
+    mode = 'train' if args.train else 'inference'
+    print(f'{mode} on {args.device}, d_model={args.d_model}, n_heads={args.n_heads}, d_layers={args.d_layers}, L={args.early_cycle_threshold}')
+    print(f'{"batch":>6} | {"full samples/s":>14} {"full MB":>9} | {"fused samples/s":>15} {"fused MB":>9} | {"speedup":>7} {"max diff":>9}')
+    context = multiprocessing.get_context('spawn')
+    for batch_size in args.batch_sizes:
+        results = {}
+        for backend in BACKENDS:
+            with context.Pool(1) as pool:
+                results[backend] = pool.apply(run_one, (args, backend, batch_size))
+        (full_seconds, full_memory, full_preds), (fused_seconds, fused_memory, fused_preds) = results['full'], results['fused']
+        max_diff = (full_preds - fused_preds).abs().max().item()
+        print(f'{batch_size:>6} | {batch_size / full_seconds:>14.1f} {full_memory:>9.1f} | {batch_size / fused_seconds:>15.1f} {fused_memory:>9.1f} | '
+              f'{full_seconds / fused_seconds:>6.2f}x {max_diff:>9.2e}')
+
+
+if __name__ == '__main__':
+    main()
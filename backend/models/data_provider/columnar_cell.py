@@ -0,0 +1,248 @@
+'''
+Columnar on-disk format for the cells of the BatteryData pickles (.bcell)
+
+Layout of a .bcell file:
+    8 bytes   magic b'BCELL\x00\x01\x00'
+    8 bytes   little-endian uint64 length of the header
+    header    utf-8 JSON, padded with spaces so that the data section starts at a multiple of 64 bytes
+    data      raw little-endian arrays, each starting at a multiple of 64 bytes
+
+The header holds the cell metadata (every field except cycle_data), the per-cycle scalar fields
+(e.g. cycle_number) and, for every per-cycle signal (e.g. voltage_in_V), the location of its values
+concatenated over all cycles and of its cycle offsets [num_cycles+1]. The samples of the i-th cycle
+are values[cycle_offsets[i]:cycle_offsets[i+1]].
+
+The file is opened with np.memmap, so reading some cycles of some signals only touches those pages,
+and the worker processes that read the same cell share the page cache.
+
+Convert the pickles of a dataset folder (the .bcell files are written next to them):
+    python -m data_provider.columnar_cell dataset/CALB
+'''
+import os
+import json
+import pickle
+import argparse
+import numpy as np
+
+MAGIC = b'BCELL\x00\x01\x00'
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+COLUMNAR_SUFFIX = '.bcell'
+
+
+def align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def columnar_path(pkl_path):
+    '''
+    The path of the columnar file that is converted from a pickle file
+    '''
+    return os.path.splitext(pkl_path)[0] + COLUMNAR_SUFFIX
+
+
+def write_columnar_cell(data, path, dtype=np.float64):
+    '''
+    Write the battery data dict (e.g. a loaded BatteryData pickle) in the columnar format
+    :param data: dict with cycle_data (list of cycle data dict) and the metadata of the cell
+    :param path: the output .bcell file
+    :param dtype: the dtype of the signals. float64 keeps the values of the pickles exactly
+    '''
+    cycle_data = data['cycle_data']
+    metadata = {key: value for key, value in data.items() if key != 'cycle_data'}
+
+    # Per-cycle lists become signals, the other per-cycle fields are kept in the header
+    signal_keys = []
+    cycle_field_keys = []
+    for cycle in cycle_data:
+        for key, value in cycle.items():
+            if isinstance(value, (list, tuple, np.ndarray)):
+                if key not in signal_keys:
+                    signal_keys.append(key)
+            elif key not in cycle_field_keys:
+                cycle_field_keys.append(key)
+    cycle_fields = {key: [to_json_value(cycle.get(key)) for cycle in cycle_data] for key in cycle_field_keys}
+
+    arrays = []
+    signals = {}
+    data_offset = 0
+    for key in signal_keys:
+        values = [np.asarray(cycle.get(key) if cycle.get(key) is not None else [], dtype=dtype) for cycle in cycle_data]
+        cycle_offsets = np.zeros(len(cycle_data)+1, dtype='<i8')
+        cycle_offsets[1:] = np.cumsum([len(cycle_values) for cycle_values in values])
+        values = np.concatenate(values).astype(np.dtype(dtype).newbyteorder('<')) if values else np.zeros(0, dtype=dtype)
+        signals[key] = {}
+        for name, array in [('values', values), ('cycle_offsets', cycle_offsets)]:
+            data_offset = align(data_offset)
+            signals[key][name] = {'dtype': array.dtype.str, 'offset': data_offset, 'length': len(array)}
+            arrays.append((data_offset, array))
+            data_offset += array.nbytes
+
+    header = {
+        'format_version': FORMAT_VERSION,
+        'num_cycles': len(cycle_data),
+        'metadata': to_json_value(metadata),
+        'cycle_fields': cycle_fields,
+        'signals': signals
+    }
+    header = json.dumps(header).encode('utf-8')
+    header += b' ' * (align(len(MAGIC) + 8 + len(header)) - len(MAGIC) - 8 - len(header))
+    data_start = len(MAGIC) + 8 + len(header)
+
+    # Write to a temporary file first so that readers never see a partially written cell
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.uint64(len(header)).astype('<u8').tobytes())
+        f.write(header)
+        for offset, array in arrays:
+            f.seek(data_start + offset)
+            f.write(array.tobytes())
+    os.replace(tmp_path, path)
+
+
+def to_json_value(value):
+    '''
+    Convert the numpy values in the metadata to python values
+    '''
+    if isinstance(value, dict):
+        return {key: to_json_value(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_json_value(item) for item in value]
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+class ColumnarCell:
+    '''
+    Read-only view of a .bcell file. The signals are sliced from the memory-mapped file
+    without reading the rest of the cell.
+    '''
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            magic = f.read(len(MAGIC))
+            if magic != MAGIC:
+                raise ValueError(f'{path} is not a columnar cell file')
+            header_length = int(np.frombuffer(f.read(8), dtype='<u8')[0])
+            header = json.loads(f.read(header_length).decode('utf-8'))
+        if header['format_version'] > FORMAT_VERSION:
+            raise ValueError(f'{path} has an unsupported format version {header["format_version"]}')
+        self.data_start = len(MAGIC) + 8 + header_length
+        self.num_cycles = header['num_cycles']
+        self.metadata = header['metadata']
+        self.cycle_fields = header['cycle_fields']
+        self.signals = header['signals']
+        self.mmap = np.memmap(path, dtype=np.uint8, mode='r') if os.path.getsize(path) > self.data_start else None
+
+    @property
+    def signal_names(self):
+        return list(self.signals.keys())
+
+    def array(self, location):
+        dtype = np.dtype(location['dtype'])
+        start = self.data_start + location['offset']
+        return self.mmap[start:start + location['length'] * dtype.itemsize].view(dtype) if location['length'] else np.zeros(0, dtype=dtype)
+
+    def cycle_offsets(self, key, start=0, stop=None):
+        '''
+        The offsets of cycles [start, stop) of a signal, relative to the first of these cycles
+        :return: [stop-start+1] offsets
+        '''
+        start, stop, _ = slice(start, stop).indices(self.num_cycles)
+        cycle_offsets = self.array(self.signals[key]['cycle_offsets'])[start:max(stop, start)+1]
+        return cycle_offsets - cycle_offsets[0]
+
+    def signal(self, key, start=0, stop=None):
+        '''
+        The samples of a signal in cycles [start, stop), concatenated. This is a view of the file.
+        '''
+        start, stop, _ = slice(start, stop).indices(self.num_cycles)
+        cycle_offsets = self.array(self.signals[key]['cycle_offsets'])
+        return self.array(self.signals[key]['values'])[cycle_offsets[start]:cycle_offsets[max(stop, start)]]
+
+    def records(self, keys, start=0, stop=None):
+        '''
+        The concatenated samples of several signals that have the same number of samples in every cycle
+        :return: dict of {key: [N]} arrays and the cycle offsets [stop-start+1], as in curve_extraction.concat_cycle_records
+        '''
+        cycle_offsets = self.cycle_offsets(keys[0], start, stop)
+        for key in keys[1:]:
+            if not np.array_equal(self.cycle_offsets(key, start, stop), cycle_offsets):
+                raise ValueError(f'{key} and {keys[0]} have different numbers of samples in {self.path}')
+        return {key: np.asarray(self.signal(key, start, stop), dtype=np.float64) for key in keys}, cycle_offsets
+
+    def cycle_data(self, start=0, stop=None, keys=None):
+        '''
+        The cycles [start, stop) as a list of cycle data dict, like the cycle_data of the pickles.
+        The signals are numpy views of the file.
+        :param keys: the signals to read. None reads all of them
+        '''
+        start, stop, _ = slice(start, stop).indices(self.num_cycles)
+        stop = max(stop, start)
+        keys = self.signal_names if keys is None else keys
+        cycle_fields = {key: values[start:stop] for key, values in self.cycle_fields.items()}
+        cycles = [{key: values[i] for key, values in cycle_fields.items()} for i in range(stop - start)]
+        for key in keys:
+            values = self.signal(key, start, stop)
+            cycle_offsets = self.cycle_offsets(key, start, stop)
+            for i, cycle in enumerate(cycles):
+                cycle[key] = values[cycle_offsets[i]:cycle_offsets[i+1]]
+        return cycles
+
+    def to_dict(self, start=0, stop=None, keys=None):
+        '''
+        The cell as a battery data dict (metadata and cycle_data), like the loaded pickles
+        '''
+        data = dict(self.metadata)
+        data['cycle_data'] = self.cycle_data(start, stop, keys)
+        return data
+
+
+def load_cell(path, start=0, stop=None, keys=None):
+    '''
+    Load a cell from a .bcell file or a BatteryData pickle as a battery data dict.
+    Only cycles [start, stop) and the signals in keys (None for all) are read from a .bcell file.
+    '''
+    if path.endswith(COLUMNAR_SUFFIX):
+        return ColumnarCell(path).to_dict(start, stop, keys)
+    with open(path, 'rb') as f:
+        data = pickle.load(f)
+    if start != 0 or stop is not None:
+        data['cycle_data'] = data['cycle_data'][start:stop]
+    return data
+
+
+def convert_pickles(root, dtype=np.float64, overwrite=False):
+    '''
+    Convert every .pkl file in root to a .bcell file next to it
+    :return: the number of converted files
+    '''
+    converted = 0
+    for file_name in sorted(os.listdir(root)):
+        if not file_name.endswith('.pkl'):
+            continue
+        pkl_path = os.path.join(root, file_name)
+        path = columnar_path(pkl_path)
+        if not overwrite and os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(pkl_path):
+            continue
+        with open(pkl_path, 'rb') as f:
+            data = pickle.load(f)
+        write_columnar_cell(data, path, dtype=dtype)
+        converted += 1
+        print(f'{pkl_path} -> {path}')
+    return converted
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert the BatteryData pickles of a folder to the columnar .bcell format')
+    parser.add_argument('root', type=str, help='the folder of the .pkl files, e.g. dataset/CALB')
+    parser.add_argument('--dtype', type=str, default='float64', choices=['float64', 'float32'],
+                        help='dtype of the signals. float32 halves the file size but rounds the values')
+    parser.add_argument('--overwrite', action='store_true', help='convert the files that are already up to date')
+    args = parser.parse_args()
+    converted = convert_pickles(args.root, dtype=np.dtype(args.dtype), overwrite=args.overwrite)
+    print(f'Converted {converted} files')
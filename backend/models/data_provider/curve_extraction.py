@@ -0,0 +1,189 @@
+import numpy as np
+
+# The records needed to build the charge and discharge curves
+NEED_KEYS = ['current_in_A', 'voltage_in_V', 'charge_capacity_in_Ah', 'discharge_capacity_in_Ah', 'time_in_s']
+
+
+def extract_cell_curves(file_name, cycle_data, nominal_capacity, early_cycle_threshold, charge_discharge_len, eol=None):
+    '''
+    Get the resampled charge and discharge curves of the early cycles of a cell
+    :param file_name: the file name. Its prefix decides whether the cycles start with charging or discharging
+    :param cycle_data: list of cycle data dict
+    :param nominal_capacity: the nominal capacity of the cell in Ah
+    :param early_cycle_threshold: the number of early cycles
+    :param charge_discharge_len: the resampled length of the concatenated charge and discharge curves
+    :param eol: the cycle life. The cycles after the eol are dropped. None keeps all the early cycles
+    :return: [early_cycle_threshold, 3, charge_discharge_len] curves. The missing cycles are filled with zeros
+    '''
+    cycle_num = get_early_cycle_num(len(cycle_data), early_cycle_threshold, eol)
+    records, cycle_offsets = concat_cycle_records(cycle_data[:cycle_num])
+    return extract_curves_from_records(file_name, records, cycle_offsets, nominal_capacity, early_cycle_threshold, charge_discharge_len)
+
+
+def get_early_cycle_num(num_cycles, early_cycle_threshold, eol=None):
+    '''
+    The number of cycles used to build the curves.
+    Only the early cycles are used. The cycles after the eol are dropped.
+    '''
+    cycle_num = min(num_cycles, early_cycle_threshold)
+    if eol is not None:
+        cycle_num = min(cycle_num, int(np.floor(eol)) + 1)
+    return cycle_num
+
+
+def extract_curves_from_records(file_name, records, cycle_offsets, nominal_capacity, early_cycle_threshold, charge_discharge_len):
+    '''
+    Same as extract_cell_curves, but from the records of the first get_early_cycle_num cycles
+    that are already concatenated (e.g. read from a columnar cell file)
+    :param records: dict of {key: [N]} arrays for every key in NEED_KEYS
+    :param cycle_offsets: the cycle offsets [num_cycles+1]
+    '''
+    records, cycle_indices = clean_negative_capacity(records, cycle_offsets)
+    return get_charge_discharge_curves(file_name, records, cycle_indices, early_cycle_threshold, nominal_capacity, charge_discharge_len)
+
+
+def concat_cycle_records(cycle_data, need_keys=NEED_KEYS):
+    '''
+    Concatenate the records of all cycles into one contiguous array per key
+    :param cycle_data: list of cycle data dict
+    :param need_keys: the records to keep
+    :return: dict of {key: [N]} arrays and the cycle offsets [num_cycles+1].
+             The records of the i-th cycle are records[key][cycle_offsets[i]:cycle_offsets[i+1]]
+    '''
+    cycle_lengths = [len(sub_cycle_data[need_keys[0]]) for sub_cycle_data in cycle_data]
+    cycle_offsets = np.zeros(len(cycle_data)+1, dtype=np.int64)
+    cycle_offsets[1:] = np.cumsum(cycle_lengths)
+    records = {}
+    for key in need_keys:
+        records[key] = np.concatenate([np.asarray(sub_cycle_data[key], dtype=np.float64) for sub_cycle_data in cycle_data]) if cycle_data else np.zeros(0)
+    return records, cycle_offsets
+
+
+def clean_negative_capacity(records, cycle_offsets):
+    '''
+    Deal with the outliers in capacity. A record with negative charge or discharge capacity is replaced by
+    the next valid record of the same cycle (backward filling). The records that have no valid record
+    after them in the same cycle are dropped.
+    :param records: dict of {key: [N]} arrays
+    :param cycle_offsets: the cycle offsets [num_cycles+1]
+    :return: the cleaned records and the cycle index (starting from 0) of each record
+    '''
+    cycle_indices = np.repeat(np.arange(len(cycle_offsets)-1), np.diff(cycle_offsets))
+    cycle_ends = cycle_offsets[1:][cycle_indices]
+    outliers = (records['charge_capacity_in_Ah'] < 0) | (records['discharge_capacity_in_Ah'] < 0)
+
+    def next_valid_index(valid):
+        # the index of the next valid record (itself included) or a value >= its cycle end if there is none
+        positions = np.where(valid, np.arange(len(valid)), len(valid))
+        return np.minimum.accumulate(positions[::-1])[::-1]
+
+    keep = next_valid_index(~outliers) < cycle_ends
+    cleaned_records = {}
+    for key, values in records.items():
+        valid = ~outliers & ~np.isnan(values)
+        fill_indices = next_valid_index(valid)
+        filled_values = np.full(len(values), np.nan)
+        fillable = fill_indices < cycle_ends
+        filled_values[fillable] = values[fill_indices[fillable]]
+        cleaned_records[key] = filled_values[keep]
+    return cleaned_records, cycle_indices[keep]
+
+
+def get_charge_discharge_curves(file_name, records, cycle_indices, early_cycle_threshold, nominal_capacity, charge_discharge_len):
+    '''
+    Get the resampled charge and discharge curves from the records of a cell
+    file_name: the file name
+    records: dict of {key: [N]} arrays of the cell
+    cycle_indices: the cycle index (starting from 0) of each record. The records are sorted by cycle.
+    early_cycle_threshold: obtain the charge and discharge curves from the required early cycles
+    nominal_capacity: the nominal capacity of the cell in Ah
+    charge_discharge_len: the resampled length of the concatenated charge and discharge curves
+    '''
+    prefix = file_name.split('_')[0]
+    if prefix == 'CALB':
+        prefix = file_name.split('_')[:2]
+        prefix = '_'.join(prefix)
+
+    # Only the required early cycles are used
+    in_early_cycles = cycle_indices < early_cycle_threshold
+    cycle_indices = cycle_indices[in_early_cycles]
+    voltage_records = records['voltage_in_V'][in_early_cycles]
+    current_records = records['current_in_A'][in_early_cycles]
+    charge_capacity_records = records['charge_capacity_in_Ah'][in_early_cycles]
+    discharge_capacity_records = records['discharge_capacity_in_Ah'][in_early_cycles]
+    current_records_in_C = current_records / nominal_capacity
+
+    # The cycles without any record are filled with zeros
+    cycles = np.unique(cycle_indices)
+    record_cycles = np.searchsorted(cycles, cycle_indices) # the position of the cycle of each record in cycles
+    record_positions = np.arange(len(cycle_indices)) - np.searchsorted(cycle_indices, cycle_indices, side='left') # the position of each record in its cycle
+
+    # The last charge and discharge records of each cycle
+    charge_end_indices = last_index_in_cycles(current_records_in_C>=0.01, record_cycles, record_positions, len(cycles))
+    discharge_end_indices = last_index_in_cycles(current_records_in_C<=-0.01, record_cycles, record_positions, len(cycles))
+    if np.any(charge_end_indices < 0) or np.any(discharge_end_indices < 0):
+        raise Exception(f'Failure in {file_name} | Some cycles have no charge or discharge records!')
+
+    # For CALB variants: some CALB file variants may have discharge-first cycles
+    if prefix in ['CALB_0', 'CALB_35', 'CALB_45']:
+        discharge_end_per_record = discharge_end_indices[record_cycles]
+        discharge_selected = record_positions < discharge_end_per_record
+        charge_selected = (record_positions >= discharge_end_per_record) & (np.abs(current_records_in_C)>0.01)
+    else:
+        charge_end_per_record = charge_end_indices[record_cycles]
+        discharge_selected = (record_positions >= charge_end_per_record) & (np.abs(current_records_in_C)>0.01)
+        charge_selected = record_positions < charge_end_per_record
+
+    charge_counts = np.bincount(record_cycles[charge_selected], minlength=len(cycles))
+    discharge_counts = np.bincount(record_cycles[discharge_selected], minlength=len(cycles))
+    if np.any(charge_counts == 0) or np.any(discharge_counts == 0):
+        raise Exception(f'Failure in {file_name} | Some cycles have empty charge or discharge curves!')
+
+    charge_curves = [resample_charge_discharge_curves(values[charge_selected], charge_counts, charge_discharge_len) for values in [voltage_records, current_records, charge_capacity_records]]
+    discharge_curves = [resample_charge_discharge_curves(values[discharge_selected], discharge_counts, charge_discharge_len) for values in [voltage_records, current_records, discharge_capacity_records]]
+    voltage_curves = np.concatenate([charge_curves[0], discharge_curves[0]], axis=1) # [num_cycles, charge_discharge_len]
+    current_curves = np.concatenate([charge_curves[1], discharge_curves[1]], axis=1)
+    capacity_in_battery = np.concatenate([charge_curves[2], discharge_curves[2]], axis=1)
+
+    voltage_curves = voltage_curves / np.max(voltage_curves, axis=1, keepdims=True) # normalize using the cutoff voltage
+    current_curves = current_curves / nominal_capacity # normalize the current to C rate
+    capacity_in_battery = capacity_in_battery / nominal_capacity # normalize the capacity
+
+    # fill zeros when the cell doesn't have enough cycles
+    curves = np.zeros((early_cycle_threshold, 3, charge_discharge_len))
+    curves[cycles] = np.stack([voltage_curves, current_curves, capacity_in_battery], axis=1)
+    return curves # [L, 3, fixed_len]
+
+
+def last_index_in_cycles(condition, record_cycles, record_positions, num_cycles):
+    '''
+    Find the position (relative to the cycle start) of the last record that satisfies the condition in each cycle
+    :return: [num_cycles] positions, -1 if no record satisfies the condition
+    '''
+    last_indices = np.full(num_cycles, -1, dtype=np.int64)
+    np.maximum.at(last_indices, record_cycles[condition], record_positions[condition])
+    return last_indices
+
+
+def resample_charge_discharge_curves(values, counts, charge_discharge_len):
+    '''
+    resample the charge and discharge curves of all cycles based on the natural records.
+    This is a batched equivalent of np.interp(np.linspace(1, n+1, charge_discharge_len//2), np.arange(1, n+1), records)
+    :param values: the concatenated charge or dicharge records (voltages, currents or capacities) of all cycles
+    :param counts: [num_cycles] the number of records in each cycle
+    :param charge_discharge_len: the resampled length of the concatenated charge and discharge curves
+    :return: interploted records [num_cycles, charge_discharge_len//2]
+    '''
+    half_len = charge_discharge_len // 2
+    offsets = np.zeros(len(counts), dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)[:-1]
+    interp_bases = np.linspace(1, counts+1, num=half_len, endpoint=True, axis=1) # [num_cycles, charge_discharge_len]
+    # the raw bases are 1, 2, ..., n, so the left neighbor of an interp base is floor(x)
+    left = np.minimum(np.floor(interp_bases), counts[:, None]).astype(np.int64)
+    right = np.minimum(left + 1, counts[:, None])
+    left_values = values[offsets[:, None] + left - 1]
+    right_values = values[offsets[:, None] + right - 1]
+    slopes = right_values - left_values
+    interp_values = slopes * (interp_bases - left) + left_values
+    # np.interp returns the last record beyond the last raw base
+    return np.where(interp_bases >= counts[:, None], values[offsets + counts - 1][:, None], interp_values)
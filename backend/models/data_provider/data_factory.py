@@ -1,11 +1,102 @@
 from data_provider.data_loader import Dataset_original
 from data_provider.data_loader import my_collate_fn_baseline, my_collate_fn_withId
-from torch.utils.data import DataLoader, RandomSampler, Dataset
+import torch
+from torch.utils.data import DataLoader, RandomSampler, SequentialSampler, WeightedRandomSampler, Sampler, Dataset
 
 data_dict = {
     'Dataset_original': Dataset_original
 }
 
+def get_train_sampler(data_set, flag, sample_weighted):
+    '''
+    Get the WeightedRandomSampler of the training set if sample_weighted, otherwise None (i.e., shuffle or keep the order)
+    '''
+    if not sample_weighted or flag != 'train':
+        return None
+    return WeightedRandomSampler(data_set.get_sampling_weights(), num_samples=len(data_set), replacement=True)
+
+class LengthBucketBatchSampler(Sampler):
+    '''
+    Group the samples of similar prefix lengths into the same batches for --bucket_by_length, so that the batches
+    truncated to their longest prefix (see Dataset_original.get_batch) are short.
+    The indices drawn by sampler are taken in pools of bucket_size batches. Each pool is sorted by prefix length
+    and cut into batches, and the batches of a pool are yielded in a random order if shuffle.
+    bucket_size=None sorts all the samples in one pool.
+    '''
+    def __init__(self, sampler, prefix_lengths, batch_size, drop_last, shuffle, bucket_size=50):
+        self.sampler = sampler
+        self.prefix_lengths = torch.as_tensor(prefix_lengths)
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+
+    def split_pool(self, pool):
+        pool = torch.as_tensor(pool, dtype=torch.long)
+        order = torch.argsort(self.prefix_lengths[pool], stable=True)
+        batches = list(pool[order].split(self.batch_size))
+        if self.drop_last and len(batches[-1]) < self.batch_size:
+            batches = batches[:-1]
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches)).tolist()]
+        return [batch.tolist() for batch in batches]
+
+    def __iter__(self):
+        pool_size = self.batch_size * self.bucket_size if self.bucket_size is not None else None
+        pool = []
+        for index in self.sampler:
+            pool.append(index)
+            if len(pool) == pool_size:
+                yield from self.split_pool(pool)
+                pool = []
+        if len(pool) > 0:
+            yield from self.split_pool(pool)
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.sampler) // self.batch_size
+        return (len(self.sampler) + self.batch_size - 1) // self.batch_size
+
+def get_data_loader(args, data_set, flag, batch_size, shuffle, drop_last, collate_fn, sampler=None):
+    '''
+    Get the DataLoader of data_set. With --bucket_by_length, the batches are built by a LengthBucketBatchSampler
+    over sampler (or over a random or sequential sampler if sampler is None).
+    '''
+    if not getattr(args, 'bucket_by_length', False):
+        return DataLoader(
+                data_set,
+                batch_size=batch_size,
+                shuffle=shuffle if sampler is None else False,
+                sampler=sampler,
+                num_workers=args.num_workers,
+                drop_last=drop_last,
+                collate_fn=collate_fn)
+    if sampler is None:
+        sampler = RandomSampler(data_set) if shuffle else SequentialSampler(data_set)
+    # The evaluation sets are sorted as a whole since their order does not matter
+    batch_sampler = LengthBucketBatchSampler(sampler, data_set.get_prefix_lengths(), batch_size, drop_last,
+                                             shuffle=shuffle, bucket_size=50 if flag == 'train' else None)
+    return DataLoader(data_set, batch_sampler=batch_sampler, num_workers=args.num_workers, collate_fn=collate_fn)
+
+def get_in_process_loader(data_loader):
+    '''
+    A loader over the same batches as data_loader that builds them in the calling thread (num_workers=0)
+    and draws its seed from its own generator. It is used by the background evaluation of --async_eval:
+    forking the worker processes from the evaluation thread while the training loader forks its own can deadlock,
+    and creating an iterator draws a seed from the global RNG, which the training uses concurrently.
+    '''
+    return DataLoader(data_loader.dataset, batch_sampler=data_loader.batch_sampler, num_workers=0,
+                      collate_fn=data_loader.collate_fn, generator=torch.Generator())
+
+def share_with_workers(data_set, num_workers):
+    '''
+    The batches are index-selects over the contiguous tensors of the dataset (see Dataset_original.get_batch).
+    Move these tensors to shared memory when the batches are built by worker processes.
+    '''
+    if num_workers > 0:
+        data_set.share_memory()
+    return data_set
+
 def data_provider_baseline_DA(args, flag, tokenizer=None, label_scaler=None, eval_cycle_min=None, eval_cycle_max=None, total_prompts=None, 
                  total_charge_discharge_curves=None, total_curve_attn_masks=None, total_labels=None, unique_labels=None,
                  class_labels=None, life_class_scaler=None, sample_weighted=False, target_dataset='None'):
@@ -49,13 +140,9 @@ def data_provider_baseline_DA(args, flag, tokenizer=None, label_scaler=None, eva
                 use_target_dataset=False
             )
 
-    data_loader = DataLoader(
-                data_set,
-                batch_size=batch_size,
-                shuffle=shuffle_flag,
-                num_workers=args.num_workers,
-                drop_last=drop_last,
-                collate_fn=my_collate_fn_baseline)
+    share_with_workers(data_set, args.num_workers)
+    sampler = get_train_sampler(data_set, flag, sample_weighted)
+    data_loader = get_data_loader(args, data_set, flag, batch_size, shuffle_flag, drop_last, my_collate_fn_baseline, sampler=sampler)
     
     if target_dataset != 'None' and flag=='train':
         target_data_set = Data(args=args,
@@ -71,6 +158,7 @@ def data_provider_baseline_DA(args, flag, tokenizer=None, label_scaler=None, eva
                 life_class_scaler=data_set.return_life_class_scaler(),
                 use_target_dataset=True
             )
+        share_with_workers(target_data_set, args.num_workers)
 
         target_data_loader = DataLoader(
                     target_data_set,
@@ -112,13 +200,9 @@ def data_provider_baseline(args, flag, tokenizer=None, label_scaler=None, eval_c
             life_class_scaler=life_class_scaler
         )
 
-    data_loader = DataLoader(
-                data_set,
-                batch_size=batch_size,
-                shuffle=shuffle_flag,
-                num_workers=args.num_workers,
-                drop_last=drop_last,
-                collate_fn=my_collate_fn_baseline)
+    share_with_workers(data_set, args.num_workers)
+    sampler = get_train_sampler(data_set, flag, sample_weighted)
+    data_loader = get_data_loader(args, data_set, flag, batch_size, shuffle_flag, drop_last, my_collate_fn_baseline, sampler=sampler)
         
     return data_set, data_loader
 
@@ -150,12 +234,6 @@ def data_provider_evaluate(args, flag, tokenizer=None, label_scaler=None, eval_c
             life_class_scaler=life_class_scaler
         )
 
-
-    data_loader = DataLoader(
-                data_set,
-                batch_size=batch_size,
-                shuffle=shuffle_flag,
-                num_workers=args.num_workers,
-                drop_last=drop_last,
-                collate_fn=my_collate_fn_withId)
+    share_with_workers(data_set, args.num_workers)
+    data_loader = get_data_loader(args, data_set, flag, batch_size, shuffle_flag, drop_last, my_collate_fn_withId)
     return data_set, data_loader
\ No newline at end of file
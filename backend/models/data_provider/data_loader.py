@@ -1,13 +1,15 @@
 import os
 import random
 import re
+import hashlib
+import multiprocessing
 import numpy as np
 import shutil
 import pandas as pd
 from torch.utils.data import Dataset
 from tqdm import tqdm
 import copy
-from sklearn.preprocessing import StandardScaler
+from sklearn.preprocessing import StandardScaler, MinMaxScaler
 from scipy.interpolate import interp1d
 from utils.timefeatures import time_features
 import warnings
@@ -19,10 +21,12 @@ import matplotlib.pyplot as plt
 import json
 from torch.nn.utils.rnn import pad_sequence
 from batteryml.data.battery_data import BatteryData
-from utils.augmentation import BatchAugmentation_battery_revised
 from data_provider.data_split_recorder import split_recorder
+from data_provider.curve_extraction import NEED_KEYS, extract_cell_curves, get_early_cycle_num, extract_curves_from_records
+from data_provider.columnar_cell import ColumnarCell, columnar_path, load_cell
+from data_provider.dataset_manifest import load_manifest, get_life_class, hash_file, get_life_label_file
 import accelerate
-from denseweight import DenseWeight
+from KDEpy import FFTKDE
 warnings.filterwarnings('ignore')
 
 # Keep only CALB-related dataset ids
@@ -32,34 +36,63 @@ datasetName2ids = {
     'CALB2024': 25,
 }
 
-def my_collate_fn_withId(samples):
+# Bump this when the preprocessing changes so that stale cache files are not reused
+PREPROCESS_CACHE_VERSION = 1
+
+def get_kde_weights(labels, alpha=1.0, eps=1e-6, grid_points=4096):
+    '''
+    DenseWeight (Steininger et al., 2021) weights of the samples, the same as fitting DenseWeight(alpha) on labels
+    and calling it on every label.
+    The samples share few unique labels (one eol per cell), so the KDE is fitted on the unique labels weighted by
+    their counts and evaluated once per unique label. The weights are then broadcast to the samples.
+    :param labels: [N] the label of each sample
+    :return: [N] weights whose mean is 1
+    '''
+    labels = np.asarray(labels, dtype=np.float64).reshape(-1)
+    unique_labels, inverse, counts = np.unique(labels, return_inverse=True, return_counts=True)
+    # Silverman's rule of thumb on the samples
+    bandwidth = 1.06 * np.std(labels) * np.power(len(labels), -1.0 / 5.0)
+    kernel = FFTKDE(bw=bandwidth).fit(unique_labels, weights=counts)
+    grid, density = kernel.evaluate(grid_points)
+    density = MinMaxScaler().fit_transform(density.reshape(-1, 1)).flatten()
+    # the grid point on the left of each label (DenseWeight's bisection)
+    grid_indices = np.clip(np.searchsorted(grid, unique_labels, side='right') - 1, 0, len(grid) - 2)
+    grid_indices[unique_labels >= grid[-1]] = len(grid) - 1
+    w_star = np.maximum(1 - alpha * density[grid_indices], eps)
+    unique_weights = w_star / (np.sum(w_star * counts) / len(labels))
+    return unique_weights[inverse]
+
+def stack_samples(samples):
+    '''
+    Stack the per-sample dicts of Dataset_original.__getitem__ into a batch dict like Dataset_original.get_batch
+    '''
     cycle_curve_data = torch.vstack([i['cycle_curve_data'].unsqueeze(0) for i in samples])
     curve_attn_mask = torch.vstack([i['curve_attn_mask'].unsqueeze(0) for i in samples])
-    # input_ids = pad_sequence([i['input_ids'] for i in samples], batch_first=True, padding_value=2)
-    # attention_mask = pad_sequence([i['attention_mask'] for i in samples], batch_first=True, padding_value=0)
-    life_class = torch.Tensor([i['life_class'] for i in samples])
-    labels = torch.Tensor([i['labels'] for i in samples])
-    scaled_life_class = torch.Tensor([i['scaled_life_class'] for i in samples])
-    weights = torch.Tensor([i['weight'] for i in samples])
-    dataset_ids = torch.Tensor([i['dataset_id'] for i in samples])
-    seen_unseen_ids = torch.Tensor([i['seen_unseen_id'] for i in samples])
-
     tmp_curve_attn_mask = curve_attn_mask.unsqueeze(-1).unsqueeze(-1) * torch.ones_like(cycle_curve_data)
     cycle_curve_data[tmp_curve_attn_mask==0] = 0 # set the unseen data as zeros
-    return cycle_curve_data, curve_attn_mask, labels, life_class, scaled_life_class, weights, dataset_ids, seen_unseen_ids
+    batch = {'cycle_curve_data': cycle_curve_data, 'curve_attn_mask': curve_attn_mask}
+    for key in ['labels', 'life_class', 'scaled_life_class', 'weight', 'dataset_id', 'seen_unseen_id']:
+        batch[key] = torch.stack([torch.as_tensor(i[key], dtype=torch.float32) for i in samples])
+    return batch
+
+def my_collate_fn_withId(samples):
+    # samples is already a batch when the dataset has __getitems__ (see Dataset_original.get_batch)
+    batch = samples if isinstance(samples, dict) else stack_samples(samples)
+    return batch['cycle_curve_data'], batch['curve_attn_mask'], batch['labels'], batch['life_class'], batch['scaled_life_class'], batch['weight'], batch['dataset_id'], batch['seen_unseen_id']
 
 def my_collate_fn_baseline(samples):
-    cycle_curve_data = torch.vstack([i['cycle_curve_data'].unsqueeze(0) for i in samples])
-    curve_attn_mask = torch.vstack([i['curve_attn_mask'].unsqueeze(0) for i in samples])
-    life_class = torch.Tensor([i['life_class'] for i in samples])
-    labels = torch.Tensor([i['labels'] for i in samples])
-    scaled_life_class = torch.Tensor([i['scaled_life_class'] for i in samples])
-    weights = torch.Tensor([i['weight'] for i in samples])
-    seen_unseen_ids = torch.Tensor([i['seen_unseen_id'] for i in samples])
+    batch = samples if isinstance(samples, dict) else stack_samples(samples)
+    return batch['cycle_curve_data'], batch['curve_attn_mask'], batch['labels'], batch['life_class'], batch['scaled_life_class'], batch['weight'], batch['seen_unseen_id']
 
-    tmp_curve_attn_mask = curve_attn_mask.unsqueeze(-1).unsqueeze(-1) * torch.ones_like(cycle_curve_data)
-    cycle_curve_data[tmp_curve_attn_mask==0] = 0 # set the unseen data as zeros
-    return cycle_curve_data, curve_attn_mask,  labels, life_class, scaled_life_class, weights, seen_unseen_ids
+# The dataset read by the processes of Dataset_original.read_cells, set once per process by init_cell_reader
+cell_reader_dataset = None
+
+def init_cell_reader(dataset):
+    global cell_reader_dataset
+    cell_reader_dataset = dataset
+
+def read_cell_samples(file_name):
+    return cell_reader_dataset.read_samples_from_one_cell(file_name)
 
 class Dataset_original(Dataset):
     def __init__(self, args, flag='train', label_scaler=None, tokenizer=None, eval_cycle_max=None, eval_cycle_min=None, total_prompts=None, 
@@ -81,10 +114,19 @@ class Dataset_original(Dataset):
         self.flag = flag
         self.dataset = args.dataset if not use_target_dataset else args.target_dataset
         self.early_cycle_threshold = args.early_cycle_threshold
+        # Truncate each batch to the longest prefix it contains (see get_batch)
+        self.bucket_by_length = getattr(args, 'bucket_by_length', False)
         self.KDE_samples = []
+        self.kde_weights = None
+        # The resampled curves are cached on disk. Set cache_path to 'None' to disable the cache.
+        cache_path = getattr(args, 'cache_path', None)
+        if cache_path is None:
+            cache_path = f'{self.root_path}/preprocessed_cache'
+        self.cache_path = None if cache_path == 'None' else cache_path
+        # The cells are read by a process pool. 0 uses all the CPU cores, 1 reads the cells in the main process.
+        load_workers = getattr(args, 'load_workers', 0)
+        self.load_workers = os.cpu_count() if load_workers == 0 else load_workers
 
-        self.need_keys = ['current_in_A', 'voltage_in_V', 'charge_capacity_in_Ah', 'discharge_capacity_in_Ah', 'time_in_s']
-        self.aug_helper = BatchAugmentation_battery_revised()
         assert flag in ['train', 'test', 'val']
 
         # Only support CALB, CALB42, CALB2024
@@ -116,8 +158,15 @@ class Dataset_original(Dataset):
                 self.unseen_seen_record = json.load(open(f'{self.root_path}/seen_unseen_labels/cal_for_test_CALB2024.json'))
             else:
                 self.unseen_seen_record = json.load(open(f'{self.root_path}/seen_unseen_labels/cal_for_test.json'))
+
+        # The manifest holds the eol, life class and content hash of every cell,
+        # so the cells that cannot produce any sample are dropped without being read
+        self.manifest = load_manifest(self.root_path)
+        self.files = [file_name for file_name in self.files if self.may_have_samples(file_name)]
         
-        self.total_charge_discharge_curves, self.total_curve_attn_masks, self.total_labels, self.unique_labels, self.class_labels, self.total_dataset_ids, self.total_cj_aug_charge_discharge_curves, self.total_seen_unseen_IDs = self.read_data()
+        # total_charge_discharge_curves holds one [early_cycle_threshold, 3, charge_discharge_len] array per cell.
+        # Each sample only records (cell index, prefix length); the attention mask is built in __getitem__.
+        self.total_charge_discharge_curves, self.total_cell_indices, self.total_prefix_lengths, self.total_labels, self.unique_labels, self.class_labels, self.total_dataset_ids, self.total_seen_unseen_IDs = self.read_data()
         
         self.KDE_samples = copy.deepcopy(self.total_labels) if flag == 'train' else []
 
@@ -146,6 +195,74 @@ class Dataset_original(Dataset):
             self.scaled_life_classes = np.array(self.class_labels) - 1
             #self.scaled_life_classes = self.life_class_scaler.transform(np.array(self.class_labels).reshape(-1,1))
 
+        self.build_batch_tensors()
+
+    def build_batch_tensors(self):
+        '''
+        Hold the cell curves and the per-sample fields in preallocated contiguous tensors, so that a batch is
+        an index-select over them (see get_batch) instead of a list of per-sample dicts.
+        total_charge_discharge_curves becomes a [num_cells, early_cycle_threshold, 3, charge_discharge_len] tensor.
+        '''
+        if len(self.total_charge_discharge_curves) > 0:
+            self.total_charge_discharge_curves = torch.from_numpy(np.stack(self.total_charge_discharge_curves).astype(np.float32))
+        else:
+            self.total_charge_discharge_curves = torch.zeros((0, self.early_cycle_threshold, 3, self.charge_discharge_len))
+        self.sample_tensors = {
+            'cell_index': torch.from_numpy(self.total_cell_indices),
+            'prefix_length': torch.from_numpy(self.total_prefix_lengths),
+            'labels': torch.Tensor(np.asarray(self.total_labels, dtype=np.float32).reshape(len(self.total_cell_indices), -1)),
+            'life_class': torch.Tensor(np.asarray(self.class_labels, dtype=np.float32)),
+            'scaled_life_class': torch.Tensor(np.asarray(self.scaled_life_classes, dtype=np.float32).reshape(-1)),
+            'weight': torch.Tensor(np.asarray(self.weights, dtype=np.float32)),
+            'dataset_id': torch.Tensor(np.asarray(self.total_dataset_ids, dtype=np.float32)),
+            'seen_unseen_id': torch.Tensor(np.asarray(self.total_seen_unseen_IDs, dtype=np.float32))
+        }
+        self.cycle_positions = torch.arange(self.early_cycle_threshold)
+
+    def share_memory(self):
+        '''
+        Move the batch tensors to shared memory, so that the data loader workers do not copy them
+        '''
+        self.total_charge_discharge_curves.share_memory_()
+        for tensor in self.sample_tensors.values():
+            tensor.share_memory_()
+        self.pickle_for_workers = True
+        return self
+
+    def __getstate__(self):
+        # The workers of the data loader only need the batch tensors. The per-sample Python lists stay in the main process.
+        # The process pool of read_cells pickles the dataset before share_memory, and needs the manifest.
+        state = self.__dict__.copy()
+        if getattr(self, 'pickle_for_workers', False):
+            for key in ['class_labels', 'total_dataset_ids', 'total_seen_unseen_IDs', 'KDE_samples', 'raw_labels', 'manifest']:
+                state[key] = None
+        return state
+
+    def get_batch(self, indices):
+        '''
+        Build the batch of the samples at indices
+        :return: dict of batched tensors. The cycles that a sample does not see are set to zeros in cycle_curve_data.
+                 With bucket_by_length, cycle_curve_data and curve_attn_mask only hold the first max(prefix_length) cycles,
+                 and the models pad the cycles that no sample of the batch sees.
+        '''
+        indices = torch.as_tensor(indices, dtype=torch.long)
+        batch = {key: tensor.index_select(0, indices) for key, tensor in self.sample_tensors.items()}
+        prefix_lengths = batch.pop('prefix_length')
+        curves, cycle_positions = self.total_charge_discharge_curves, self.cycle_positions
+        if self.bucket_by_length and len(prefix_lengths) > 0:
+            max_length = int(prefix_lengths.max())
+            curves, cycle_positions = curves[:, :max_length], cycle_positions[:max_length]
+        cycle_curve_data = curves.index_select(0, batch.pop('cell_index'))
+        curve_attn_mask = (cycle_positions.unsqueeze(0) < prefix_lengths.unsqueeze(1)).float()
+        cycle_curve_data.mul_(curve_attn_mask.unsqueeze(-1).unsqueeze(-1)) # set the unseen data as zeros
+        batch['cycle_curve_data'] = cycle_curve_data
+        batch['curve_attn_mask'] = curve_attn_mask
+        return batch
+
+    def __getitems__(self, indices):
+        # Called by the DataLoader with the indices of a whole batch
+        return self.get_batch(indices)
+
     def get_loss_weight(self, method='KDE'):
         '''
         Get the weight for weighted loss
@@ -175,22 +292,35 @@ class Dataset_original(Dataset):
                 normalized_x = np.log(x / np.min(x)+1)
                 weights = 1 / normalized_x
             elif method == 'KDE':
-                # Define DenseWeight
-                dw = DenseWeight(alpha=1.0)
-                # Fit DenseWeight and get the weights for the 1000 samples
-                dw.fit(self.KDE_samples)
-                # Calculate the weight for an arbitrary target value
-                weights = []
-                for label in self.KDE_samples:
-                    single_sample_weight = dw(label)[0]
-                    weights.append(single_sample_weight)
+                weights = self.get_kde_weights()
             else:
                 raise Exception('Not implemented')
             return weights
         else:
-            return np.ones(len(self.total_charge_discharge_curves))
+            return np.ones(len(self.total_labels))
+
 
+    def get_kde_weights(self):
+        '''
+        Get the KDE (DenseWeight) weights of the training samples. They are computed once and cached with the dataset.
+        '''
+        if self.kde_weights is None:
+            self.kde_weights = get_kde_weights(self.KDE_samples)
+        return self.kde_weights
+
+    def get_sampling_weights(self):
+        '''
+        Get the weights of the training samples for the WeightedRandomSampler used by --weighted_sampling.
+        The samples of rare cycle lives are drawn more often.
+        '''
+        return torch.as_tensor(self.get_kde_weights(), dtype=torch.double)
     
+    def get_prefix_lengths(self):
+        '''
+        Get the number of seen cycles of each sample, used to bucket the samples by length
+        '''
+        return self.sample_tensors['prefix_length']
+
     def get_center_vector_index(self, file_name):
         prefix = file_name.split('_')[0]
         if prefix in ['MATR', 'HUST'] or 'LFP' in file_name:
@@ -205,43 +335,41 @@ class Dataset_original(Dataset):
         return self.life_class_scaler
     
     def __len__(self):
-        return len(self.total_labels)
+        return len(self.total_cell_indices)
         
     def read_data(self):
         '''
         read all data from files
-        :return: x_enc, x_cycle_numbers, prompts, charge_data, discharge_data, RPT_masks, labels
+        :return: per-cell curves, the cell index and prefix length of each sample, labels, unique_labels, class_labels,
+                 dataset_ids and seen_unseen_IDs
         '''
     
-        total_charge_discharge_curves = []
-        total_curve_attn_masks = []
+        total_charge_discharge_curves = [] # one entry per cell
+        total_cell_indices = [] # the index of the cell in total_charge_discharge_curves for each sample
+        total_prefix_lengths = [] # the number of seen cycles for each sample
         total_labels = [] # RUL
         unique_labels = []
         class_labels = [] # the pseudo class for samples
         total_dataset_ids = []
-        total_cj_aug_charge_discharge_curves = []
         total_seen_unseen_IDs = []
 
-        for file_name in tqdm(self.files):
+        for file_name, cell_samples in zip(self.files, tqdm(self.read_cells(), total=len(self.files))):
             # Only CALB-related datasets are supported here
             dataset_id = datasetName2ids[file_name.split('_')[0]]
 
-            charge_discharge_curves, attn_masks, labels, eol, cj_aug_charge_discharge_curves = self.read_samples_from_one_cell(
-                file_name)
+            charge_discharge_curves, prefix_lengths, labels, eol = cell_samples
             if eol is None:
                 # This battery has not reached end of life
                 continue
             
-            for class_label, life_range in self.life_classes.items():
-                if eol >= life_range[0] and eol < life_range[1]:
-                    class_label = int(class_label)
-                    class_labels += [class_label for _ in range(len(charge_discharge_curves))]
-                    break
+            class_label = self.manifest[file_name]['life_class'] if file_name in self.manifest else get_life_class(eol, self.life_classes)
+            class_labels += [class_label for _ in range(len(labels))]
             
 
-            total_charge_discharge_curves += charge_discharge_curves
-            total_cj_aug_charge_discharge_curves += cj_aug_charge_discharge_curves
-            total_curve_attn_masks += attn_masks
+            cell_index = len(total_charge_discharge_curves)
+            total_charge_discharge_curves.append(charge_discharge_curves)
+            total_cell_indices += [cell_index for _ in range(len(labels))]
+            total_prefix_lengths += prefix_lengths
             total_labels += labels 
             total_dataset_ids += [dataset_id for _ in range(len(labels))]
             # total_center_vector_indices += [center_vector_index for _ in range(len(labels))]
@@ -257,90 +385,157 @@ class Dataset_original(Dataset):
             else:
                 total_seen_unseen_IDs += [1 for _ in range(len(labels))] # 1 indicates seen. This is not used on training or evaluation set
 
-        return total_charge_discharge_curves, total_curve_attn_masks, np.array(total_labels), unique_labels, class_labels, total_dataset_ids, total_cj_aug_charge_discharge_curves, total_seen_unseen_IDs
+        return total_charge_discharge_curves, np.array(total_cell_indices, dtype=np.int64), np.array(total_prefix_lengths, dtype=np.int64), np.array(total_labels), unique_labels, class_labels, total_dataset_ids, total_seen_unseen_IDs
 
-    
-    def read_cell_data_according_to_prefix(self, file_name):
+    def read_cells(self):
         '''
-        Read the battery data and eol according to the file_name
+        read the samples of all cells in the order of self.files
+        The cells are independent, so they are read by a process pool when load_workers > 1.
+        :return: an iterator over the outputs of read_samples_from_one_cell
+        '''
+        load_workers = min(self.load_workers, len(self.files))
+        if load_workers <= 1:
+            for file_name in self.files:
+                yield self.read_samples_from_one_cell(file_name)
+            return
+
+        # The dataset (with the manifest) is sent to each process once by the initializer, so a task is only a file name
+        with multiprocessing.Pool(load_workers, initializer=init_cell_reader, initargs=(self,)) as pool:
+            # imap keeps the order of self.files while the results are streamed back
+            yield from pool.imap(read_cell_samples, self.files)
+
+    def get_cell_path(self, file_name):
+        '''
+        Get the file of a cell. The columnar .bcell file converted from the pickle is used if it exists
         The dataset is indicated by the prefix of the file_name
         '''
         # Keep only CALB variants and fail for others
         prefix = file_name.split('_')[0]
-        if prefix.startswith('CALB'):
-            data =  pickle.load(open(f'{self.root_path}/CALB/{file_name}', 'rb'))
-        else:
+        if not prefix.startswith('CALB'):
             raise Exception('Unsupported dataset prefix. Only CALB variants are supported by this loader.')
+        pkl_path = f'{self.root_path}/CALB/{file_name}'
+        cell_path = columnar_path(pkl_path)
+        return cell_path if os.path.exists(cell_path) else pkl_path
+
+    def read_cell_data_according_to_prefix(self, file_name):
+        '''
+        Read the battery data and eol according to the file_name
+        The dataset is indicated by the prefix of the file_name
+        '''
+        data = load_cell(self.get_cell_path(file_name))
+        eol = self.read_life_label(file_name)
+        return data, eol
 
+    def may_have_samples(self, file_name):
+        '''
+        Whether a cell can produce samples according to the manifest, i.e., it has reached the end of life
+        after the early cycles. The cells that are not in the manifest are kept and checked when they are read.
+        '''
+        if file_name not in self.manifest:
+            return True
+        eol = self.manifest[file_name]['eol']
+        return eol is not None and eol > self.early_cycle_threshold
+
+    def read_life_label(self, file_name):
+        '''
+        Read the eol of a cell from the manifest or the life label file of its dataset
+        :return: eol or None if the cell has not reached the end of life
+        '''
+        if file_name in self.manifest:
+            return self.manifest[file_name]['eol']
+        prefix = file_name.split('_')[0]
         # Life label files: assume prefix-based life label files exist for CALB variants
-        with open(f'{self.root_path}/Life labels/{prefix}_labels.json') as f:
+        with open(get_life_label_file(self.root_path, prefix)) as f:
             life_labels = json.load(f)
         if file_name in life_labels:
             eol = life_labels[file_name]
         else:
             eol = None
-        return data, eol
-    
+        return eol
+
+    def get_cache_file(self, file_name, eol):
+        '''
+        Get the cache file of the resampled curves of one cell.
+        The cache key consists of the file content hash (from the manifest) and every parameter that affects the preprocessing.
+        :return: the path of the cache file or None if the cache is disabled
+        '''
+        if self.cache_path is None:
+            return None
+        content_hash = self.manifest[file_name]['hash'] if file_name in self.manifest else hash_file(self.get_cell_path(file_name))
+        hasher = hashlib.sha1(content_hash.encode())
+        hasher.update(f'{PREPROCESS_CACHE_VERSION}_{self.charge_discharge_len}_{self.early_cycle_threshold}_{eol}'.encode())
+        cell_name = file_name.split('.pkl')[0]
+        return f'{self.cache_path}/{cell_name}_{hasher.hexdigest()[:16]}.npz'
+
+    def save_cache(self, cache_file, charge_discharge_curves, eol, nominal_capacity):
+        '''
+        Save the resampled curves of one cell. The file is written to a temporary path first so that
+        concurrent readers never see a partially written cache file.
+        '''
+        os.makedirs(self.cache_path, exist_ok=True)
+        tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'wb') as f:
+            np.savez(f, charge_discharge_curves=charge_discharge_curves, eol=eol, nominal_capacity=nominal_capacity)
+        os.replace(tmp_file, cache_file)
+
     def read_cell_df(self, file_name):
         '''
-        read the dataframe of one cell, and drop its formation cycles.
+        read the records of one cell, and drop its formation cycles.
         In addition, we will resample its charge and discharge curves
+        The resampled curves are loaded from the cache if they have been computed with the same parameters.
         :param file_name: which file needs to be read
-        :return: df, charge_discharge_curves, basic_prompt, eol
+        :return: charge_discharge_curves, eol, nominal_capacity
         '''
-        data, eol = self.read_cell_data_according_to_prefix(file_name)
+        eol = self.read_life_label(file_name)
         if eol is None:
             # This battery has not reached the end of life
-            return None, None, None, None, None
-        cell_name = file_name.split('.pkl')[0]
-        
-        # Use nominal_capacity in data for CALB variants; remove RWTH/SNL special cases
-        nominal_capacity = data['nominal_capacity_in_Ah']
-            
-        cycle_data = data['cycle_data'] # list of cycle data dict
-            
-        total_cycle_dfs = []
-        for correct_cycle_index, sub_cycle_data in enumerate(cycle_data):
-            cycle_df = pd.DataFrame()
-            for key in self.need_keys:
-                cycle_df[key] = sub_cycle_data[key]
-            cycle_df['cycle_number'] = correct_cycle_index + 1
-            cycle_df.loc[cycle_df['charge_capacity_in_Ah']<0] = np.nan # deal with outliers in capacity
-            cycle_df.loc[cycle_df['discharge_capacity_in_Ah']<0] = np.nan
-            cycle_df.bfill(inplace=True) # deal with NaN
-            total_cycle_dfs.append(cycle_df)
-            
-            correct_cycle_number = correct_cycle_index + 1
-            if correct_cycle_number > self.early_cycle_threshold or correct_cycle_number > eol:
-                break
+            return None, None, None
+
+        cache_file = self.get_cache_file(file_name, eol)
+        if cache_file is not None and os.path.exists(cache_file):
+            with np.load(cache_file) as cache:
+                charge_discharge_curves = cache['charge_discharge_curves']
+                nominal_capacity = cache['nominal_capacity'].item()
+        elif self.get_cell_path(file_name).endswith('.bcell'):
+            # Only the early cycles of the needed signals are read from the columnar file
+            cell = ColumnarCell(self.get_cell_path(file_name))
+            nominal_capacity = cell.metadata['nominal_capacity_in_Ah']
+            cycle_num = get_early_cycle_num(cell.num_cycles, self.early_cycle_threshold, eol)
+            records, cycle_offsets = cell.records(NEED_KEYS, 0, cycle_num)
+            charge_discharge_curves = extract_curves_from_records(file_name, records, cycle_offsets, nominal_capacity, self.early_cycle_threshold, self.charge_discharge_len)
+            if cache_file is not None:
+                self.save_cache(cache_file, charge_discharge_curves, eol, nominal_capacity)
+        else:
+            data, eol = self.read_cell_data_according_to_prefix(file_name)
             
-        df = pd.concat(total_cycle_dfs)
-        # obtain the charge and discahrge curves
-        charge_discharge_curves = self.get_charge_discharge_curves(file_name, df, self.early_cycle_threshold, nominal_capacity)
-        cj_aug_charge_discharge_curves, fm_aug_charge_discharge_curves  = self.aug_helper.batch_aug(charge_discharge_curves)
+            # Use nominal_capacity in data for CALB variants; remove RWTH/SNL special cases
+            nominal_capacity = data['nominal_capacity_in_Ah']
+                
+            cycle_data = data['cycle_data'] # list of cycle data dict
+            # obtain the charge and discahrge curves
+            charge_discharge_curves = extract_cell_curves(file_name, cycle_data, nominal_capacity, self.early_cycle_threshold, self.charge_discharge_len, eol=eol)
+            if cache_file is not None:
+                self.save_cache(cache_file, charge_discharge_curves, eol, nominal_capacity)
+
+        return charge_discharge_curves, eol, nominal_capacity
 
-        return df, charge_discharge_curves, eol, nominal_capacity, cj_aug_charge_discharge_curves
-    
-        
     def read_samples_from_one_cell(self, file_name):
         '''
         read all samples using this function
+        The early-life curves of the cell are returned only once. Each sample is described by its prefix length,
+        i.e., the number of cycles the model is allowed to see.
         :param file_name: which file needs to be read
-        :return: history_sohs, future_sohs, masks, cycles, prompts, charge_data, discharge_data and RPT_masks in each sample
+        :return: early charge_discharge_curves, prefix_lengths, labels and eol
         '''
 
-        df, charge_discharge_curves_data, eol, nominal_capacity, cj_aug_charge_discharge_curves = self.read_cell_df(file_name)
-        if df is None or eol<=self.early_cycle_threshold:
-            return None, None, None, None, None
+        charge_discharge_curves_data, eol, nominal_capacity = self.read_cell_df(file_name)
+        if eol is None or eol<=self.early_cycle_threshold:
+            return None, None, None, None
 
-        # the charge and discharge data
-        charge_discharge_curves = []  # [N, seq_len, fix_charge_resample_len]
-        total_cj_aug_charge_discharge_curves = []
-        attn_masks = []
+        prefix_lengths = []
         labels = []
         # get the early-life data
         early_charge_discharge_curves_data = charge_discharge_curves_data[:self.early_cycle_threshold]
-        early_cj_aug_charge_discharge_curves = cj_aug_charge_discharge_curves[:self.early_cycle_threshold]
         if np.any(np.isnan(early_charge_discharge_curves_data)):
             raise Exception(f'Failure in {file_name} | Early data contains NaN! Cycle life is {eol}!')
         for i in range(self.seq_len, self.early_cycle_threshold+1):
@@ -349,9 +544,6 @@ class Dataset_original(Dataset):
                 # We should not include the eol cycle data
                 break
             
-            tmp_attn_mask = np.zeros(self.early_cycle_threshold)
-            tmp_attn_mask[:i] = 1 # set 1 not to mask
-            
             if self.eval_cycle_max is not None and self.eval_cycle_min is not None:
                 if i <= self.eval_cycle_max and i >= self.eval_cycle_min:
                     # Only keep the val and test samples that satisfy the eval_cycle
@@ -362,143 +554,34 @@ class Dataset_original(Dataset):
 
             # tmp_prompt = basic_prompt
             labels.append(eol)
-            charge_discharge_curves.append(early_charge_discharge_curves_data)
-            total_cj_aug_charge_discharge_curves.append(early_cj_aug_charge_discharge_curves)
-            attn_masks.append(tmp_attn_mask)
+            prefix_lengths.append(i)
 
-        return charge_discharge_curves, attn_masks, labels, eol, total_cj_aug_charge_discharge_curves
+        return early_charge_discharge_curves_data, prefix_lengths, labels, eol
 
-    def get_charge_discharge_curves(self, file_name, df, early_cycle_threshold, nominal_capacity):
+    def get_curve_attn_mask(self, prefix_length):
         '''
-        Get the resampled charge and discharge curves from the dataframe
-        file_name: the file name
-        df: the dataframe for a cell
-        early_cycle_threshold: obtain the charge and discharge curves from the required early cycles
+        Build the attention mask of a sample that sees the first prefix_length cycles
         '''
-        curves = []
-        unique_cycles = df['cycle_number'].unique()
-        prefix = file_name.split('_')[0]
-        if prefix == 'CALB':
-            prefix = file_name.split('_')[:2]
-            prefix = '_'.join(prefix)
-
-        for cycle in range(1, early_cycle_threshold+1):
-            if cycle in df['cycle_number'].unique():
-                cycle_df = df.loc[df['cycle_number'] == cycle]
-                
-                voltage_records = cycle_df['voltage_in_V'].values
-                current_records = cycle_df['current_in_A'].values
-                current_records_in_C = current_records/nominal_capacity
-                charge_capacity_records = cycle_df['charge_capacity_in_Ah'].values
-                discharge_capacity_records = cycle_df['discharge_capacity_in_Ah'].values
-                time_in_s_records = cycle_df['time_in_s'].values
-
-                cutoff_voltage_indices = np.nonzero(current_records_in_C>=0.01)
-                charge_end_index = cutoff_voltage_indices[0][-1]
-
-                cutoff_voltage_indices = np.nonzero(current_records_in_C<=-0.01) 
-                discharge_end_index = cutoff_voltage_indices[0][-1]
-                
-                # For CALB variants: some CALB file variants may have discharge-first cycles
-                if prefix in ['CALB_0', 'CALB_35', 'CALB_45']:
-                    discharge_voltages = voltage_records[:discharge_end_index]
-                    discharge_capacities = discharge_capacity_records[:discharge_end_index]
-                    discharge_currents = current_records[:discharge_end_index]
-                    discharge_times = time_in_s_records[:discharge_end_index]
-                    
-                    charge_voltages = voltage_records[discharge_end_index:]
-                    charge_capacities = charge_capacity_records[discharge_end_index:]
-                    charge_currents = current_records[discharge_end_index:]
-                    charge_times = time_in_s_records[discharge_end_index:]
-                    charge_current_in_C = charge_currents / nominal_capacity
-                    
-                    charge_voltages = charge_voltages[np.abs(charge_current_in_C)>0.01]
-                    charge_capacities = charge_capacities[np.abs(charge_current_in_C)>0.01]
-                    charge_currents = charge_currents[np.abs(charge_current_in_C)>0.01]
-                    charge_times = charge_times[np.abs(charge_current_in_C)>0.01]
-                else:
-                    discharge_voltages = voltage_records[charge_end_index:]
-                    discharge_capacities = discharge_capacity_records[charge_end_index:]
-                    discharge_currents = current_records[charge_end_index:]
-                    discharge_times = time_in_s_records[charge_end_index:]
-                    discharge_current_in_C = discharge_currents / nominal_capacity
-                    
-                    discharge_voltages = discharge_voltages[np.abs(discharge_current_in_C)>0.01]
-                    discharge_capacities = discharge_capacities[np.abs(discharge_current_in_C)>0.01]
-                    discharge_currents = discharge_currents[np.abs(discharge_current_in_C)>0.01]
-                    discharge_times = discharge_times[np.abs(discharge_current_in_C)>0.01]
-                    
-                    charge_voltages = voltage_records[:charge_end_index]
-                    charge_capacities = charge_capacity_records[:charge_end_index]
-                    charge_currents = current_records[:charge_end_index]
-                    charge_times = time_in_s_records[:charge_end_index]
-
-                discharge_voltages, discharge_currents, discharge_capacities = self.resample_charge_discharge_curves(discharge_voltages, discharge_currents, discharge_capacities)
-                charge_voltages, charge_currents, charge_capacities = self.resample_charge_discharge_curves(charge_voltages, charge_currents, charge_capacities)
-
-
-                
-                voltage_records = np.concatenate([charge_voltages, discharge_voltages], axis=0)
-                current_records = np.concatenate([charge_currents, discharge_currents], axis=0)
-                capacity_in_battery = np.concatenate([charge_capacities, discharge_capacities], axis=0)
-                
-                voltage_records = voltage_records.reshape(1, self.charge_discharge_len) / max(voltage_records) # normalize using the cutoff voltage
-                current_records = current_records.reshape(1, self.charge_discharge_len) / nominal_capacity # normalize the current to C rate
-                capacity_in_battery = capacity_in_battery.reshape(1, self.charge_discharge_len) / nominal_capacity # normalize the capacity
-                
-                curve_data = np.concatenate([voltage_records, current_records, capacity_in_battery], axis=0)
-                # curve_data = np.concatenate([voltage_records, current_records], axis=0)
-            else:
-                # fill zeros when the cell doesn't have enough cycles
-                curve_data = np.zeros((3, self.charge_discharge_len))
-
-            curves.append(curve_data.reshape(1, curve_data.shape[0], self.charge_discharge_len))
-              
-        curves = np.concatenate(curves, axis=0) # [L, 3, fixed_len]
-        return curves
-
-    def resample_charge_discharge_curves(self, voltages, currents, capacity_in_battery):
-        '''
-        resample the charge and discharge curves based on the natural records
-        :param voltages:charge or dicharge voltages
-        :param currents: charge or discharge current
-        :param capacity_in_battery: remaining capacities in the battery
-        :return:interploted records
-        '''
-        charge_discharge_len = self.charge_discharge_len // 2
-        raw_bases = np.arange(1, len(voltages)+1)
-        interp_bases = np.linspace(1, len(voltages)+1, num=charge_discharge_len,
-                                        endpoint=True)
-        interp_voltages = np.interp(interp_bases, raw_bases, voltages)
-        interp_currents = np.interp(interp_bases, raw_bases, currents)
-        interp_capacity_in_battery = np.interp(interp_bases, raw_bases, capacity_in_battery)
-        return interp_voltages, interp_currents, interp_capacity_in_battery
-    
+        curve_attn_mask = np.zeros(self.early_cycle_threshold)
+        curve_attn_mask[:prefix_length] = 1 # set 1 not to mask
+        return curve_attn_mask
 
     def __getitem__(self, index):
+        cell_index = self.total_cell_indices[index]
+        prefix_length = self.total_prefix_lengths[index]
         sample = {
-                'cycle_curve_data': torch.Tensor(self.total_charge_discharge_curves[index]),
-                'curve_attn_mask': torch.Tensor(self.total_curve_attn_masks[index]),
-                'labels': self.total_labels[index],
-                'life_class': self.class_labels[index],
-                'scaled_life_class': self.scaled_life_classes[index],
-                'weight': self.weights[index],
-                'dataset_id': self.total_dataset_ids[index],
-                'cj_cycle_curve_data': self.total_cj_aug_charge_discharge_curves[index],
-                'seen_unseen_id': self.total_seen_unseen_IDs[index]
+                'cycle_curve_data': self.total_charge_discharge_curves[cell_index],
+                'curve_attn_mask': torch.Tensor(self.get_curve_attn_mask(prefix_length))
             }
+        for key in ['labels', 'life_class', 'scaled_life_class', 'weight', 'dataset_id', 'seen_unseen_id']:
+            sample[key] = self.sample_tensors[key][index]
         return sample
     
     def read_train_labels(self, train_files):
         train_labels = []
         for file_name in train_files:
-            prefix = file_name.split('_')[0]
-            # Only CALB-related label loading
-            with open(f'{self.root_path}/Life labels/{prefix}_labels.json') as f:
-                life_labels = json.load(f)
-            if file_name in life_labels:
-                eol = life_labels[file_name]
-            else:
+            eol = self.read_life_label(file_name)
+            if eol is None:
                 continue
             train_labels.append(eol)
         return train_labels
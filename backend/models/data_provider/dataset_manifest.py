@@ -0,0 +1,199 @@
+'''
+Manifest of the cells of a dataset root, so that the loader can filter the cells and assign their
+labels without reading them.
+
+The manifest is stored in {root_path}/manifest.json with one row per cell:
+    file, prefix, eol, nominal_capacity, cycle_count, life_class, seen_unseen, hash, stamp
+seen_unseen maps each record of {root_path}/seen_unseen_labels (e.g. cal_for_test) to the tag of the cell.
+hash is the sha1 of the cell file and stamp is its [size, mtime_ns]. A cell is only read again when its
+stamp changes. The label fields are refreshed from the label files every time the manifest is loaded.
+
+Build or refresh the manifest of a dataset root:
+    python -m data_provider.dataset_manifest dataset
+'''
+import os
+import json
+import pickle
+import hashlib
+import argparse
+import numpy as np
+from data_provider.columnar_cell import ColumnarCell, COLUMNAR_SUFFIX
+
+MANIFEST_VERSION = 1
+# The folders of the cells under the dataset root
+CELL_FOLDERS = ['CALB']
+LIFE_CLASSES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'life_classes.json')
+# The folders of the life label files under the dataset root, see get_life_label_file
+LIFE_LABEL_FOLDERS = ['Life labels', 'Life Labels']
+
+
+def get_manifest_path(root_path):
+    return f'{root_path}/manifest.json'
+
+
+def get_file_stamp(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def hash_file(path):
+    hasher = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def get_life_class(eol, life_classes):
+    '''
+    The life class of a cell whose cycle life is eol, None if eol is None
+    '''
+    if eol is None:
+        return None
+    for class_label, life_range in life_classes.items():
+        if eol >= life_range[0] and eol < life_range[1]:
+            return int(class_label)
+    return None
+
+
+def get_life_label_file(root_path, prefix):
+    '''
+    The life label file of a dataset prefix. The folder is 'Life labels' in the released datasets and
+    'Life Labels' in this repository, so both are looked up.
+    :return: the path of the existing file, or the one under 'Life labels' if there is none
+    '''
+    for folder in LIFE_LABEL_FOLDERS:
+        label_file = f'{root_path}/{folder}/{prefix}_labels.json'
+        if os.path.exists(label_file):
+            return label_file
+    return f'{root_path}/{LIFE_LABEL_FOLDERS[0]}/{prefix}_labels.json'
+
+
+def list_cell_files(root_path):
+    '''
+    :return: {file_name: path} of the cells under the dataset root. file_name is the .pkl name used by
+             the split records. The pickle is preferred over the .bcell file converted from it.
+    '''
+    cell_files = {}
+    for folder in CELL_FOLDERS:
+        folder_path = f'{root_path}/{folder}'
+        if not os.path.isdir(folder_path):
+            continue
+        for name in sorted(os.listdir(folder_path)):
+            if name.endswith('.pkl'):
+                cell_files[name] = f'{folder_path}/{name}'
+            elif name.endswith(COLUMNAR_SUFFIX):
+                file_name = name[:-len(COLUMNAR_SUFFIX)] + '.pkl'
+                if not os.path.exists(f'{folder_path}/{file_name}'):
+                    cell_files[file_name] = f'{folder_path}/{name}'
+    return cell_files
+
+
+def read_cell_fields(path):
+    '''
+    Read the fields of the manifest that need the cell file
+    '''
+    if path.endswith(COLUMNAR_SUFFIX):
+        cell = ColumnarCell(path)
+        nominal_capacity, cycle_count = cell.metadata.get('nominal_capacity_in_Ah'), cell.num_cycles
+    else:
+        with open(path, 'rb') as f:
+            data = pickle.load(f)
+        nominal_capacity, cycle_count = data.get('nominal_capacity_in_Ah'), len(data['cycle_data'])
+    return {
+        'nominal_capacity': float(nominal_capacity) if nominal_capacity is not None else None,
+        'cycle_count': int(cycle_count),
+        'hash': hash_file(path),
+        'stamp': get_file_stamp(path)
+    }
+
+
+def read_label_files(root_path, prefixes):
+    '''
+    :return: {prefix: {file_name: eol}} from the life label files and {record_name: {file_name: tag}}
+             from the seen/unseen records
+    '''
+    life_labels = {}
+    for prefix in prefixes:
+        label_file = get_life_label_file(root_path, prefix)
+        if os.path.exists(label_file):
+            with open(label_file) as f:
+                life_labels[prefix] = json.load(f)
+    seen_unseen_records = {}
+    record_folder = f'{root_path}/seen_unseen_labels'
+    if os.path.isdir(record_folder):
+        for name in sorted(os.listdir(record_folder)):
+            if name.endswith('.json'):
+                with open(f'{record_folder}/{name}') as f:
+                    seen_unseen_records[name[:-len('.json')]] = json.load(f)
+    return life_labels, seen_unseen_records
+
+
+def load_manifest(root_path, save=True):
+    '''
+    Load the manifest of a dataset root. The rows of new or changed cells are (re)built and the
+    label fields of all rows are refreshed. The updated manifest is saved if save is True.
+    :return: {file_name: row}
+    '''
+    manifest_path = get_manifest_path(root_path)
+    cells = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest.get('version') == MANIFEST_VERSION:
+            cells = manifest['cells']
+
+    with open(LIFE_CLASSES_FILE) as f:
+        life_classes = json.load(f)
+    cell_files = list_cell_files(root_path)
+    prefixes = sorted(set(file_name.split('_')[0] for file_name in cell_files))
+    life_labels, seen_unseen_records = read_label_files(root_path, prefixes)
+
+    changed = set(cells) != set(cell_files)
+    rows = {}
+    for file_name, path in cell_files.items():
+        row = cells.get(file_name)
+        if row is None or row['path'] != os.path.relpath(path, root_path) or row['stamp'] != get_file_stamp(path):
+            row = {'file': file_name, 'path': os.path.relpath(path, root_path)}
+            row.update(read_cell_fields(path))
+            changed = True
+
+        prefix = file_name.split('_')[0]
+        eol = life_labels.get(prefix, {}).get(file_name)
+        label_fields = {
+            'prefix': prefix,
+            'eol': eol,
+            'life_class': get_life_class(eol, life_classes),
+            'seen_unseen': {name: record[file_name] for name, record in seen_unseen_records.items() if file_name in record}
+        }
+        if any(row.get(key) != value for key, value in label_fields.items()):
+            row.update(label_fields)
+            changed = True
+        rows[file_name] = row
+
+    if save and changed:
+        save_manifest(manifest_path, rows)
+    return rows
+
+
+def save_manifest(manifest_path, rows):
+    '''
+    Write to a temporary file first so that concurrent readers never see a partially written manifest
+    '''
+    tmp_path = f'{manifest_path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': MANIFEST_VERSION, 'cells': rows}, f, indent=1)
+        os.replace(tmp_path, manifest_path)
+    except OSError as e:
+        print(f'Failed to save the manifest {manifest_path}: {e}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build or refresh the manifest of a dataset root')
+    parser.add_argument('root_path', type=str, help='the dataset root, e.g. dataset')
+    args = parser.parse_args()
+    rows = load_manifest(args.root_path)
+    eols = [row['eol'] for row in rows.values() if row['eol'] is not None]
+    print(f'{get_manifest_path(args.root_path)}: {len(rows)} cells, {len(eols)} with a cycle life'
+          + (f' (median {np.median(eols):.0f})' if eols else ''))
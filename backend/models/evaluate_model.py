@@ -5,9 +5,7 @@ from accelerate import DistributedDataParallelKwargs
 from torch import nn, optim
 from torch.optim import lr_scheduler
 from tqdm import tqdm
-import evaluate
 from transformers import AutoTokenizer
-from sklearn.metrics import root_mean_squared_error, mean_absolute_percentage_error, mean_absolute_error
 from models import CPGRU, CPLSTM, CPMLP, CPBiGRU, CPBiLSTM, CPTransformer, PatchTST, iTransformer, Transformer, \
     DLinear, Autoformer, MLP, MICN, CNN, \
     BiLSTM, BiGRU, GRU, LSTM
@@ -22,7 +20,8 @@ import json
 import datetime
 from data_provider.data_factory import data_provider_baseline
 import joblib
-from utils.tools import del_files, EarlyStopping, adjust_learning_rate, load_content
+from utils.tools import del_files, EarlyStopping, adjust_learning_rate, load_content, predict_prefixes_baseline
+from utils.metrics import mean_absolute_percentage_error, alpha_accuracy
 
 parser = argparse.ArgumentParser(description='Time-LLM')
 def calculate_metrics_based_on_seen_number_of_cycles(total_preds, total_references, total_seen_number_of_cycles, alpha1, alpha2, model, dataset, seed, finetune_dataset, start=1, end=100):
@@ -34,13 +33,9 @@ def calculate_metrics_based_on_seen_number_of_cycles(total_preds, total_referenc
         references = total_references[total_seen_number_of_cycles==number]
 
         mape = mean_absolute_percentage_error(references, preds)
-        relative_error = abs(preds - references) / references
-        hit_num = sum(relative_error<=alpha)
-        alpha_acc = hit_num / len(references) * 100
+        alpha_acc = alpha_accuracy(references, preds, alpha1)
 
-        relative_error = abs(preds - references) / references
-        hit_num = sum(relative_error<=alpha2)
-        alpha_acc2 = hit_num / len(references) * 100
+        alpha_acc2 = alpha_accuracy(references, preds, alpha2)
 
         number_MAPE[number] = float(mape)
         number_alphaAcc1[number] = float(alpha_acc)
@@ -79,6 +74,7 @@ parser.add_argument('--seed', type=int, default=2021, help='random seed')
 parser.add_argument('--dataset', type=str, default='CALB', help='dataset used for pretrained model')
 parser.add_argument('--data', type=str, required=False, default='Dataset_original', help='dataset type')
 parser.add_argument('--root_path', type=str, default='./dataset/CALB_dataset/', help='root path of the data file')
+parser.add_argument('--cache_path', type=str, default=None, help='folder of the preprocessed curve cache; defaults to {root_path}/preprocessed_cache, set to None to disable it')
 parser.add_argument('--data_path', type=str, default='ETTh1.csv', help='data file')
 parser.add_argument('--features', type=str, default='M',
                     help='forecasting task, options:[M, S, MS]; '
@@ -106,6 +102,7 @@ parser.add_argument('--c_out', type=int, default=1, help='output size')
 parser.add_argument('--d_model', type=int, default=16, help='dimension of model')
 parser.add_argument('--n_heads', type=int, default=4, help='num of heads')
 parser.add_argument('--lstm_layers', type=int, default=1, help='num of LSTM layers')
+parser.add_argument('--attention_backend', type=str, default=None, choices=['full', 'fused'], help='the attention of CPTransformer: full (einsum and softmax) or fused (scaled_dot_product_attention); defaults to the one of the checkpoint')
 parser.add_argument('--e_layers', type=int, default=2, help='num of encoder layers')
 parser.add_argument('--d_layers', type=int, default=1, help='num of decoder layers')
 parser.add_argument('--d_ff', type=int, default=32, help='dimension of fcn')
@@ -123,6 +120,9 @@ parser.add_argument('--output_num', type=int, default=1, help='The number of pre
 
 # optimization
 parser.add_argument('--num_workers', type=int, default=1, help='data loader num workers')
+parser.add_argument('--batched_prefix_inference', action='store_true', default=False, help='predict all the prefix lengths of a cell in one pass')
+parser.add_argument('--bucket_by_length', action='store_true', default=False, help='batch the samples of similar numbers of seen cycles together and truncate each batch to its longest prefix')
+parser.add_argument('--load_workers', type=int, default=0, help='processes used to read the cells when building the datasets; 0 uses all CPU cores, 1 reads them in the main process')
 parser.add_argument('--itr', type=int, default=1, help='experiments times')
 parser.add_argument('--train_epochs', type=int, default=10, help='train epochs')
 parser.add_argument('--least_epochs', type=int, default=5, help='The model is trained at least some epoches before the early stopping is used')
@@ -188,6 +188,12 @@ args_json = json.load(open(f'{args_path}args.json'))
 args_json['dataset'] = args.eval_dataset
 args_json['batch_size'] = args.batch_size
 args_json['model'] = args.model
+args_json['cache_path'] = args.cache_path
+args_json['load_workers'] = args.load_workers
+args_json['batched_prefix_inference'] = args.batched_prefix_inference
+args_json['bucket_by_length'] = args.bucket_by_length
+if args.attention_backend is not None:
+    args_json['attention_backend'] = args.attention_backend
 args.__dict__ = args_json
 finetune_dataset = args.finetune_dataset if 'finetune_dataset' in args_json else 'None'
 trained_dataset = args.dataset
@@ -273,28 +279,32 @@ for ii in range(args.itr):
     total_seen_unseen_ids = []
     total_seen_number_of_cycles = []
     model.eval() # set the model to evaluation mode
-    with torch.no_grad():
-        for i, (cycle_curve_data, curve_attn_mask, labels, life_class, scaled_life_class, weights, dataset_ids, seen_unseen_ids) in tqdm(enumerate(test_loader)):
-            
-            cycle_curve_data = cycle_curve_data.float().to(accelerator.device)# [B, S, N]
-            curve_attn_mask = curve_attn_mask.float().to(accelerator.device)
-            labels = labels.float().to(accelerator.device)
-            seen_number_of_cycles = torch.sum(curve_attn_mask, dim=1) # [B]
-
-            # encoder - decoder
-            outputs = model(cycle_curve_data, curve_attn_mask)
-
-            # self.accelerator.wait_for_everyone()
-            transformed_preds = outputs * std + mean_value
-            transformed_labels = labels * std + mean_value
-            all_predictions, all_targets, dataset_ids, seen_unseen_ids, seen_number_of_cycles = accelerator.gather_for_metrics((transformed_preds, transformed_labels, dataset_ids, seen_unseen_ids, seen_number_of_cycles))
-            
-            total_preds = total_preds + all_predictions.detach().cpu().numpy().reshape(-1).tolist()
-            total_references = total_references + all_targets.detach().cpu().numpy().reshape(-1).tolist()
-            total_dataset_ids = total_dataset_ids + dataset_ids.detach().cpu().numpy().reshape(-1).tolist()
-            total_seen_unseen_ids = total_seen_unseen_ids + seen_unseen_ids.detach().cpu().numpy().reshape(-1).tolist()
-            total_seen_number_of_cycles = total_seen_number_of_cycles + seen_number_of_cycles.detach().cpu().numpy().reshape(-1).tolist()
-    
+    if args.batched_prefix_inference:
+        # predict all the prefix lengths of a cell in one pass
+        total_preds, total_references, total_dataset_ids, total_seen_unseen_ids, total_seen_number_of_cycles = predict_prefixes_baseline(accelerator, model, test_data)
+    else:
+        with torch.no_grad():
+            for i, (cycle_curve_data, curve_attn_mask, labels, life_class, scaled_life_class, weights, dataset_ids, seen_unseen_ids) in tqdm(enumerate(test_loader)):
+                
+                cycle_curve_data = cycle_curve_data.float().to(accelerator.device)# [B, S, N]
+                curve_attn_mask = curve_attn_mask.float().to(accelerator.device)
+                labels = labels.float().to(accelerator.device)
+                seen_number_of_cycles = torch.sum(curve_attn_mask, dim=1) # [B]
+
+                # encoder - decoder
+                outputs = model(cycle_curve_data, curve_attn_mask)
+
+                # self.accelerator.wait_for_everyone()
+                transformed_preds = outputs * std + mean_value
+                transformed_labels = labels * std + mean_value
+                all_predictions, all_targets, dataset_ids, seen_unseen_ids, seen_number_of_cycles = accelerator.gather_for_metrics((transformed_preds, transformed_labels, dataset_ids, seen_unseen_ids, seen_number_of_cycles))
+                
+                total_preds = total_preds + all_predictions.detach().cpu().numpy().reshape(-1).tolist()
+                total_references = total_references + all_targets.detach().cpu().numpy().reshape(-1).tolist()
+                total_dataset_ids = total_dataset_ids + dataset_ids.detach().cpu().numpy().reshape(-1).tolist()
+                total_seen_unseen_ids = total_seen_unseen_ids + seen_unseen_ids.detach().cpu().numpy().reshape(-1).tolist()
+                total_seen_number_of_cycles = total_seen_number_of_cycles + seen_number_of_cycles.detach().cpu().numpy().reshape(-1).tolist()
+        
 
     res_path='./results'
     # accelerator.wait_for_everyone()
@@ -306,13 +316,9 @@ for ii in range(args.itr):
         total_seen_number_of_cycles = np.array(total_seen_number_of_cycles)
         total_preds = np.array(total_preds)
 
-        relative_error = abs(total_preds - total_references) / total_references
-        hit_num = sum(relative_error<=alpha)
-        alpha_acc = hit_num / len(total_references) * 100
+        alpha_acc = alpha_accuracy(total_references, total_preds, alpha)
 
-        relative_error = abs(total_preds - total_references) / total_references
-        hit_num = sum(relative_error<=alpha2)
-        alpha_acc2 = hit_num / len(total_references) * 100
+        alpha_acc2 = alpha_accuracy(total_references, total_preds, alpha2)
 
 
         mape = mean_absolute_percentage_error(total_references, total_preds)
@@ -329,31 +335,23 @@ for ii in range(args.itr):
             seen_alpha_acc = 'NA'
         else:
             seen_mape = mean_absolute_percentage_error(seen_references, seen_preds)
-            relative_error = abs(seen_preds - seen_references) / seen_references
-            hit_num = sum(relative_error<=alpha)
-            seen_alpha_acc = hit_num / len(seen_references) * 100
+            seen_alpha_acc = alpha_accuracy(seen_references, seen_preds, alpha)
 
         if len(unseen_references) == 0:
             accelerator.print(f'Eval cycle: {eval_cycle_min}-{eval_cycle_max} | Seen MAPE: {seen_mape} | Seen {alpha}-accuracy: {seen_alpha_acc}%')
         else:
             unseen_mape = mean_absolute_percentage_error(unseen_references, unseen_preds)
-            relative_error = abs(unseen_preds - unseen_references) / unseen_references
-            hit_num = sum(relative_error<=alpha)
-            unseen_alpha_acc = hit_num / len(unseen_references) * 100
+            unseen_alpha_acc = alpha_accuracy(unseen_references, unseen_preds, alpha)
             accelerator.print(f'Eval cycle: {eval_cycle_min}-{eval_cycle_max} | Seen MAPE: {seen_mape} | Unseen MAPE: {unseen_mape} | Seen {alpha}-accuracy: {seen_alpha_acc}% | Unseen {alpha}-accuracy: {unseen_alpha_acc}%')
 
-        relative_error = abs(seen_preds - seen_references) / seen_references
-        hit_num = sum(relative_error<=alpha2)
-        seen_alpha_acc2 = hit_num / len(seen_references) * 100
+        seen_alpha_acc2 = alpha_accuracy(seen_references, seen_preds, alpha2)
 
         if len(unseen_references)==0:
             # accelerator.print(f'Eval cycle: {eval_cycle_min}-{eval_cycle_max} | Seen MAPE: {seen_mape} | Seen {alpha}-accuracy: {seen_alpha_acc}%')
             accelerator.print(f'Eval cycle: {eval_cycle_min}-{eval_cycle_max} | Seen {alpha2}-accuracy: {seen_alpha_acc2}%')
             accelerator.print('No unseen aging conditions')
         else:
-            relative_error = abs(unseen_preds - unseen_references) / unseen_references
-            hit_num = sum(relative_error<=alpha2)
-            unseen_alpha_acc2 = hit_num / len(unseen_references) * 100
+            unseen_alpha_acc2 = alpha_accuracy(unseen_references, unseen_preds, alpha2)
             # accelerator.print(f'Eval cycle: {eval_cycle_min}-{eval_cycle_max} | Seen MAPE: {seen_mape} | Unseen MAPE: {unseen_mape} | Seen {alpha}-accuracy: {seen_alpha_acc}% | Unseen {alpha}-accuracy: {unseen_alpha_acc}%')
             accelerator.print(f'Eval cycle: {eval_cycle_min}-{eval_cycle_max} | Seen {alpha2}-accuracy: {seen_alpha_acc2}% | Unseen {alpha2}-accuracy: {unseen_alpha_acc2}%')
 
@@ -0,0 +1,111 @@
+'''
+Export a trained CP model (CPTransformer, CPMLP, CPLSTM, CPBiGRU or CPBiLSTM) to a self-contained TorchScript or
+ONNX graph for the slim runtime in RUL/exported_predictor.py.
+The graph takes the resampled curves [B, early_cycle, 3, charge_discharge_length] and the mask [B, early_cycle] and
+returns the scaled predictions [B, output_num]. runtime.json next to it holds the shapes of the inputs and the mean
+and var of the label scaler, so the runtime does not need the model code, the scalers or the training dependencies.
+The exported graph is checked against the model on a batch of another size before the script returns.
+
+Usage:
+    python export_model.py --args_path checkpoints/CALB_CPTransformer/<setting> --format torchscript
+    python export_model.py --args_path checkpoints/CALB_CPLSTM/<setting> --format onnx
+'''
+import os
+import json
+import inspect
+import argparse
+import numpy as np
+import torch
+import joblib
+from quantize_model import load_checkpoint_args, load_variant
+from RUL.rul_predictor import MODEL_CLASSES
+from RUL.exported_predictor import RUNTIME_CONFIG_NAME, GRAPH_NAMES, ExportedRULPredictor
+
+
+def get_example_inputs(model_args, batch_size, generator):
+    '''
+    :return: random curves and masks of batch_size cells with random numbers of seen cycles
+    '''
+    L = model_args.early_cycle_threshold
+    seen_cycles = torch.randint(1, L + 1, (batch_size, 1), generator=generator)
+    curve_attn_mask = (torch.arange(L).unsqueeze(0) < seen_cycles).float()
+    cycle_curve_data = torch.rand(batch_size, L, 3, model_args.charge_discharge_length, generator=generator)
+    cycle_curve_data = cycle_curve_data * curve_attn_mask[:, :, None, None] # set the unseen data as zeros
+    return cycle_curve_data, curve_attn_mask
+
+
+def export_torchscript(model, example_inputs, graph_file):
+    with torch.no_grad():
+        traced_model = torch.jit.trace(model, example_inputs, check_trace=False)
+    torch.jit.save(torch.jit.freeze(traced_model), graph_file)
+
+
+def export_onnx(model, example_inputs, graph_file, opset_version):
+    # The TorchScript-based exporter converts the packed sequences of the recurrent models.
+    # It is the default up to torch 2.8, later versions need dynamo=False
+    exporter_kwargs = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+    torch.onnx.export(model, example_inputs, graph_file, input_names=['cycle_curve_data', 'curve_attn_mask'],
+                      output_names=['preds'], opset_version=opset_version, **exporter_kwargs,
+                      dynamic_axes={'cycle_curve_data': {0: 'batch'}, 'curve_attn_mask': {0: 'batch'}, 'preds': {0: 'batch'}})
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export a trained CP model to TorchScript or ONNX for the slim runtime')
+    parser.add_argument('--args_path', type=str, required=True, help='the checkpoint folder with args.json, the weights and the scalers')
+    parser.add_argument('--format', type=str, default='torchscript', choices=list(GRAPH_NAMES))
+    parser.add_argument('--output_path', type=str, default=None, help='where the graph and runtime.json are written; defaults to <args_path>/export')
+    parser.add_argument('--quantized', action='store_true', default=False,
+                        help='export the int8 weights written by quantize_model.py (TorchScript only)')
+    parser.add_argument('--opset_version', type=int, default=17, help='the ONNX opset')
+    parser.add_argument('--seed', type=int, default=2021)
+    args = parser.parse_args()
+
+    model_args = load_checkpoint_args(args.args_path)
+    if model_args.model not in MODEL_CLASSES:
+        raise ValueError(f'Unsupported model type: {model_args.model}')
+    if args.quantized and args.format != 'torchscript':
+        raise ValueError('The int8 weights can only be exported to TorchScript')
+    if args.quantized and model_args.model not in ['CPTransformer', 'CPMLP']:
+        raise ValueError('The traced int8 LSTM and GRU layers only run with the batch size they were traced with, export the fp32 weights')
+    output_path = args.output_path or os.path.join(args.args_path, 'export')
+    os.makedirs(output_path, exist_ok=True)
+    graph_file = os.path.join(output_path, GRAPH_NAMES[args.format])
+
+    model = load_variant(args.args_path, 'int8' if args.quantized else 'fp32')
+    generator = torch.Generator().manual_seed(args.seed)
+    example_inputs = get_example_inputs(model_args, 2, generator)
+    if args.format == 'torchscript':
+        export_torchscript(model, example_inputs, graph_file)
+    else:
+        export_onnx(model, example_inputs, graph_file, args.opset_version)
+
+    label_scaler = joblib.load(os.path.join(args.args_path, 'label_scaler'))
+    runtime_config = {
+        'model': model_args.model,
+        'format': args.format,
+        'quantized': args.quantized,
+        'early_cycle_threshold': model_args.early_cycle_threshold,
+        'charge_discharge_length': model_args.charge_discharge_length,
+        'output_num': model_args.output_num,
+        'label_mean': float(label_scaler.mean_[-1]),
+        'label_var': float(label_scaler.var_[-1])
+    }
+    with open(os.path.join(output_path, RUNTIME_CONFIG_NAME), 'w') as f:
+        json.dump(runtime_config, f, indent=2)
+
+    # Check the exported graph on a batch of another size than the one it was exported with
+    cycle_curve_data, curve_attn_mask = get_example_inputs(model_args, 5, generator)
+    with torch.inference_mode():
+        expected = model(cycle_curve_data, curve_attn_mask).numpy()
+    try:
+        predictor = ExportedRULPredictor(output_path)
+    except ImportError as e:
+        print(f'Exported {graph_file}, not checked: {e}')
+        return
+    outputs = predictor.run(cycle_curve_data.numpy(), curve_attn_mask.numpy())
+    max_diff = float(np.max(np.abs(outputs - expected)))
+    print(f'Exported {graph_file}, max abs difference to the model: {max_diff:.2e}')
+
+
+if __name__ == '__main__':
+    main()
@@ -5,10 +5,8 @@ from accelerate import DistributedDataParallelKwargs
 from torch import nn, optim
 from torch.optim import lr_scheduler
 from tqdm import tqdm
-import evaluate
 from transformers import AutoTokenizer
 from transformers import AutoConfig, LlamaModel, LlamaTokenizer, LlamaForCausalLM
-from sklearn.metrics import root_mean_squared_error, mean_absolute_percentage_error, mean_absolute_error
 from models import CPLSTM, CPMLP, CPBiGRU, CPBiLSTM, CPTransformer
 import wandb
 from peft import LoraConfig, PeftModel, get_peft_model, prepare_model_for_kbit_training
@@ -19,9 +17,11 @@ import numpy as np
 import os
 import json
 import datetime
-from data_provider.data_factory import data_provider_baseline
+from data_provider.data_factory import data_provider_baseline, get_in_process_loader
 import joblib
-from utils.tools import del_files, EarlyStopping, adjust_learning_rate, load_content, vali_baseline
+from utils.augmentation import BatchAugmentation_battery_revised
+from utils.metrics import MetricAccumulator
+from utils.tools import del_files, EarlyStopping, adjust_learning_rate, evaluate_baseline, AsyncEvaluator, load_content, vali_baseline
 parser = argparse.ArgumentParser(description='Time-LLM')
 
 def set_seed(seed):
@@ -48,6 +48,7 @@ parser.add_argument('--seed', type=int, default=2021, help='random seed')
 parser.add_argument('--dataset', type=str, default='CALB', help='dataset used for pretrained model')
 parser.add_argument('--data', type=str, required=False, default='BatteryLifeLLM', help='dataset type')
 parser.add_argument('--root_path', type=str, default='./dataset/CALB_dataset/', help='root path of the data file')
+parser.add_argument('--cache_path', type=str, default=None, help='folder of the preprocessed curve cache; defaults to {root_path}/preprocessed_cache, set to None to disable it')
 parser.add_argument('--data_path', type=str, default='ETTh1.csv', help='data file')
 parser.add_argument('--features', type=str, default='M',
                     help='forecasting task, options:[M, S, MS]; '
@@ -75,6 +76,7 @@ parser.add_argument('--c_out', type=int, default=1, help='output size')
 parser.add_argument('--d_model', type=int, default=16, help='dimension of model')
 parser.add_argument('--n_heads', type=int, default=4, help='num of heads')
 parser.add_argument('--lstm_layers', type=int, default=1, help='num of LSTM layers')
+parser.add_argument('--attention_backend', type=str, default=None, choices=['full', 'fused'], help='the attention of CPTransformer: full (einsum and softmax) or fused (scaled_dot_product_attention); defaults to the one of the checkpoint')
 parser.add_argument('--e_layers', type=int, default=2, help='num of encoder layers')
 parser.add_argument('--d_layers', type=int, default=1, help='num of decoder layers')
 parser.add_argument('--d_ff', type=int, default=32, help='dimension of fcn')
@@ -92,12 +94,17 @@ parser.add_argument('--output_num', type=int, default=1, help='The number of pre
 
 # optimization
 parser.add_argument('--num_workers', type=int, default=1, help='data loader num workers')
+parser.add_argument('--data_augmentation', action='store_true', default=False, help='augment the training batches on the fly')
+parser.add_argument('--bucket_by_length', action='store_true', default=False, help='batch the samples of similar numbers of seen cycles together and truncate each batch to its longest prefix')
+parser.add_argument('--load_workers', type=int, default=0, help='processes used to read the cells when building the datasets; 0 uses all CPU cores, 1 reads them in the main process')
 parser.add_argument('--itr', type=int, default=1, help='experiments times')
 parser.add_argument('--train_epochs', type=int, default=10, help='train epochs')
 parser.add_argument('--least_epochs', type=int, default=5, help='The model is trained at least some epoches before the early stopping is used')
 parser.add_argument('--batch_size', type=int, default=32, help='batch size of train input data')
 parser.add_argument('--eval_batch_size', type=int, default=16, help='batch size of model evaluation')
 parser.add_argument('--patience', type=int, default=10, help='early stopping patience')
+parser.add_argument('--eval_interval', type=int, default=1, help='evaluate on the validation and testing sets every eval_interval epochs; the patience counts evaluations')
+parser.add_argument('--async_eval', action='store_true', default=False, help='evaluate snapshots of the weights in a background thread while the training continues (single process only). The background evaluation builds its batches in the training process, without --num_workers worker processes')
 parser.add_argument('--learning_rate', type=float, default=0.0001, help='optimizer learning rate')
 parser.add_argument('--des', type=str, default='test', help='exp description')
 parser.add_argument('--loss', type=str, default='MSE', help='loss function')
@@ -153,6 +160,14 @@ args_json['alpha1'] = args.alpha1
 args_json['alpha2'] = args.alpha2
 args_json['save_path'] = args.checkpoints
 args_json['model'] = args.model
+args_json['cache_path'] = args.cache_path
+args_json['load_workers'] = args.load_workers
+args_json['data_augmentation'] = args.data_augmentation
+args_json['bucket_by_length'] = args.bucket_by_length
+if args.attention_backend is not None:
+    args_json['attention_backend'] = args.attention_backend
+args_json['eval_interval'] = args.eval_interval
+args_json['async_eval'] = args.async_eval
 args.__dict__ = args_json
 for ii in range(args.itr):
     # setting record of experiments
@@ -226,6 +241,7 @@ for ii in range(args.itr):
     early_stopping = EarlyStopping(accelerator=accelerator, patience=args.patience)
 
     criterion = nn.MSELoss(reduction='none') 
+    aug_helper = BatchAugmentation_battery_revised() if args.data_augmentation else None
     accumulation_steps = args.accumulation_steps
     load_checkpoint_in_model(model, args_path) # load the saved parameters into model
     accelerator.print(f'The model is {args.model}')
@@ -272,6 +288,16 @@ for ii in range(args.itr):
                                             epochs=args.train_epochs,
                                             max_lr=args.learning_rate)
 
+    # The background evaluation uses the loaders that are not prepared (see AsyncEvaluator)
+    async_evaluator = None
+    if args.async_eval:
+        if accelerator.num_processes > 1:
+            accelerator.print('The asynchronous evaluation only supports a single process. The evaluation is synchronous.')
+        else:
+            # The background thread builds its batches without worker processes (see get_in_process_loader)
+            async_vali_loader, async_test_loader = get_in_process_loader(vali_loader), get_in_process_loader(test_loader)
+            async_evaluator = AsyncEvaluator(lambda snapshot: evaluate_baseline(args, accelerator, snapshot, vali_data, async_vali_loader, test_data, async_test_loader, criterion))
+
     train_loader, vali_loader, test_loader, model, model_optim, scheduler = accelerator.prepare(train_loader, vali_loader, test_loader, model, model_optim, scheduler)
     best_vali_loss = float('inf')
     best_vali_MAE, best_test_MAE = 0, 0
@@ -288,9 +314,8 @@ for ii in range(args.itr):
     best_seen_vali_MAPE, best_seen_test_MAPE = 0, 0
     best_unseen_vali_MAPE, best_unseen_test_MAPE = 0, 0
 
+    train_losses = {}
     for epoch in range(args.train_epochs):
-        mae_metric = evaluate.load('./utils/mae')
-        mape_metric = evaluate.load('./utils/mape')
         iter_count = 0
         total_loss = 0
         total_cl_loss = 0
@@ -301,7 +326,7 @@ for ii in range(args.itr):
         print_cl_loss = 0
         print_life_class_loss = 0
         std, mean_value = np.sqrt(train_data.label_scaler.var_[-1]), train_data.label_scaler.mean_[-1]
-        total_preds, total_references = [], []
+        train_metrics = MetricAccumulator(accelerator)
         for i, (cycle_curve_data, curve_attn_mask,  labels, life_class, scaled_life_class, weights, seen_unseen_ids) in enumerate(train_loader):
             with accelerator.accumulate(model):
                 model_optim.zero_grad()
@@ -312,6 +337,8 @@ for ii in range(args.itr):
                 cycle_curve_data = cycle_curve_data.float().to(accelerator.device)
                 curve_attn_mask = curve_attn_mask.float().to(accelerator.device) # [B, L]
                 labels = labels.float().to(accelerator.device)
+                if aug_helper is not None:
+                    cycle_curve_data = aug_helper(cycle_curve_data, curve_attn_mask)
                 
                 # encoder - decoder
                 outputs = model(cycle_curve_data, curve_attn_mask)
@@ -337,10 +364,7 @@ for ii in range(args.itr):
 
                 transformed_preds = outputs[:cut_off] * std + mean_value
                 transformed_labels = labels[:cut_off]  * std + mean_value
-                all_predictions, all_targets = accelerator.gather_for_metrics((transformed_preds, transformed_labels))
-                
-                total_preds = total_preds + all_predictions.detach().cpu().numpy().reshape(-1).tolist()
-                total_references = total_references + all_targets.detach().cpu().numpy().reshape(-1).tolist()
+                train_metrics.update(transformed_preds, transformed_labels)
                 accelerator.backward(loss)
                 model_optim.step()
                 if args.lradj == 'TST':
@@ -355,48 +379,64 @@ for ii in range(args.itr):
                     iter_count = 0
                     time_now = time.time()
 
-        train_rmse = root_mean_squared_error(total_references, total_preds)
-        train_mape = mean_absolute_percentage_error(total_references, total_preds)
+        train_metrics = train_metrics.compute()
+        train_rmse, train_mape = train_metrics['rmse'], train_metrics['mape']
         accelerator.print("Epoch: {} cost time: {}".format(epoch + 1, time.time() - epoch_time))
 
-        vali_rmse, vali_mae_loss, vali_mape, vali_alpha_acc1, vali_alpha_acc2 = vali_baseline(args, accelerator, model, vali_data, vali_loader, criterion, compute_seen_unseen=False)
-        test_rmse, test_mae_loss, test_mape, test_alpha_acc1, test_alpha_acc2, test_unseen_mape, test_seen_mape, test_unseen_alpha_acc1, test_seen_alpha_acc1, test_unseen_alpha_acc2, test_seen_alpha_acc2 = vali_baseline(args, accelerator, model, test_data, test_loader, criterion, compute_seen_unseen=True)
-        vali_loss = vali_mape
-
-        if vali_loss < best_vali_loss:
-            best_vali_loss = vali_loss
-            best_vali_MAE = vali_mae_loss
-            best_test_MAE = test_mae_loss
-            best_vali_RMSE = vali_rmse
-            best_test_RMSE = test_rmse
-            best_vali_MAPE = vali_mape
-            best_test_MAPE = test_mape
-
-            # alpha-accuracy
-            best_vali_alpha_acc1 = vali_alpha_acc1
-            best_vali_alpha_acc2 = vali_alpha_acc2
-            best_test_alpha_acc1 = test_alpha_acc1
-            best_test_alpha_acc2 = test_alpha_acc2
-
-            # seen, unseen
-            best_seen_test_MAPE = test_seen_mape
-            best_unseen_test_MAPE = test_unseen_mape
-            best_seen_test_alpha_acc1 = test_seen_alpha_acc1
-            best_unseen_test_alpha_acc1 = test_unseen_alpha_acc1
-            best_seen_test_alpha_acc2 = test_seen_alpha_acc2
-            best_unseen_test_alpha_acc2 = test_unseen_alpha_acc2
-            
         train_loss = total_loss / len(train_loader)
         total_cl_loss = total_cl_loss / len(train_loader)
         total_lc_loss = total_lc_loss / len(train_loader)
+        train_losses[epoch] = train_loss
         accelerator.print(
-            f"Epoch: {epoch+1} | Train Loss: {train_loss:.5f}| Train cl loss: {total_cl_loss:.5f}| Train lc loss: {total_lc_loss:.5f} | Train RMSE: {train_rmse:.7f} | Train MAPE: {train_mape:.7f} | Vali RMSE: {vali_rmse:.7f}| Vali MAE: {vali_mae_loss:.7f}| Vali MAPE: {vali_mape:.7f}| "
-            f"Test RMSE: {test_rmse:.7f}| Test MAE: {test_mae_loss:.7f} | Test MAPE: {test_mape:.7f}")
-        
-        early_stopping(epoch+1, vali_loss, vali_mae_loss, test_mae_loss, model, path)
-        if early_stopping.early_stop:
-            accelerator.print("Early stopping")
-            accelerator.set_trigger()
+            f"Epoch: {epoch+1} | Train Loss: {train_loss:.5f}| Train cl loss: {total_cl_loss:.5f}| Train lc loss: {total_lc_loss:.5f} | Train RMSE: {train_rmse:.7f} | Train MAPE: {train_mape:.7f}")
+
+        # The evaluation results are handled in the order of the epochs. The background evaluations finish later.
+        eval_results = []
+        if (epoch + 1) % args.eval_interval == 0 or epoch + 1 == args.train_epochs:
+            if async_evaluator is not None:
+                async_evaluator.submit(epoch, accelerator.unwrap_model(model))
+            else:
+                eval_results.append((epoch, model, evaluate_baseline(args, accelerator, model, vali_data, vali_loader, test_data, test_loader, criterion)))
+        if async_evaluator is not None:
+            eval_results = async_evaluator.poll(wait=epoch + 1 == args.train_epochs)
+
+        for eval_epoch, eval_model, (vali_results, test_results) in eval_results:
+            vali_rmse, vali_mae_loss, vali_mape, vali_alpha_acc1, vali_alpha_acc2 = vali_results
+            test_rmse, test_mae_loss, test_mape, test_alpha_acc1, test_alpha_acc2, test_unseen_mape, test_seen_mape, test_unseen_alpha_acc1, test_seen_alpha_acc1, test_unseen_alpha_acc2, test_seen_alpha_acc2 = test_results
+            vali_loss = vali_mape
+
+            if vali_loss < best_vali_loss:
+                best_vali_loss = vali_loss
+                best_vali_MAE = vali_mae_loss
+                best_test_MAE = test_mae_loss
+                best_vali_RMSE = vali_rmse
+                best_test_RMSE = test_rmse
+                best_vali_MAPE = vali_mape
+                best_test_MAPE = test_mape
+
+                # alpha-accuracy
+                best_vali_alpha_acc1 = vali_alpha_acc1
+                best_vali_alpha_acc2 = vali_alpha_acc2
+                best_test_alpha_acc1 = test_alpha_acc1
+                best_test_alpha_acc2 = test_alpha_acc2
+
+                # seen, unseen
+                best_seen_test_MAPE = test_seen_mape
+                best_unseen_test_MAPE = test_unseen_mape
+                best_seen_test_alpha_acc1 = test_seen_alpha_acc1
+                best_unseen_test_alpha_acc1 = test_unseen_alpha_acc1
+                best_seen_test_alpha_acc2 = test_seen_alpha_acc2
+                best_unseen_test_alpha_acc2 = test_unseen_alpha_acc2
+            
+            accelerator.print(
+                f"Epoch: {eval_epoch+1} | Vali RMSE: {vali_rmse:.7f}| Vali MAE: {vali_mae_loss:.7f}| Vali MAPE: {vali_mape:.7f}| "
+                f"Test RMSE: {test_rmse:.7f}| Test MAE: {test_mae_loss:.7f} | Test MAPE: {test_mape:.7f}")
+
+            early_stopping(eval_epoch+1, vali_loss, vali_mae_loss, test_mae_loss, eval_model, path)
+            if early_stopping.early_stop:
+                accelerator.print("Early stopping")
+                accelerator.set_trigger()
+                break
             
         if accelerator.check_trigger():
             break
@@ -411,6 +451,9 @@ for ii in range(args.itr):
         else:
             accelerator.print('Updating learning rate to {}'.format(scheduler.get_last_lr()[0]))
 
+    if async_evaluator is not None:
+        async_evaluator.shutdown()
+
 accelerator.print(f'Best model performance: Test MAE: {best_test_MAE:.4f} | Test RMSE: {best_test_RMSE:.4f} | Test MAPE: {best_test_MAPE:.4f} | Test 15%-accuracy: {best_test_alpha_acc1:.4f} | Test 10%-accuracy: {best_test_alpha_acc2:.4f} | Val MAE: {best_vali_MAE:.4f} | Val RMSE: {best_vali_RMSE:.4f} | Val MAPE: {best_vali_MAPE:.4f} | Val 15%-accuracy: {best_vali_alpha_acc1:.4f} | Val 10%-accuracy: {best_vali_alpha_acc2:.4f} ')
 accelerator.print(f'Best model performance: Test Seen MAPE: {best_seen_test_MAPE:.4f} | Test Unseen MAPE: {best_unseen_test_MAPE:.4f}')
 accelerator.print(f'Best model performance: Test Seen 15%-accuracy: {best_seen_test_alpha_acc1:.4f} | Test Unseen 15%-accuracy: {best_unseen_test_alpha_acc1:.4f}')
@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import numpy as np
 from math import sqrt
 from utils.masking import TriangularCausalMask, ProbMask
@@ -163,6 +164,35 @@ class FullAttention(nn.Module):
             return (V.contiguous(), None)
 
 
+class FusedAttention(FullAttention):
+    '''
+    FullAttention computed by the fused torch.nn.functional.scaled_dot_product_attention kernel.
+    attn_mask is either a compact [B, S] key padding mask or a [B, 1, L, S] mask like in FullAttention, True to mask.
+    It has no parameters, so a model trained with FullAttention can use it and vice versa.
+    The attention weights are not materialized. With output_attention, it falls back to FullAttention.
+    '''
+    def forward(self, queries, keys, values, attn_mask, tau=None, delta=None):
+        if attn_mask is not None and attn_mask.dim() == 2:
+            attn_mask = attn_mask[:, None, None, :] # [B, 1, 1, S]
+        if self.output_attention:
+            return super().forward(queries, keys, values, attn_mask, tau=tau, delta=delta)
+
+        B, L, H, E = queries.shape
+        scale = self.scale or 1. / sqrt(E)
+        is_causal = False
+        if not self.mask_flag:
+            attn_mask = None
+        elif attn_mask is None:
+            is_causal = True
+        else:
+            attn_mask = ~attn_mask # scaled_dot_product_attention takes True to attend
+
+        V = F.scaled_dot_product_attention(queries.transpose(1, 2), keys.transpose(1, 2), values.transpose(1, 2),
+                                           attn_mask=attn_mask, dropout_p=self.dropout.p if self.training else 0.,
+                                           is_causal=is_causal, scale=scale) # [B, H, L, D]
+        return (V.transpose(1, 2).contiguous(), None)
+
+
 class ProbAttention(nn.Module):
     def __init__(self, mask_flag=True, factor=5, scale=None, attention_dropout=0.1, output_attention=False):
         super(ProbAttention, self).__init__()
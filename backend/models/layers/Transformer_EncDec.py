@@ -88,13 +88,19 @@ class EncoderLayer(nn.Module):
             attn_mask=attn_mask,
             tau=tau, delta=delta
         )
+        return self.feed_forward(x, new_x), attn
+
+    def feed_forward(self, x, new_x):
+        '''
+        Add the attention output new_x to x and apply the position-wise feed forward network
+        '''
         x = x + self.dropout(new_x)
 
         y = x = self.norm1(x)
         y = self.dropout(self.activation(self.conv1(y.transpose(-1, 1))))
         y = self.dropout(self.conv2(y).transpose(-1, 1))
 
-        return self.norm2(x + y), attn
+        return self.norm2(x + y)
 
 
 class Encoder(nn.Module):
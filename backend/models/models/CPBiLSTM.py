@@ -47,13 +47,21 @@ class Model(nn.Module):
 
         self.projection = nn.Linear(configs.d_ff*2, configs.output_num)
 
-    def classification(self, x_enc, curve_attn_mask, return_embedding=False):
-        # Embedding
-        # Intra-cycle modelling
+    def intra_cycle_modelling(self, x_enc):
+        '''
+        x_enc: [B, early_cycle, num_var, fixed_len]
+        return: [B, early_cycle, d_model]
+        '''
         x_enc = self.intra_flatten(x_enc) # [B, early_cycle, fixed_len * num_var]
         x_enc = self.intra_embed(x_enc)
         for i in range(self.e_layers):
             x_enc = self.intra_MLP[i](x_enc) # [B, early_cycle, d_model]
+        return x_enc
+
+    def classification(self, x_enc, curve_attn_mask, return_embedding=False):
+        # Embedding
+        # Intra-cycle modelling
+        x_enc = self.intra_cycle_modelling(x_enc)
 
         # Inter-cycle modelling
         lengths = torch.sum(curve_attn_mask, dim=1).cpu() # [N]
@@ -61,7 +69,7 @@ class Model(nn.Module):
         x_enc, (_,_) = self.inter_cycle_BiLSTM(x_enc)
         x_enc, lens_unpacked = pad_packed_sequence(x_enc, True)
         idx = (torch.as_tensor(lengths, device=x_enc.device, dtype=torch.long) - 1).view(-1, 1).expand(
-            len(lengths), x_enc.size(2))
+            -1, x_enc.size(2))
         idx = idx.unsqueeze(1)
         x_enc = x_enc.gather(1, idx).squeeze(1) # [B, 2*d_ff]
 
@@ -84,3 +92,78 @@ class Model(nn.Module):
         else:
             dec_out = self.classification(cycle_curve_data, curve_attn_mask, return_embedding=return_embedding)
             return dec_out  # [B, N]
+
+    def predict_prefixes(self, cycle_curve_data, prefix_lengths):
+        '''
+        Predict the RUL for several prefix lengths of each cell in one pass.
+        The intra-cycle embeddings are computed once per cell.
+        params:
+            cycle_curve_data: [B, L, num_variables, fixed_length_of_curve], the curves of the cells
+            prefix_lengths: [B, P], the number of seen cycles of each prediction
+        return: [B, P, output_num]
+        '''
+        x_enc = self.intra_cycle_modelling(cycle_curve_data) # [B, L, d_model]
+        B, L = x_enc.shape[0], x_enc.shape[1]
+        P = prefix_lengths.shape[1]
+        idx = (prefix_lengths.long() - 1).unsqueeze(-1).expand(-1, -1, 2*self.d_ff)
+        if self.inter_cycle_BiLSTM.num_layers == 1:
+            # The forward direction is causal, so its state at step i only depends on the first i+1 cycles.
+            # The backward direction starts at the last seen cycle, so its output there only depends on that cycle.
+            forward_states, (_,_) = self.inter_cycle_BiLSTM(x_enc)
+            backward_states, (_,_) = self.inter_cycle_BiLSTM(x_enc.reshape(B*L, 1, -1))
+            backward_states = backward_states.reshape(B, L, -1)
+            x_enc = torch.cat([forward_states[:, :, :self.d_ff], backward_states[:, :, self.d_ff:]], dim=-1) # [B, L, 2*d_ff]
+            x_enc = x_enc.gather(1, idx) # [B, P, 2*d_ff]
+        else:
+            # The upper layers depend on the whole prefix, so every prefix is run as a packed sequence
+            x_enc = x_enc.unsqueeze(1).expand(-1, P, -1, -1).reshape(B*P, L, -1)
+            lengths = prefix_lengths.reshape(-1).cpu()
+            x_enc = pack_padded_sequence(x_enc, lengths=lengths, batch_first=True, enforce_sorted=False)
+            x_enc, (_,_) = self.inter_cycle_BiLSTM(x_enc)
+            x_enc, lens_unpacked = pad_packed_sequence(x_enc, True, total_length=L)
+            x_enc = x_enc.reshape(B, P, L, -1).gather(2, idx.unsqueeze(2)).squeeze(2) # [B, P, 2*d_ff]
+        return self.projection(x_enc)
+
+    def init_stream_state(self, batch_size):
+        '''
+        The streaming state of cells without seen cycles (see stream_step)
+        return: (h, c) of the forward direction, each [B, 1, d_ff] with one layer,
+                otherwise the intra-cycle embeddings of the seen cycles [B, early_cycle, d_model] and their number [B]
+        '''
+        parameter = next(self.parameters())
+        if self.inter_cycle_BiLSTM.num_layers == 1:
+            h = torch.zeros(batch_size, 1, self.d_ff, device=parameter.device, dtype=parameter.dtype)
+            return (h, torch.zeros_like(h))
+        embeddings = torch.zeros(batch_size, self.early_cycle_threshold, self.d_model, device=parameter.device, dtype=parameter.dtype)
+        return (embeddings, torch.zeros(batch_size, dtype=torch.long, device=parameter.device))
+
+    def stream_step(self, cycle_curve_data, state):
+        '''
+        Advance a batch of cells by their next cycle, with the same prediction as forward on all the seen cycles.
+        With one layer, the output at the last seen cycle is the forward state, which goes on from the previous cycles,
+        and the backward state of the last cycle alone (see predict_prefixes), so a step is O(1).
+        The upper layers depend on the whole prefix, so with more layers the embeddings of the seen cycles are
+        kept and only the recurrent part is run again.
+        params:
+            cycle_curve_data: [B, num_variables, fixed_length_of_curve], the next cycle of each cell
+            state: the state of the cells, see init_stream_state
+        return: preds [B, output_num] and the new state
+        '''
+        x_enc = self.intra_cycle_modelling(cycle_curve_data.unsqueeze(1)) # [B, 1, d_model]
+        if self.inter_cycle_BiLSTM.num_layers == 1:
+            h, c = [s.transpose(0, 1) for s in state]
+            # The forward direction goes on from its state; the backward direction starts at the new cycle
+            h0 = (torch.cat([h, torch.zeros_like(h)]), torch.cat([c, torch.zeros_like(c)]))
+            x_enc, (h, c) = self.inter_cycle_BiLSTM(x_enc, h0)
+            return self.projection(x_enc[:, 0]), (h[:1].transpose(0, 1), c[:1].transpose(0, 1))
+        embeddings, lengths = state
+        if int(lengths.max()) >= self.early_cycle_threshold:
+            raise ValueError(f'The model only sees the first {self.early_cycle_threshold} cycles')
+        embeddings = embeddings.clone()
+        embeddings[torch.arange(len(lengths), device=lengths.device), lengths] = x_enc[:, 0]
+        lengths = lengths + 1
+        x_enc = pack_padded_sequence(embeddings, lengths=lengths.cpu(), batch_first=True, enforce_sorted=False)
+        x_enc, (_,_) = self.inter_cycle_BiLSTM(x_enc)
+        x_enc, lens_unpacked = pad_packed_sequence(x_enc, True)
+        x_enc = x_enc[torch.arange(len(lengths), device=x_enc.device), lengths - 1] # [B, 2*d_ff]
+        return self.projection(x_enc), (embeddings, lengths)
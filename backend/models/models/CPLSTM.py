@@ -47,13 +47,21 @@ class Model(nn.Module):
 
         self.projection = nn.Linear(configs.d_ff, configs.output_num)
 
-    def classification(self, x_enc, curve_attn_mask, return_embedding=False):
-        # Embedding
-        # Intra-cycle modelling
+    def intra_cycle_modelling(self, x_enc):
+        '''
+        x_enc: [B, early_cycle, num_var, fixed_len]
+        return: [B, early_cycle, d_model]
+        '''
         x_enc = self.intra_flatten(x_enc) # [B, early_cycle, fixed_len * num_var]
         x_enc = self.intra_embed(x_enc)
         for i in range(self.e_layers):
             x_enc = self.intra_MLP[i](x_enc) # [B, early_cycle, d_model]
+        return x_enc
+
+    def classification(self, x_enc, curve_attn_mask, return_embedding=False):
+        # Embedding
+        # Intra-cycle modelling
+        x_enc = self.intra_cycle_modelling(x_enc)
 
         # Inter-cycle modelling
         lengths = torch.sum(curve_attn_mask, dim=1).cpu() # [N]
@@ -61,7 +69,7 @@ class Model(nn.Module):
         x_enc, (_,_) = self.inter_cycle_LSTM(x_enc)
         x_enc, lens_unpacked = pad_packed_sequence(x_enc, True)
         idx = (torch.as_tensor(lengths, device=x_enc.device, dtype=torch.long) - 1).view(-1, 1).expand(
-            len(lengths), x_enc.size(2))
+            -1, x_enc.size(2))
         idx = idx.unsqueeze(1)
         x_enc = x_enc.gather(1, idx).squeeze(1) # [B, 2*d_ff]
 
@@ -84,3 +92,42 @@ class Model(nn.Module):
         else:
             dec_out = self.classification(cycle_curve_data, curve_attn_mask, return_embedding=return_embedding)
             return dec_out  # [B, N]
+
+    def predict_prefixes(self, cycle_curve_data, prefix_lengths):
+        '''
+        Predict the RUL for several prefix lengths of each cell in one pass.
+        The intra-cycle embeddings are computed once per cell and the LSTM states of all steps are collected.
+        params:
+            cycle_curve_data: [B, L, num_variables, fixed_length_of_curve], the curves of the cells
+            prefix_lengths: [B, P], the number of seen cycles of each prediction
+        return: [B, P, output_num]
+        '''
+        x_enc = self.intra_cycle_modelling(cycle_curve_data) # [B, L, d_model]
+        # The LSTM is causal, so the state at step i only depends on the first i+1 cycles
+        x_enc, (_,_) = self.inter_cycle_LSTM(x_enc) # [B, L, d_ff]
+        idx = (prefix_lengths.long() - 1).unsqueeze(-1).expand(-1, -1, x_enc.size(2))
+        x_enc = x_enc.gather(1, idx) # [B, P, d_ff]
+        return self.projection(x_enc)
+
+    def init_stream_state(self, batch_size):
+        '''
+        The streaming state of cells without seen cycles (see stream_step)
+        return: (h, c), each [B, lstm_layers, d_ff]
+        '''
+        parameter = next(self.parameters())
+        h = torch.zeros(batch_size, self.inter_cycle_LSTM.num_layers, self.d_ff, device=parameter.device, dtype=parameter.dtype)
+        return (h, torch.zeros_like(h))
+
+    def stream_step(self, cycle_curve_data, state):
+        '''
+        Advance a batch of cells by their next cycle. The LSTM is causal, so one step from the state of the
+        previous cycles gives the same prediction as forward on all the seen cycles.
+        params:
+            cycle_curve_data: [B, num_variables, fixed_length_of_curve], the next cycle of each cell
+            state: (h, c) of the cells, each [B, lstm_layers, d_ff], see init_stream_state
+        return: preds [B, output_num] and the new state
+        '''
+        x_enc = self.intra_cycle_modelling(cycle_curve_data.unsqueeze(1)) # [B, 1, d_model]
+        h, c = [s.transpose(0, 1).contiguous() for s in state]
+        x_enc, (h, c) = self.inter_cycle_LSTM(x_enc, (h, c))
+        return self.projection(x_enc[:, 0]), (h.transpose(0, 1), c.transpose(0, 1))
@@ -46,25 +46,77 @@ class Model(nn.Module):
 
 
 
-    def forward(self, cycle_curve_data, curve_attn_mask, return_embedding=False):
+    def intra_cycle_modelling(self, cycle_curve_data):
         '''
-        cycle_curve_data: [B, early_cycle, fixed_len, num_var]
-        curve_attn_mask: [B, early_cycle]
+        cycle_curve_data: [B, early_cycle, num_var, fixed_len]
+        return: [B, early_cycle, d_model]
         '''
-        # tmp_curve_attn_mask = curve_attn_mask.unsqueeze(-1).unsqueeze(-1) * torch.ones_like(cycle_curve_data)
-        # cycle_curve_data[tmp_curve_attn_mask==0] = 0 # set the unseen data as zeros
-
         cycle_curve_data = self.intra_flatten(cycle_curve_data) # [B, early_cycle, fixed_len * num_var]
         cycle_curve_data = self.intra_embed(cycle_curve_data)
         for i in range(self.e_layers):
             cycle_curve_data = self.intra_MLP[i](cycle_curve_data) # [B, early_cycle, d_model]
+        return cycle_curve_data
 
-        cycle_curve_data = self.inter_flatten(cycle_curve_data) # [B, d_model]
-        for i in range(self.d_layers):
-            cycle_curve_data = self.inter_MLP[i](cycle_curve_data) # [B, d_model]
+    def pad_unseen_cycles(self, cycle_curve_data, embeddings, curve_attn_mask):
+        '''
+        The batches of --bucket_by_length only hold the first L cycles, where L is the longest prefix of the batch.
+        The cycles after L are unseen by all the samples, i.e., zero curves, so they share the embedding of a zero curve.
+        cycle_curve_data: [B, L, num_var, fixed_len]
+        embeddings: [B, L, d_model]
+        curve_attn_mask: [B, L]
+        return: [B, early_cycle, d_model] and [B, early_cycle]
+        '''
+        B, L = embeddings.shape[0], embeddings.shape[1]
+        if L >= self.early_cycle_threshold:
+            return embeddings, curve_attn_mask
+        zero_embedding = self.intra_cycle_modelling(torch.zeros_like(cycle_curve_data[:1, :1])) # [1, 1, d_model]
+        embeddings = torch.cat([embeddings, zero_embedding.expand(B, self.early_cycle_threshold - L, -1)], dim=1)
+        curve_attn_mask = F.pad(curve_attn_mask, (0, self.early_cycle_threshold - L))
+        return embeddings, curve_attn_mask
 
-        preds = self.head_output(F.relu(cycle_curve_data))
+    def forward(self, cycle_curve_data, curve_attn_mask, return_embedding=False):
+        '''
+        cycle_curve_data: [B, early_cycle, fixed_len, num_var], or [B, L, fixed_len, num_var] with L < early_cycle (see pad_unseen_cycles)
+        curve_attn_mask: [B, early_cycle] or [B, L]
+        '''
+        # tmp_curve_attn_mask = curve_attn_mask.unsqueeze(-1).unsqueeze(-1) * torch.ones_like(cycle_curve_data)
+        # cycle_curve_data[tmp_curve_attn_mask==0] = 0 # set the unseen data as zeros
+
+        embeddings = self.intra_cycle_modelling(cycle_curve_data)
+        embeddings, curve_attn_mask = self.pad_unseen_cycles(cycle_curve_data, embeddings, curve_attn_mask)
+        preds, cycle_curve_data = self.inter_cycle_modelling(embeddings)
         if return_embedding:
             return preds, cycle_curve_data
         else:
             return preds
+
+    def inter_cycle_modelling(self, cycle_curve_data):
+        '''
+        cycle_curve_data: [B, early_cycle, d_model]
+        return: preds [B, 1] and the embedding [B, d_model]
+        '''
+        cycle_curve_data = self.inter_flatten(cycle_curve_data) # [B, d_model]
+        for i in range(self.d_layers):
+            cycle_curve_data = self.inter_MLP[i](cycle_curve_data) # [B, d_model]
+
+        preds = self.head_output(F.relu(cycle_curve_data))
+        return preds, cycle_curve_data
+
+    def predict_prefixes(self, cycle_curve_data, prefix_lengths):
+        '''
+        Predict the RUL for several prefix lengths of each cell in one pass.
+        The intra-cycle embeddings are computed once per cell and shared by all the prefix lengths.
+        cycle_curve_data: [B, early_cycle, num_var, fixed_len], the curves of the cells
+        prefix_lengths: [B, P], the number of seen cycles of each prediction
+        return: [B, P, output_num]
+        '''
+        B, L = cycle_curve_data.shape[0], cycle_curve_data.shape[1]
+        P = prefix_lengths.shape[1]
+        embeddings = self.intra_cycle_modelling(cycle_curve_data) # [B, early_cycle, d_model]
+        # The unseen cycles are fed as zeros in forward, so they share the embedding of a zero curve
+        zero_embedding = self.intra_cycle_modelling(torch.zeros_like(cycle_curve_data[:1, :1])) # [1, 1, d_model]
+        curve_attn_mask = torch.arange(L, device=prefix_lengths.device).view(1, 1, L) < prefix_lengths.unsqueeze(-1) # [B, P, early_cycle]
+        embeddings = torch.where(curve_attn_mask.unsqueeze(-1), embeddings.unsqueeze(1), zero_embedding.unsqueeze(1)) # [B, P, early_cycle, d_model]
+        embeddings = embeddings.reshape(B*P, L, -1)
+        preds, _ = self.inter_cycle_modelling(embeddings)
+        return preds.reshape(B, P, -1)
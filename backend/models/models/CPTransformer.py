@@ -2,7 +2,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from layers.Transformer_EncDec import Decoder, DecoderLayer, Encoder, EncoderLayer, ConvLayer
-from layers.SelfAttention_Family import FullAttention, AttentionLayer
+from layers.SelfAttention_Family import FullAttention, FusedAttention, AttentionLayer
 from layers.Embed import DataEmbedding, PositionalEmbedding
 class MLPBlock(nn.Module):
     def __init__(self, in_dim, hidden_dim, out_dim, drop_rate):
@@ -39,11 +39,14 @@ class Model(nn.Module):
         self.intra_MLP = nn.ModuleList([MLPBlock(self.d_model, self.d_ff, self.d_model, self.drop_rate) for _ in range(configs.e_layers)])
 
         self.pe = PositionalEmbedding(self.d_model)
+        # 'fused' uses scaled_dot_product_attention with a [B, L] key padding mask. Both backends have the same parameters.
+        self.attention_backend = getattr(configs, 'attention_backend', 'full')
+        Attention = FusedAttention if self.attention_backend == 'fused' else FullAttention
         self.inter_TransformerEncoder = Encoder(
             [
                 EncoderLayer(
                     AttentionLayer(
-                        FullAttention(True, configs.factor, attention_dropout=configs.dropout,
+                        Attention(True, configs.factor, attention_dropout=configs.dropout,
                                       output_attention=False), configs.d_model, configs.n_heads),
                     configs.d_model,
                     configs.d_ff,
@@ -56,29 +59,173 @@ class Model(nn.Module):
         self.inter_flatten = nn.Flatten(start_dim=1)
         self.projection = nn.Linear(configs.d_model * self.early_cycle_threshold, configs.output_num)
 
-    def forward(self, cycle_curve_data, curve_attn_mask, return_embedding=False):
+    def intra_cycle_modelling(self, cycle_curve_data):
         '''
-        cycle_curve_data: [B, early_cycle, fixed_len, num_var]
-        curve_attn_mask: [B, early_cycle]
+        cycle_curve_data: [B, early_cycle, num_var, fixed_len]
+        return: [B, early_cycle, d_model]
         '''
-        # tmp_curve_attn_mask = curve_attn_mask.unsqueeze(-1).unsqueeze(-1) * torch.ones_like(cycle_curve_data)
-        # cycle_curve_data[tmp_curve_attn_mask==0] = 0 # set the unseen data as zeros
-
         cycle_curve_data = self.intra_flatten(cycle_curve_data) # [B, early_cycle, fixed_len * num_var]
         cycle_curve_data = self.intra_embed(cycle_curve_data)
         for i in range(self.e_layers):
             cycle_curve_data = self.intra_MLP[i](cycle_curve_data) # [B, early_cycle, d_model]
+        return cycle_curve_data
 
+    def pad_unseen_cycles(self, cycle_curve_data, embeddings, curve_attn_mask):
+        '''
+        The batches of --bucket_by_length only hold the first L cycles, where L is the longest prefix of the batch.
+        The cycles after L are unseen by all the samples, i.e., zero curves, so they share the embedding of a zero curve.
+        cycle_curve_data: [B, L, num_var, fixed_len]
+        embeddings: [B, L, d_model]
+        curve_attn_mask: [B, L]
+        return: [B, early_cycle, d_model] and [B, early_cycle]
+        '''
+        B, L = embeddings.shape[0], embeddings.shape[1]
+        if L >= self.early_cycle_threshold:
+            return embeddings, curve_attn_mask
+        zero_embedding = self.intra_cycle_modelling(torch.zeros_like(cycle_curve_data[:1, :1])) # [1, 1, d_model]
+        embeddings = torch.cat([embeddings, zero_embedding.expand(B, self.early_cycle_threshold - L, -1)], dim=1)
+        curve_attn_mask = F.pad(curve_attn_mask, (0, self.early_cycle_threshold - L))
+        return embeddings, curve_attn_mask
+
+    def forward(self, cycle_curve_data, curve_attn_mask, return_embedding=False):
+        '''
+        cycle_curve_data: [B, early_cycle, fixed_len, num_var], or [B, L, fixed_len, num_var] with L < early_cycle (see pad_unseen_cycles)
+        curve_attn_mask: [B, early_cycle] or [B, L]
+        '''
+        # tmp_curve_attn_mask = curve_attn_mask.unsqueeze(-1).unsqueeze(-1) * torch.ones_like(cycle_curve_data)
+        # cycle_curve_data[tmp_curve_attn_mask==0] = 0 # set the unseen data as zeros
+
+        embeddings = self.intra_cycle_modelling(cycle_curve_data)
+        embeddings, curve_attn_mask = self.pad_unseen_cycles(cycle_curve_data, embeddings, curve_attn_mask)
+        preds, output = self.inter_cycle_modelling(embeddings, curve_attn_mask)
+        if return_embedding:
+            return preds, output
+        return preds
+
+    def inter_cycle_modelling(self, cycle_curve_data, curve_attn_mask):
+        '''
+        cycle_curve_data: [B, early_cycle, d_model]
+        curve_attn_mask: [B, early_cycle]
+        return: preds [B, output_num] and the flattened embedding [B, early_cycle * d_model]
+        '''
         cycle_curve_data = self.pe(cycle_curve_data) + cycle_curve_data
-        curve_attn_mask = curve_attn_mask.unsqueeze(1) # [B, 1, L]
-        curve_attn_mask = torch.repeat_interleave(curve_attn_mask, curve_attn_mask.shape[-1], dim=1) # [B, L, L]
-        curve_attn_mask = curve_attn_mask.unsqueeze(1) # [B, 1, L, L]
-        curve_attn_mask = curve_attn_mask==0 # set True to mask
+        if self.attention_backend == 'fused':
+            curve_attn_mask = curve_attn_mask==0 # [B, L], set True to mask the unseen keys
+        else:
+            curve_attn_mask = curve_attn_mask.unsqueeze(1) # [B, 1, L]
+            curve_attn_mask = torch.repeat_interleave(curve_attn_mask, curve_attn_mask.shape[-1], dim=1) # [B, L, L]
+            curve_attn_mask = curve_attn_mask.unsqueeze(1) # [B, 1, L, L]
+            curve_attn_mask = curve_attn_mask==0 # set True to mask
         output, attns = self.inter_TransformerEncoder(cycle_curve_data, attn_mask=curve_attn_mask)
 
         output = self.dropout(output)
         output = output.reshape(output.shape[0], -1)  # (batch_size, L * d_model)
         preds = self.projection(output)  # (batch_size, num_classes)
-        if return_embedding:
-            return preds, output
-        return preds
+        return preds, output
+
+    def predict_prefixes(self, cycle_curve_data, prefix_lengths):
+        '''
+        Predict the RUL for several prefix lengths of each cell in one pass.
+        The intra-cycle embeddings are computed once per cell and shared by all the prefix lengths.
+        cycle_curve_data: [B, early_cycle, num_var, fixed_len], the curves of the cells
+        prefix_lengths: [B, P], the number of seen cycles of each prediction
+        return: [B, P, output_num]
+        '''
+        B, L = cycle_curve_data.shape[0], cycle_curve_data.shape[1]
+        P = prefix_lengths.shape[1]
+        embeddings = self.intra_cycle_modelling(cycle_curve_data) # [B, early_cycle, d_model]
+        # The unseen cycles are fed as zeros in forward, so they share the embedding of a zero curve
+        zero_embedding = self.intra_cycle_modelling(torch.zeros_like(cycle_curve_data[:1, :1])) # [1, 1, d_model]
+        curve_attn_mask = torch.arange(L, device=prefix_lengths.device).view(1, 1, L) < prefix_lengths.unsqueeze(-1) # [B, P, early_cycle]
+        embeddings = torch.where(curve_attn_mask.unsqueeze(-1), embeddings.unsqueeze(1), zero_embedding.unsqueeze(1)) # [B, P, early_cycle, d_model]
+        embeddings = embeddings.reshape(B*P, L, -1)
+        preds, _ = self.inter_cycle_modelling(embeddings, curve_attn_mask.reshape(B*P, L).float())
+        return preds.reshape(B, P, -1)
+
+    def start_session(self):
+        '''
+        Start the incremental inference of one cell whose cycles arrive one at a time (see StreamingSession)
+        '''
+        return StreamingSession(self)
+
+
+class StreamingSession:
+    '''
+    Incremental inference of one cell whose cycles arrive one at a time.
+    update(cycle_curve) embeds only the new cycle and returns the same prediction as forward on the first
+    seen_cycles cycles, i.e., with the later cycles set to zeros and masked.
+    The unseen cycles are only masked as keys, so every cycle attends to all the seen cycles and a new cycle changes
+    the outputs of all the positions. The session caches what does not change:
+        - the inputs of the encoder (intra-cycle embedding + positional embedding) of every cycle
+        - the queries, keys and values of the first encoder layer
+    The attention of each layer only covers the keys of the seen cycles, which gives the same result as masking
+    the others. The model should be in evaluation mode.
+    '''
+    def __init__(self, model):
+        self.model = model
+        self.seen_cycles = 0
+        L = model.early_cycle_threshold
+        parameter = next(model.parameters())
+        with torch.no_grad():
+            # All the cycles start as unseen zero curves
+            zero_curve = torch.zeros(1, 1, 3, model.charge_discharge_length, device=parameter.device, dtype=parameter.dtype)
+            zero_embedding = model.intra_cycle_modelling(zero_curve) # [1, 1, d_model]
+            self.inputs = (zero_embedding.expand(1, L, -1) + model.pe(zero_embedding.expand(1, L, -1))).contiguous() # [1, L, d_model]
+            self.layers = model.inter_TransformerEncoder.attn_layers
+            if len(self.layers) > 0:
+                first_attention = self.layers[0].attention
+                H = first_attention.n_heads
+                self.queries = first_attention.query_projection(self.inputs).view(1, L, H, -1)
+                self.keys = first_attention.key_projection(self.inputs).view(1, L, H, -1)
+                self.values = first_attention.value_projection(self.inputs).view(1, L, H, -1)
+
+    def update(self, cycle_curve):
+        '''
+        Add the next cycle of the cell
+        cycle_curve: [3, charge_discharge_length], the resampled curves of the cycle
+        return: [output_num], the scaled prediction given all the cycles seen so far
+        '''
+        model = self.model
+        if self.seen_cycles >= model.early_cycle_threshold:
+            raise ValueError(f'The model only sees the first {model.early_cycle_threshold} cycles')
+        n = self.seen_cycles
+        parameter = next(model.parameters())
+        with torch.no_grad():
+            cycle_curve = torch.as_tensor(cycle_curve, device=parameter.device, dtype=parameter.dtype)
+            embedding = model.intra_cycle_modelling(cycle_curve.reshape(1, 1, *cycle_curve.shape[-2:])) # [1, 1, d_model]
+            self.inputs[:, n:n+1] = embedding + model.pe.pe[:, n:n+1]
+            if len(self.layers) > 0:
+                first_attention = self.layers[0].attention
+                x = self.inputs[:, n:n+1]
+                self.queries[:, n] = first_attention.query_projection(x).view(1, first_attention.n_heads, -1)
+                self.keys[:, n] = first_attention.key_projection(x).view(1, first_attention.n_heads, -1)
+                self.values[:, n] = first_attention.value_projection(x).view(1, first_attention.n_heads, -1)
+        self.seen_cycles = n + 1
+        return self.predict()
+
+    def predict(self):
+        '''
+        return: [output_num], the scaled prediction given the cycles seen so far
+        '''
+        if self.seen_cycles == 0:
+            raise ValueError('No cycle has been seen yet')
+        model, n = self.model, self.seen_cycles
+        L = model.early_cycle_threshold
+        with torch.no_grad():
+            x = self.inputs
+            attn_mask = torch.zeros(1, 1, 1, n, dtype=torch.bool, device=x.device) # all the seen keys are attended
+            for i, layer in enumerate(self.layers):
+                attention = layer.attention
+                H = attention.n_heads
+                if i == 0:
+                    queries, keys, values = self.queries, self.keys[:, :n], self.values[:, :n]
+                else:
+                    queries = attention.query_projection(x).view(1, L, H, -1)
+                    keys = attention.key_projection(x[:, :n]).view(1, n, H, -1)
+                    values = attention.value_projection(x[:, :n]).view(1, n, H, -1)
+                out, _ = attention.inner_attention(queries, keys, values, attn_mask)
+                x = layer.feed_forward(x, attention.out_projection(out.view(1, L, -1)))
+            if model.inter_TransformerEncoder.norm is not None:
+                x = model.inter_TransformerEncoder.norm(x)
+            preds = model.projection(model.dropout(x).reshape(1, -1))
+        return preds[0]
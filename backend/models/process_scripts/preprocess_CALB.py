@@ -2,6 +2,7 @@
 # Copyright (c) Microsoft Corporation.
 
 import os
+import multiprocessing
 import numpy as np
 import pandas as pd
 import openpyxl
@@ -14,18 +15,33 @@ from batteryml import BatteryData, CycleData, CyclingProtocol
 from batteryml.builders import PREPROCESSORS
 from batteryml.preprocess.base import BasePreprocessor
 
+try:
+    # calamine parses the workbooks about 10x faster than openpyxl
+    from python_calamine import CalamineWorkbook
+except ImportError:
+    CalamineWorkbook = None
+
+# The columns of the record sheet used by organize_cell
+RECORD_COLUMNS = ['循环号', '电压(V)', '电流(A)', '放电容量(Ah)', '容量(Ah)', '绝对时间']
+MINUS_10_RECORD_COLUMNS = ['外循环', '电压(V)', '电流(A)', '安时(AH)', '步时间(s)']
+TEXT_COLUMNS = ['绝对时间']
+
 
 @PREPROCESSORS.register()
 class CALBPreprocessor(BasePreprocessor):
-    def process(self, parent_dir, **kwargs) -> List[BatteryData]:
+    def process(self, parent_dir, num_workers=0, **kwargs) -> List[BatteryData]:
+        '''
+        The cells are independent, so they are converted by a process pool of num_workers processes.
+        num_workers=0 uses all the CPU cores, 1 converts the cells in the main process.
+        '''
         path = Path(parent_dir)
         files_path_list = ['0度', '25度', '35度', '45度']# drop the -10 batch for its capacity retention bigger than 0.925 SOH
-        process_batteries_num = 0
         skip_batteries_num = 0
+        jobs = []
         for files_path in files_path_list:
-            file_path = os.listdir(path / files_path)
+            file_path = sorted(os.listdir(path / files_path))
             files = [i for i in file_path if i.endswith('.xlsx')]
-            for file in tqdm(files):
+            for file in files:
                 cell_name = 'CALB_' + files_path.split('度')[0] + '_' + file.split('.')[0]
                 if cell_name.startswith('CALB_45_B254'):
                     continue
@@ -35,23 +51,107 @@ class CALBPreprocessor(BasePreprocessor):
                 if whether_to_skip == True:
                     skip_batteries_num += 1
                     continue
+                jobs.append((path / files_path / file, files_path, cell_name))
 
-                data = pd.read_excel(path / files_path/ file, sheet_name='record')
-                df = pd.DataFrame(data)
-                if (files_path == '25度') or (files_path == '35度') or ('B254' in file) or ('B256' in file):
-                    df = df[df['循环号'] > 1]
-
-                # organize data
-                battery = organize_cell(df, cell_name, 58, files_path)
-                self.dump_single_file(battery)
+        num_workers = os.cpu_count() if num_workers == 0 else num_workers
+        num_workers = min(num_workers, len(jobs))
+        process_batteries_num = 0
+        if num_workers <= 1:
+            for cell_id in tqdm(map(self.process_cell, jobs), total=len(jobs)):
                 process_batteries_num += 1
-
                 if not self.silent:
-                    tqdm.write(f'File: {battery.cell_id} dumped to pkl file')
+                    tqdm.write(f'File: {cell_id} dumped to pkl file')
+        else:
+            with multiprocessing.Pool(num_workers) as pool:
+                for cell_id in tqdm(pool.imap_unordered(self.process_cell, jobs), total=len(jobs)):
+                    process_batteries_num += 1
+                    if not self.silent:
+                        tqdm.write(f'File: {cell_id} dumped to pkl file')
 
         return process_batteries_num, skip_batteries_num
 
+    def process_cell(self, job):
+        '''
+        Convert one raw workbook and dump the cell to its pkl file
+        :param job: (the .xlsx path, the temperature folder, the cell name)
+        :return: the cell id
+        '''
+        file_path, files_path, cell_name = job
+        columns = MINUS_10_RECORD_COLUMNS if '-10' in cell_name else RECORD_COLUMNS
+        records = read_record_sheet(file_path, columns)
+        if (files_path == '25度') or (files_path == '35度') or ('B254' in file_path.name) or ('B256' in file_path.name):
+            keep = records['循环号'] > 1
+            records = {column: values[keep] for column, values in records.items()}
+
+        # organize data
+        battery = organize_cell(records, cell_name, 58, files_path)
+        self.dump_single_file(battery)
+        return battery.cell_id
+
+
+def read_record_sheet(file_path, columns):
+    '''
+    Read some columns of the record sheet of a raw CALB workbook.
+    The workbook is read with calamine if it is installed, otherwise it is streamed row by row by openpyxl
+    in read-only mode. Only the required columns are kept.
+    :return: {column: [N] array}. The columns in TEXT_COLUMNS are object arrays, the others are float arrays.
+             The rows without a cycle number (e.g. the empty rows at the end of the sheet) are dropped.
+    '''
+    if CalamineWorkbook is not None:
+        rows = iter(CalamineWorkbook.from_path(str(file_path)).get_sheet_by_name('record').to_python())
+        workbook = None
+    else:
+        workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+        rows = workbook['record'].iter_rows(values_only=True)
+    try:
+        header = list(next(rows))
+        indices = [header.index(column) for column in columns]
+        values = [[row[index] if index < len(row) else None for index in indices] for row in rows]
+    finally:
+        if workbook is not None:
+            workbook.close()
+
+    columns_values = list(zip(*values)) if values else [() for _ in columns]
+    records = {}
+    for column, column_values in zip(columns, columns_values):
+        if column in TEXT_COLUMNS:
+            records[column] = np.array(column_values, dtype=object)
+        else:
+            column_values = np.array(column_values, dtype=object)
+            column_values[column_values == ''] = None # calamine returns '' for the empty cells
+            records[column] = column_values.astype(np.float64)
+    has_cycle = ~np.isnan(records[columns[0]])
+    return {column: column_values[has_cycle] for column, column_values in records.items()}
+
+
+def parse_time_of_day(absolute_times):
+    '''
+    Convert the absolute times (e.g. '2021-03-01 08:00:10.5') to the seconds since the start of the day
+    '''
+    times = pd.Series(absolute_times)
+    if len(times) > 0 and not isinstance(times.iloc[0], str):
+        # the cells are formatted as dates
+        times = pd.to_datetime(times)
+        return (times.dt.hour * 3600 + times.dt.minute * 60 + times.dt.second + times.dt.microsecond / 1e6).to_numpy(dtype=np.float64)
+    hms = times.str.split(' ').str[1].str.split(':', expand=True).astype(float)
+    return (hms[0] * 3600 + hms[1] * 60 + hms[2]).to_numpy()
+
+
+def split_cycles(cycle_numbers):
+    '''
+    Group the records by cycle number like DataFrame.groupby, i.e., the cycles are sorted and the records keep their order
+    :return: the order of the records and (cycle number, start, stop) of each cycle in that order
+    '''
+    order = np.argsort(cycle_numbers, kind='stable')
+    cycles, starts = np.unique(cycle_numbers[order], return_index=True)
+    stops = np.append(starts[1:], len(order))
+    return order, list(zip(cycles, starts, stops))
+
+
 def organize_cell(timeseries_df, name, C, temperature):
+    '''
+    :param timeseries_df: {column: [N] array} of the record sheet (see read_record_sheet) or a DataFrame of it
+    '''
     temperature_in_C_value = 0
     charge_rate_in_C = 0
     discharge_rate_in_C = 0
@@ -88,38 +188,39 @@ def organize_cell(timeseries_df, name, C, temperature):
         lower_cutoff_voltage = 2.5
         upper_cutoff_voltage = 4.25
 
+    # The signals are sliced from the column arrays of the record sheet instead of being converted to lists
+    columns = MINUS_10_RECORD_COLUMNS if '-10' in name else RECORD_COLUMNS
+    timeseries_df = {column: np.asarray(timeseries_df[column]) for column in columns}
     if '-10' in name:
+        order, cycles = split_cycles(timeseries_df['外循环'])
+        voltages, currents = timeseries_df['电压(V)'][order], timeseries_df['电流(A)'][order]
+        capacities, times = timeseries_df['安时(AH)'][order], timeseries_df['步时间(s)'][order]
         cycle_data = []
-        for cycle_index, df in timeseries_df.groupby('外循环'):
+        for cycle_index, start, stop in cycles:
             cycle_data.append(CycleData(
                 cycle_number=int(cycle_index),
-                voltage_in_V=df['电压(V)'].tolist(),
-                current_in_A=df['电流(A)'].tolist(),
-                temperature_in_C=list([temperature_in_C_value] * len(df)),
-                discharge_capacity_in_Ah=df['安时(AH)'].tolist(),
-                charge_capacity_in_Ah=df['安时(AH)'].tolist(),
-                time_in_s=df['步时间(s)'].tolist()
+                voltage_in_V=voltages[start:stop],
+                current_in_A=currents[start:stop],
+                temperature_in_C=np.full(stop - start, temperature_in_C_value),
+                discharge_capacity_in_Ah=capacities[start:stop],
+                charge_capacity_in_Ah=capacities[start:stop],
+                time_in_s=times[start:stop]
             ))
     else:
+        order, cycles = split_cycles(timeseries_df['循环号'])
+        voltages, currents = timeseries_df['电压(V)'][order], timeseries_df['电流(A)'][order]
+        discharge_capacities, charge_capacities = timeseries_df['放电容量(Ah)'][order], timeseries_df['容量(Ah)'][order]
+        times = parse_time_of_day(timeseries_df['绝对时间'][order])
         cycle_data = []
-        for cycle_index, df in timeseries_df.groupby('循环号'):
-            times = []
-            for time in list(df['绝对时间'].values):
-                time = time.split(' ')[1]
-                h = float(time.split(':')[0])
-                m = float(time.split(':')[1])
-                s = float(time.split(':')[2])
-                seconds = (h * 3600 + m * 60 + s)
-                times.append(seconds)
-
+        for cycle_index, start, stop in cycles:
             cycle_data.append(CycleData(
                 cycle_number=int(cycle_index),
-                voltage_in_V=df['电压(V)'].tolist(),
-                current_in_A=df['电流(A)'].tolist(),
-                temperature_in_C=list([temperature_in_C_value] * len(df)),
-                discharge_capacity_in_Ah=df['放电容量(Ah)'].tolist(),
-                charge_capacity_in_Ah=df['容量(Ah)'].tolist(),
-                time_in_s=times
+                voltage_in_V=voltages[start:stop],
+                current_in_A=currents[start:stop],
+                temperature_in_C=np.full(stop - start, temperature_in_C_value),
+                discharge_capacity_in_Ah=discharge_capacities[start:stop],
+                charge_capacity_in_Ah=charge_capacities[start:stop],
+                time_in_s=times[start:stop]
             ))
     # Charge Protocol is constant current
     charge_protocol = [CyclingProtocol(
@@ -0,0 +1,179 @@
+'''
+Quantize a trained CP model (CPTransformer, CPMLP, CPLSTM, CPBiGRU or CPBiLSTM) to int8 with dynamic quantization
+and compare it with the fp32 model on CPU.
+model_int8.pt and quantization_report.json are written into the checkpoint folder. The report holds
+    - the MAPE and alpha-accuracy of both models on the test split
+    - the p50/p99 latency and the peak memory of both models at several batch sizes
+    - the size of the weights of both models
+Each latency run is made in a fresh process, and its peak memory is the growth of the peak RSS during the forward passes.
+The int8 model is served by RULPredictor(model_path, quantized=True).
+
+Usage:
+    python quantize_model.py --args_path checkpoints/CALB_CPTransformer/<setting> --root_path ./dataset
+'''
+import io
+import os
+import json
+import time
+import resource
+import argparse
+import multiprocessing
+import numpy as np
+import torch
+import joblib
+from RUL.rul_predictor import MODEL_CLASSES, Args, load_model_weights
+from data_provider.data_loader import Dataset_original
+from utils.metrics import mean_absolute_percentage_error, alpha_accuracy
+from utils.quantization import quantize_model, save_quantized_model, load_quantized_model
+
+VARIANTS = ['fp32', 'int8']
+
+
+def load_checkpoint_args(args_path):
+    with open(os.path.join(args_path, 'args.json')) as f:
+        return Args(**json.load(f))
+
+
+def load_variant(args_path, variant):
+    model_args = load_checkpoint_args(args_path)
+    model = MODEL_CLASSES[model_args.model].Model(model_args).float()
+    if variant == 'int8':
+        return load_quantized_model(model, args_path)
+    load_model_weights(model, args_path)
+    return model.eval()
+
+
+def get_serialized_size(model):
+    '''
+    :return: the size of the saved state_dict of the model in MB
+    '''
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes / 2**20
+
+
+def predict_test_set(model, test_data, batch_size=256):
+    '''
+    :return: the transformed predictions and labels of the test samples
+    '''
+    std, mean_value = np.sqrt(test_data.label_scaler.var_[-1]), test_data.label_scaler.mean_[-1]
+    preds, labels = [], []
+    with torch.inference_mode():
+        for start in range(0, len(test_data), batch_size):
+            batch = test_data.get_batch(range(start, min(start + batch_size, len(test_data))))
+            preds.append(model(batch['cycle_curve_data'], batch['curve_attn_mask']).reshape(-1).numpy())
+            labels.append(batch['labels'].reshape(-1).numpy())
+    return np.concatenate(preds) * std + mean_value, np.concatenate(labels) * std + mean_value
+
+
+def get_peak_memory():
+    '''
+    :return: the peak RSS of this process in MB. ru_maxrss also keeps the peak of the parent that forked the process,
+             so VmHWM is used where it is available.
+    '''
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure_latency(args_path, variant, batch_size, warmup, repeats, num_threads):
+    '''
+    Time the forward pass of one batch of batch_size cells that see all the early cycles
+    :return: p50 and p99 latency in ms and the peak memory growth of the forward passes in MB
+    '''
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    model = load_variant(args_path, variant)
+    model_args = load_checkpoint_args(args_path)
+    generator = torch.Generator().manual_seed(0)
+    cycle_curve_data = torch.rand(batch_size, model_args.early_cycle_threshold, 3, model_args.charge_discharge_length, generator=generator)
+    curve_attn_mask = torch.ones(batch_size, model_args.early_cycle_threshold)
+    base_memory = get_peak_memory()
+    latencies = []
+    with torch.inference_mode():
+        for i in range(warmup + repeats):
+            start = time.perf_counter()
+            model(cycle_curve_data, curve_attn_mask)
+            if i >= warmup:
+                latencies.append((time.perf_counter() - start) * 1000)
+    peak_memory = get_peak_memory() - base_memory
+    return float(np.percentile(latencies, 50)), float(np.percentile(latencies, 99)), peak_memory
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Quantize a trained CP model to int8 and compare it with the fp32 model')
+    parser.add_argument('--args_path', type=str, required=True, help='the checkpoint folder with args.json, the weights and the scalers')
+    parser.add_argument('--eval_dataset', type=str, default=None, help='the dataset of the test split; defaults to the one of the checkpoint')
+    parser.add_argument('--root_path', type=str, default=None, help='root path of the data files; defaults to the one of the checkpoint')
+    parser.add_argument('--cache_path', type=str, default='./dataset/preprocessed_cache', help="where the resampled curves are cached, 'None' to disable the cache")
+    parser.add_argument('--load_workers', type=int, default=0, help='processes used to read the cells; 0 uses all CPU cores')
+    parser.add_argument('--alpha1', type=float, default=0.15, help='the alpha of the first alpha-accuracy')
+    parser.add_argument('--alpha2', type=float, default=0.1, help='the alpha of the second alpha-accuracy')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 16, 64, 256])
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--repeats', type=int, default=50)
+    parser.add_argument('--num_threads', type=int, default=None, help='torch threads of the latency runs')
+    args = parser.parse_args()
+
+    model_args = load_checkpoint_args(args.args_path)
+    if model_args.model not in MODEL_CLASSES:
+        raise ValueError(f'Unsupported model type: {model_args.model}')
+    fp32_model = load_variant(args.args_path, 'fp32')
+    save_quantized_model(quantize_model(fp32_model), args.args_path)
+    models = {'fp32': fp32_model, 'int8': load_variant(args.args_path, 'int8')}
+    report = {'model': model_args.model, 'args_path': args.args_path, 'accuracy': {}, 'latency': {},
+              'weights_MB': {variant: get_serialized_size(model) for variant, model in models.items()}}
+
+    # Accuracy on the test split
+    model_args.dataset = args.eval_dataset or model_args.dataset
+    model_args.root_path = args.root_path or model_args.root_path
+    model_args.cache_path = args.cache_path
+    model_args.load_workers = args.load_workers
+    model_args.bucket_by_length = False
+    label_scaler = joblib.load(os.path.join(args.args_path, 'label_scaler'))
+    life_class_scaler = joblib.load(os.path.join(args.args_path, 'life_class_scaler'))
+    test_data = Dataset_original(model_args, flag='test', label_scaler=label_scaler, life_class_scaler=life_class_scaler)
+    predictions = {}
+    for variant, model in models.items():
+        preds, references = predict_test_set(model, test_data)
+        predictions[variant] = preds
+        report['accuracy'][variant] = {
+            'MAPE': float(mean_absolute_percentage_error(references, preds)),
+            f'{args.alpha1}-accuracy': float(alpha_accuracy(references, preds, args.alpha1)),
+            f'{args.alpha2}-accuracy': float(alpha_accuracy(references, preds, args.alpha2))
+        }
+    report['accuracy']['max_relative_deviation'] = float(np.max(np.abs(predictions['int8'] - predictions['fp32']) / np.abs(predictions['fp32'])))
+
+    # Latency and memory, each run in a fresh process
+    context = multiprocessing.get_context('spawn')
+    for batch_size in args.batch_sizes:
+        report['latency'][batch_size] = {}
+        for variant in VARIANTS:
+            with context.Pool(1) as pool:
+                p50, p99, peak_memory = pool.apply(measure_latency, (args.args_path, variant, batch_size, args.warmup, args.repeats, args.num_threads))
+            report['latency'][batch_size][variant] = {'p50_ms': p50, 'p99_ms': p99, 'peak_memory_MB': peak_memory}
+
+    with open(os.path.join(args.args_path, 'quantization_report.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print(f'{model_args.model} on the {model_args.dataset} test split ({len(test_data)} samples), weights '
+          f'{report["weights_MB"]["fp32"]:.1f} MB fp32 -> {report["weights_MB"]["int8"]:.1f} MB int8')
+    metrics = list(report['accuracy']['fp32'])
+    print(f'{"":>6} | ' + ' | '.join(f'{metric:>14}' for metric in metrics))
+    for variant in VARIANTS:
+        print(f'{variant:>6} | ' + ' | '.join(f'{report["accuracy"][variant][metric]:>14.4f}' for metric in metrics))
+    print(f'max relative deviation of the int8 predictions: {report["accuracy"]["max_relative_deviation"]:.4f}')
+    print(f'{"batch":>6} | {"fp32 p50 ms":>11} {"p99 ms":>8} {"MB":>7} | {"int8 p50 ms":>11} {"p99 ms":>8} {"MB":>7} | {"speedup":>7}')
+    for batch_size, results in report['latency'].items():
+        fp32, int8 = results['fp32'], results['int8']
+        print(f'{batch_size:>6} | {fp32["p50_ms"]:>11.2f} {fp32["p99_ms"]:>8.2f} {fp32["peak_memory_MB"]:>7.1f} | '
+              f'{int8["p50_ms"]:>11.2f} {int8["p99_ms"]:>8.2f} {int8["peak_memory_MB"]:>7.1f} | {fp32["p50_ms"] / int8["p50_ms"]:>6.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+'''
+Score new cells with a trained checkpoint, without split records or life labels.
+The cell files (BatteryData pickles or .bcell files) matched by the globs are read and resampled by a process pool,
+predicted in batches and written to a CSV or Parquet file batch by batch. At most a few batches of cells are in flight,
+so the memory use does not grow with the number of files.
+
+The cells are named by the cell_id stored in them, or by their file name if there is none.
+Each row holds the predicted EOL, the RUL from the last cycle in the file and the life class of the predicted EOL
+(see data_provider/life_classes.json). The model sees the first min(cycles in the file, early_cycle_threshold) cycles.
+The cells that cannot be read get a row with the error instead of stopping the job.
+
+Usage:
+    python score_cells.py --args_path checkpoints/CALB_CPTransformer/<setting> --cells 'new_cells/*.pkl' --output scores.csv
+    python score_cells.py --args_path checkpoints/CALB_CPLSTM/<setting> --cells 'new_cells/**/*.bcell' --output scores.parquet
+'''
+import os
+import csv
+import glob
+import json
+import argparse
+import multiprocessing
+from collections import deque
+import numpy as np
+import torch
+from tqdm import tqdm
+from RUL.rul_predictor import RULPredictor
+from data_provider.curve_extraction import NEED_KEYS, extract_cell_curves, extract_curves_from_records
+from data_provider.columnar_cell import ColumnarCell, COLUMNAR_SUFFIX, load_cell
+from data_provider.dataset_manifest import LIFE_CLASSES_FILE, get_life_class
+
+COLUMNS = ['cell_id', 'file', 'model', 'seen_cycles', 'last_cycle', 'predicted_eol', 'predicted_rul', 'life_class', 'error']
+
+
+def list_cells(patterns):
+    '''
+    :return: the sorted paths of the cells matched by the globs. The .bcell file is preferred over the pickle it was
+             converted from, since only its early cycles are read.
+    '''
+    cell_paths = {}
+    for pattern in patterns:
+        for path in glob.glob(pattern, recursive=True):
+            cell_name, suffix = os.path.splitext(path)
+            if suffix == COLUMNAR_SUFFIX or (suffix == '.pkl' and cell_name not in cell_paths):
+                cell_paths[cell_name] = path
+    return sorted(cell_paths.values())
+
+
+def get_cell_name(metadata, path):
+    '''
+    The cell_id stored in the cell like RULPredictor.predict, or the file name if there is none.
+    The prefix of the name decides whether the cycles start with charging or discharging.
+    '''
+    if isinstance(metadata.get('cell_id'), str):
+        return metadata['cell_id']
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def read_cell(path, early_cycle_threshold, charge_discharge_length):
+    '''
+    Resample the early curves of one cell
+    :return: (path, cell name, curves [early_cycle_threshold, 3, charge_discharge_length], seen cycles, cycles in the file, error)
+    '''
+    cell_name = os.path.splitext(os.path.basename(path))[0]
+    try:
+        if path.endswith(COLUMNAR_SUFFIX):
+            cell = ColumnarCell(path)
+            cell_name = get_cell_name(cell.metadata, path)
+            num_cycles = cell.num_cycles
+            seen_cycles = min(num_cycles, early_cycle_threshold)
+            records, cycle_offsets = cell.records(NEED_KEYS, 0, seen_cycles)
+            curves = extract_curves_from_records(cell_name, records, cycle_offsets, cell.metadata['nominal_capacity_in_Ah'],
+                                                 early_cycle_threshold, charge_discharge_length)
+        else:
+            data = load_cell(path)
+            cell_name = get_cell_name(data, path)
+            num_cycles = len(data['cycle_data'])
+            seen_cycles = min(num_cycles, early_cycle_threshold)
+            curves = extract_cell_curves(cell_name, data['cycle_data'], data['nominal_capacity_in_Ah'],
+                                         early_cycle_threshold, charge_discharge_length)
+        if seen_cycles < 1:
+            raise ValueError('the cell has no cycles')
+        if np.any(np.isnan(curves)):
+            raise ValueError('the early curves contain NaN')
+    except Exception as e:
+        return path, cell_name, None, None, None, f'{type(e).__name__}: {e}'
+    return path, cell_name, curves.astype(np.float32), seen_cycles, num_cycles, None
+
+
+def read_cells(paths, workers, max_pending, early_cycle_threshold, charge_discharge_length):
+    '''
+    Read the cells in the order of paths with a process pool
+    Pool.imap queues every task and keeps the results that are not consumed yet, so the tasks are submitted
+    one by one and at most max_pending cells are in flight.
+    '''
+    if workers <= 1:
+        for path in paths:
+            yield read_cell(path, early_cycle_threshold, charge_discharge_length)
+        return
+    with multiprocessing.Pool(workers) as pool:
+        pending = deque()
+        for path in paths:
+            pending.append(pool.apply_async(read_cell, (path, early_cycle_threshold, charge_discharge_length)))
+            if len(pending) >= max_pending:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+class ScoreWriter:
+    '''
+    Write the rows of each batch to a CSV file, or to a Parquet file as one row group
+    '''
+
+    def __init__(self, output_path):
+        self.parquet = output_path.endswith('.parquet')
+        if self.parquet:
+            try:
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+            except ImportError:
+                raise ImportError('pyarrow is needed to write Parquet files, or write a .csv file')
+            self.pa = pa
+            self.schema = pa.schema([('cell_id', pa.string()), ('file', pa.string()), ('model', pa.string()),
+                                     ('seen_cycles', pa.int64()), ('last_cycle', pa.int64()), ('predicted_eol', pa.float64()),
+                                     ('predicted_rul', pa.float64()), ('life_class', pa.int64()), ('error', pa.string())])
+            self.writer = pq.ParquetWriter(output_path, self.schema)
+        else:
+            self.file = open(output_path, 'w', newline='')
+            self.writer = csv.DictWriter(self.file, fieldnames=COLUMNS)
+            self.writer.writeheader()
+
+    def write(self, rows):
+        if not rows:
+            return
+        if self.parquet:
+            self.writer.write_table(self.pa.Table.from_pylist(rows, schema=self.schema))
+        else:
+            self.writer.writerows(rows)
+            self.file.flush()
+
+    def close(self):
+        if self.parquet:
+            self.writer.close()
+        else:
+            self.file.close()
+
+
+def get_row(path, cell_name, model_type, **fields):
+    row = {column: None for column in COLUMNS}
+    row.update(cell_id=cell_name, file=path, model=model_type, **fields)
+    return row
+
+
+def predict_cells(predictor, cells, life_classes):
+    '''
+    Predict a batch of cells read by read_cell
+    :return: the rows of the cells
+    '''
+    cycle_curve_data = torch.from_numpy(np.stack([curves for _, _, curves, _, _, _ in cells]))
+    seen_cycles = torch.tensor([seen for _, _, _, seen, _, _ in cells]).unsqueeze(1)
+    curve_attn_mask = (torch.arange(predictor.early_cycle_threshold).unsqueeze(0) < seen_cycles).float()
+    outputs = predictor.predict_batch(cycle_curve_data, curve_attn_mask)
+    predicted_eols = outputs.reshape(len(cells), -1)[:, 0].numpy() * predictor.std + predictor.mean_value
+    rows = []
+    for (path, cell_name, _, seen, num_cycles, _), predicted_eol in zip(cells, predicted_eols):
+        predicted_eol = float(predicted_eol)
+        rows.append(get_row(path, cell_name, predictor.model_type, seen_cycles=seen, last_cycle=num_cycles, predicted_eol=predicted_eol,
+                            predicted_rul=max(predicted_eol - num_cycles, 0.0), life_class=get_life_class(predicted_eol, life_classes)))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Score cell files with a trained CP model and stream the predictions to CSV or Parquet')
+    parser.add_argument('--args_path', type=str, required=True, help='the checkpoint folder with args.json, the weights and the scalers')
+    parser.add_argument('--cells', type=str, nargs='+', required=True, help="globs of the cell files, e.g. 'new_cells/**/*.pkl'")
+    parser.add_argument('--output', type=str, required=True, help='the .csv or .parquet file of the predictions')
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--load_workers', type=int, default=0, help='processes used to read the cells; 0 uses all CPU cores')
+    parser.add_argument('--device', type=str, default=None, help='defaults to cuda if it is available')
+    parser.add_argument('--quantized', action='store_true', default=False, help='use the int8 weights written by quantize_model.py on the CPU')
+    args = parser.parse_args()
+
+    paths = list_cells(args.cells)
+    if not paths:
+        raise FileNotFoundError(f'No .pkl or {COLUMNAR_SUFFIX} cell files match {args.cells}')
+    predictor = RULPredictor(args.args_path, device=args.device, quantized=args.quantized)
+    with open(LIFE_CLASSES_FILE) as f:
+        life_classes = json.load(f)
+    workers = os.cpu_count() if args.load_workers == 0 else args.load_workers
+
+    writer = ScoreWriter(args.output)
+    # The rows of the cells that cannot be read are written with the next batch
+    batch, error_rows, failed = [], [], 0
+    try:
+        cells = read_cells(paths, workers, 2 * args.batch_size, predictor.early_cycle_threshold, predictor.charge_discharge_length)
+        for cell in tqdm(cells, total=len(paths)):
+            path, cell_name, error = cell[0], cell[1], cell[-1]
+            if error is not None:
+                failed += 1
+                error_rows.append(get_row(path, cell_name, predictor.model_type, error=error))
+            else:
+                batch.append(cell)
+            if len(batch) + len(error_rows) >= args.batch_size:
+                writer.write(error_rows + (predict_cells(predictor, batch, life_classes) if batch else []))
+                batch, error_rows = [], []
+        writer.write(error_rows + (predict_cells(predictor, batch, life_classes) if batch else []))
+    finally:
+        writer.close()
+    print(f'Scored {len(paths) - failed} of {len(paths)} cells into {args.output}')
+
+
+if __name__ == '__main__':
+    main()
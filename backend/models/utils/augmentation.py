@@ -38,11 +38,10 @@ class BatchAugmentation_battery_revised():
         '''
         Augment the current and voltage records
         Args:
-            x (Tensor): shape [B*L, num_var, charge_discharg_len]
+            x (Tensor or ndarray): shape [B*L, num_var, charge_discharg_len]
         '''
-        x = torch.from_numpy(x)
-        aug_x = copy.deepcopy(x)
-        raw_x = copy.deepcopy(x)
+        if isinstance(x, np.ndarray):
+            x = torch.from_numpy(x)
         N, num_var = x.shape[0], x.shape[1]
         voltage_records = x[:,0,:]
         current_records = x[:,1,:]
@@ -63,19 +62,31 @@ class BatchAugmentation_battery_revised():
 
         freqmask_aug_x = torch.cat([freqmask_aug_voltage, freqmask_aug_current, capacity_records], dim=1)
 
-        # m = torch.ones((N,1,1), dtype=x.dtype, device=x.device)
-        # m = m.uniform_(0, 1) < self.cut_rate # set True to use cut_aug
-        # m = m.expand_as(aug_x)
+        return cut_aug_x, freqmask_aug_x
 
-        # aug_x = torch.where(m, cut_aug_x, freqmask_aug_x) # randomly use frequency mask and cutoff_jitter
+    def __call__(self, cycle_curve_data, curve_attn_mask):
+        '''
+        Augment a batch on the fly. It runs on the device of the batch.
+        Each cycle randomly uses cutoff-jitter or frequency masking, and only aug_rate of the cycles are replaced by augmented data.
+        Args:
+            cycle_curve_data (Tensor): shape [B, L, num_var, charge_discharg_len]
+            curve_attn_mask (Tensor): shape [B, L]. The unseen cycles are kept as zeros.
+        '''
+        B, L = cycle_curve_data.shape[0], cycle_curve_data.shape[1]
+        raw_x = cycle_curve_data.reshape(B*L, cycle_curve_data.shape[2], cycle_curve_data.shape[3])
+        cut_aug_x, freqmask_aug_x = self.batch_aug(raw_x)
 
-        # m = torch.ones((N,1,1), dtype=x.dtype, device=x.device)
-        # m = m.uniform_(0, 1) < self.aug_rate # set True to use cut_aug
-        # m = m.expand_as(aug_x)
+        m = torch.ones((B*L,1,1), dtype=raw_x.dtype, device=raw_x.device)
+        m = m.uniform_(0, 1) < self.cut_rate # set True to use cut_aug
+        aug_x = torch.where(m, cut_aug_x, freqmask_aug_x) # randomly use frequency mask and cutoff_jitter
 
-        # aug_x = torch.where(m, aug_x, raw_x) # only a portion of cycles are replaced by augmented data.
-        # aug_x = aug_x.cpu().numpy()
-        return cut_aug_x, freqmask_aug_x
+        m = torch.ones((B*L,1,1), dtype=raw_x.dtype, device=raw_x.device)
+        m = m.uniform_(0, 1) < self.aug_rate # set True to use the augmented data
+        aug_x = torch.where(m, aug_x, raw_x) # only a portion of cycles are replaced by augmented data.
+
+        aug_x = aug_x.reshape(cycle_curve_data.shape)
+        aug_x = aug_x * curve_attn_mask.reshape(B, L, 1, 1).to(aug_x.dtype) # set the unseen data as zeros
+        return aug_x
     
 class BatchAugmentation_battery():
     def __init__(self, cut_rate=0.5, holes=10, length=5, std=0.02):
@@ -1,4 +1,5 @@
 import numpy as np
+import torch
 
 
 def RSE(pred, true):
@@ -39,3 +40,129 @@ def metric(pred, true):
     mspe = MSPE(pred, true)
 
     return mae, mse, rmse, mape, mspe
+
+
+# The metrics of the battery life predictions. They take (references, preds) like sklearn.metrics and give the same
+# results, so the training, evaluation and RUL scripts share them without importing sklearn or evaluate.
+# MetricAccumulator below computes the same metrics over the batches of a data loader.
+
+def mean_absolute_error(references, preds):
+    return np.mean(np.abs(np.asarray(preds, dtype=np.float64) - np.asarray(references, dtype=np.float64)))
+
+
+def mean_squared_error(references, preds):
+    return np.mean((np.asarray(references, dtype=np.float64) - np.asarray(preds, dtype=np.float64)) ** 2)
+
+
+def root_mean_squared_error(references, preds):
+    return np.sqrt(mean_squared_error(references, preds))
+
+
+def mean_absolute_percentage_error(references, preds):
+    '''
+    The fraction (not %) as in sklearn. The references are clipped to eps to avoid dividing by zero.
+    '''
+    references = np.asarray(references, dtype=np.float64)
+    preds = np.asarray(preds, dtype=np.float64)
+    return np.mean(np.abs(preds - references) / np.maximum(np.abs(references), np.finfo(np.float64).eps))
+
+
+def alpha_accuracy(references, preds, alpha):
+    '''
+    The percentage of the predictions whose relative error is at most alpha
+    '''
+    references = np.asarray(references, dtype=np.float64)
+    preds = np.asarray(preds, dtype=np.float64)
+    relative_error = np.abs(preds - references) / references
+    return np.count_nonzero(relative_error <= alpha) / len(references) * 100
+
+
+class MetricAccumulator:
+    '''
+    Streaming RMSE, MAE, MAPE and alpha-accuracy of the (transformed) predictions.
+    The running sums stay on the device of the predictions, so update() does not sync with the host.
+    The processes are synced once in compute().
+    With split_seen_unseen, the metrics of the seen (id 1) and unseen (id 0) samples are also computed.
+    The results are the same as sklearn's root_mean_squared_error, mean_absolute_error and
+    mean_absolute_percentage_error on the gathered predictions, up to the float64 summation order.
+    '''
+    # the columns of the running sums
+    STATS = ['count', 'squared_error', 'absolute_error', 'absolute_percentage_error', 'alpha1_hits', 'alpha2_hits']
+
+    def __init__(self, accelerator=None, alpha1=0.15, alpha2=0.1, split_seen_unseen=False):
+        self.accelerator = accelerator
+        self.alpha1 = alpha1
+        self.alpha2 = alpha2
+        self.split_seen_unseen = split_seen_unseen
+        self.reset()
+
+    def reset(self):
+        self.sums = None # [num_groups, len(STATS)], the groups are all, seen and unseen samples
+
+    def update(self, preds, references, seen_unseen_ids=None):
+        if seen_unseen_ids is None:
+            seen_unseen_ids = torch.ones(references.shape[0], device=references.device)
+        accelerator = self.accelerator
+        if accelerator is not None and accelerator.num_processes > 1 and accelerator.gradient_state.end_of_dataloader:
+            # The last batch can hold duplicated samples that make the batches of all processes equal.
+            # gather_for_metrics drops them, and only the main process accumulates the gathered batch.
+            preds, references, seen_unseen_ids = accelerator.gather_for_metrics((preds, references, seen_unseen_ids.to(preds.device)))
+            if not accelerator.is_main_process:
+                return
+
+        # float64 as in sklearn. MPS has no float64.
+        dtype = torch.float32 if preds.device.type == 'mps' else torch.float64
+        preds = preds.detach().reshape(-1).to(dtype)
+        references = references.detach().reshape(-1).to(dtype)
+        seen_unseen_ids = seen_unseen_ids.detach().reshape(-1).to(preds.device)
+
+        absolute_errors = torch.abs(preds - references)
+        relative_errors = absolute_errors / references
+        stats = torch.stack([
+            torch.ones_like(preds),
+            absolute_errors ** 2,
+            absolute_errors,
+            absolute_errors / torch.clamp(torch.abs(references), min=np.finfo(np.float64).eps),
+            (relative_errors <= self.alpha1).to(dtype),
+            (relative_errors <= self.alpha2).to(dtype)
+        ], dim=1) # [B, len(STATS)]
+        groups = [torch.ones_like(preds)]
+        if self.split_seen_unseen:
+            groups += [(seen_unseen_ids == 1).to(dtype), (seen_unseen_ids == 0).to(dtype)]
+        sums = torch.stack(groups) @ stats # [num_groups, len(STATS)]
+        self.sums = sums if self.sums is None else self.sums + sums
+
+    def compute(self):
+        '''
+        :return: dict of rmse, mae, mape, alpha_acc1 and alpha_acc2 (in %). With split_seen_unseen, also
+                 the mape, alpha_acc1 and alpha_acc2 of the seen and unseen samples (e.g. seen_mape)
+        '''
+        num_groups = 3 if self.split_seen_unseen else 1
+        sums = self.sums
+        if sums is None:
+            device = self.accelerator.device if self.accelerator is not None else 'cpu'
+            sums = torch.zeros((num_groups, len(self.STATS)), dtype=torch.float32 if torch.device(device).type == 'mps' else torch.float64, device=device)
+        if self.accelerator is not None and self.accelerator.num_processes > 1:
+            sums = self.accelerator.reduce(sums, reduction='sum')
+        sums = sums.cpu().numpy().astype(np.float64)
+
+        group_metrics = []
+        for count, squared_error, absolute_error, absolute_percentage_error, alpha1_hits, alpha2_hits in sums:
+            if count == 0:
+                # the same as the metrics of a placeholder sample (reference 0, prediction 1)
+                group_metrics.append({'rmse': 1.0, 'mae': 1.0, 'mape': 1 / np.finfo(np.float64).eps, 'alpha_acc1': 0.0, 'alpha_acc2': 0.0})
+                continue
+            group_metrics.append({
+                'rmse': np.sqrt(squared_error / count),
+                'mae': absolute_error / count,
+                'mape': absolute_percentage_error / count,
+                'alpha_acc1': alpha1_hits / count * 100,
+                'alpha_acc2': alpha2_hits / count * 100
+            })
+
+        metrics = dict(group_metrics[0])
+        if self.split_seen_unseen:
+            for name, group in zip(['seen', 'unseen'], group_metrics[1:]):
+                for key in ['mape', 'alpha_acc1', 'alpha_acc2']:
+                    metrics[f'{name}_{key}'] = group[key]
+        return metrics
@@ -0,0 +1,69 @@
+'''
+Post-training int8 dynamic quantization of the CP models for CPU inference.
+The weights of the Linear, LSTM and GRU layers are stored in int8 and the activations are quantized on the fly.
+The feed forward networks of the Transformer encoder layers are 1x1 Conv1d layers, which dynamic quantization does not
+cover, so they are replaced by the equivalent Linear layers first.
+'''
+import os
+import copy
+import torch
+import torch.nn as nn
+
+QUANTIZED_WEIGHTS_NAME = 'model_int8.pt'
+
+
+class PointwiseLinear(nn.Module):
+    '''
+    A 1x1 Conv1d computed by a Linear layer, so that it can be quantized
+    x: [B, in_channels, L]
+    '''
+    def __init__(self, conv):
+        super(PointwiseLinear, self).__init__()
+        self.linear = nn.Linear(conv.in_channels, conv.out_channels, bias=conv.bias is not None)
+        with torch.no_grad():
+            self.linear.weight.copy_(conv.weight[:, :, 0])
+            if conv.bias is not None:
+                self.linear.bias.copy_(conv.bias)
+
+    def forward(self, x):
+        return self.linear(x.transpose(1, 2)).transpose(1, 2)
+
+
+def replace_pointwise_convs(module):
+    '''
+    Replace the 1x1 Conv1d layers of module by PointwiseLinear in place
+    '''
+    for name, child in module.named_children():
+        if isinstance(child, nn.Conv1d) and child.kernel_size == (1,) and child.stride == (1,) and child.padding == (0,) \
+                and child.dilation == (1,) and child.groups == 1:
+            setattr(module, name, PointwiseLinear(child))
+        else:
+            replace_pointwise_convs(child)
+    return module
+
+
+def quantize_model(model, inplace=False):
+    '''
+    :return: an int8 dynamic-quantized copy of the fp32 model for CPU inference, or the model itself quantized if inplace
+    '''
+    if not inplace:
+        model = copy.deepcopy(model)
+    model = model.cpu().float().eval()
+    replace_pointwise_convs(model)
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear, nn.LSTM, nn.GRU}, dtype=torch.qint8, inplace=True)
+
+
+def save_quantized_model(quantized_model, model_path):
+    torch.save(quantized_model.state_dict(), os.path.join(model_path, QUANTIZED_WEIGHTS_NAME))
+
+
+def load_quantized_model(model, model_path):
+    '''
+    Load the int8 weights saved by save_quantized_model
+    :param model: the fp32 model built from the args of the checkpoint, it is quantized in place
+    '''
+    quantized_model = quantize_model(model, inplace=True)
+    # The packed weights of the quantized LSTM and GRU layers are script objects, which weights_only does not allow
+    state_dict = torch.load(os.path.join(model_path, QUANTIZED_WEIGHTS_NAME), map_location='cpu', weights_only=False)
+    quantized_model.load_state_dict(state_dict)
+    return quantized_model
@@ -2,15 +2,17 @@ import numpy as np
 import torch
 import matplotlib.pyplot as plt
 import shutil
-from sklearn.metrics import mean_absolute_error
+import copy
+import collections
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
-import evaluate
 import torch.nn.functional as F
 from scipy.signal.windows import gaussian
-from sklearn.metrics import root_mean_squared_error, mean_absolute_percentage_error
 import time
 from torch import nn
 import wandb
+from accelerate.utils import gather_object
+from utils.metrics import MetricAccumulator
 plt.switch_backend('agg')
 def get_parameter_number(model):
     total_num = sum(p.numel() for p in model.parameters())
@@ -213,8 +215,8 @@ def del_files(dir_path):
     shutil.rmtree(dir_path, ignore_errors=True)
 
 def vali_baseline(args, accelerator, model, vali_data, vali_loader, criterion, compute_seen_unseen=False):
-    total_preds, total_references = [], []
-    total_seen_unseen_ids = []
+    metric_accumulator = MetricAccumulator(accelerator, alpha1=args.alpha1, alpha2=args.alpha2, split_seen_unseen=compute_seen_unseen)
+    std, mean_value = np.sqrt(vali_data.label_scaler.var_[-1]), vali_data.label_scaler.mean_[-1]
     model.eval()
     with torch.no_grad():
         for i, (cycle_curve_data, curve_attn_mask,  labels, life_class, scaled_life_class, weights, seen_unseen_ids) in tqdm(enumerate(vali_loader)):
@@ -225,77 +227,111 @@ def vali_baseline(args, accelerator, model, vali_data, vali_loader, criterion, c
             # encoder - decoder
             outputs = model(cycle_curve_data, curve_attn_mask)
             # self.accelerator.wait_for_everyone()
-            std, mean_value = np.sqrt(vali_data.label_scaler.var_[-1]), vali_data.label_scaler.mean_[-1]
             transformed_preds = outputs * std + mean_value
             transformed_labels = labels * std + mean_value
+            metric_accumulator.update(transformed_preds, transformed_labels, seen_unseen_ids)
 
-            all_predictions, all_targets, seen_unseen_ids = accelerator.gather_for_metrics((transformed_preds, transformed_labels, seen_unseen_ids))
-
-         
-            total_preds = total_preds + all_predictions.detach().cpu().numpy().reshape(-1).tolist()
-            total_references = total_references + all_targets.detach().cpu().numpy().reshape(-1).tolist()
-            if compute_seen_unseen:
-                total_seen_unseen_ids = total_seen_unseen_ids + seen_unseen_ids.detach().cpu().numpy().reshape(-1).tolist()
+    metrics = metric_accumulator.compute()
+    model.train()
+    if compute_seen_unseen:
+        # the model performance on the samples from the seen and unseen aging conditions
+        return metrics['rmse'], metrics['mae'], metrics['mape'], metrics['alpha_acc1'], metrics['alpha_acc2'], metrics['unseen_mape'], metrics['seen_mape'], \
+            metrics['unseen_alpha_acc1'], metrics['seen_alpha_acc1'], metrics['unseen_alpha_acc2'], metrics['seen_alpha_acc2']
+    return metrics['rmse'], metrics['mae'], metrics['mape'], metrics['alpha_acc1'], metrics['alpha_acc2']
 
-    total_preds = np.array(total_preds)
-    total_references = np.array(total_references)   
-    total_seen_unseen_ids = np.array(total_seen_unseen_ids)
-    rmse = root_mean_squared_error(total_references, total_preds)
-    mae = mean_absolute_error(total_references, total_preds)
-    mape = mean_absolute_percentage_error(total_references, total_preds)
 
-    relative_error = abs(total_preds - total_references) / total_references
-    hit_num = sum(relative_error<=args.alpha1)
-    alpha_acc1 = hit_num / len(total_references) * 100
+def evaluate_baseline(args, accelerator, model, vali_data, vali_loader, test_data, test_loader, criterion):
+    '''
+    Evaluate the model on the validation set and on the testing set (with the seen/unseen breakdown)
+    :return: the outputs of vali_baseline on the validation set and on the testing set
+    '''
+    vali_results = vali_baseline(args, accelerator, model, vali_data, vali_loader, criterion, compute_seen_unseen=False)
+    test_results = vali_baseline(args, accelerator, model, test_data, test_loader, criterion, compute_seen_unseen=True)
+    return vali_results, test_results
 
-    relative_error = abs(total_preds - total_references) / total_references
-    hit_num = sum(relative_error<=args.alpha2)
-    alpha_acc2 = hit_num / len(total_references) * 100
 
-    if compute_seen_unseen:
-        # calculate the model performance on the samples from the seen and unseen aging conditions
-        seen_references = total_references[total_seen_unseen_ids==1] if np.any(total_seen_unseen_ids==1) else np.array([0])
-        unseen_references = total_references[total_seen_unseen_ids==0] if np.any(total_seen_unseen_ids==0) else np.array([0])
-        seen_preds = total_preds[total_seen_unseen_ids==1] if np.any(total_seen_unseen_ids==1) else np.array([1])
-        unseen_preds = total_preds[total_seen_unseen_ids==0] if np.any(total_seen_unseen_ids==0) else np.array([1])
-
-        # MAPE
-        seen_mape = mean_absolute_percentage_error(seen_references, seen_preds)
-        if len(unseen_preds) > 0:
-            unseen_mape = mean_absolute_percentage_error(unseen_references, unseen_preds)
-        else:
-            unseen_mape = -10000
-
-        # alpha-acc1 
-        relative_error = abs(seen_preds - seen_references) / seen_references
-        hit_num = sum(relative_error<=args.alpha1)
-        seen_alpha_acc1 = hit_num / len(seen_references) * 100
-
-        
-        if len(unseen_preds) > 0:
-            relative_error = abs(unseen_preds - unseen_references) / unseen_references
-            hit_num = sum(relative_error<=args.alpha1)
-            unseen_alpha_acc1 = hit_num / len(unseen_references) * 100
-        else:
-            unseen_alpha_acc1 = -10000
+class AsyncEvaluator:
+    '''
+    Evaluate snapshots of the model weights in a background thread while the training continues.
+    submit() copies the model, so the training can keep updating the weights. The results are returned by poll()
+    in the order of submission, together with the evaluated snapshot (e.g. to save it as the best checkpoint).
+    At most max_pending snapshots are kept: submit() waits for the oldest evaluation when there are more.
+    The data loaders given to evaluate_fn must not be prepared by the accelerator, because the prepared loaders
+    share the gradient state with the training loader.
+    '''
+    def __init__(self, evaluate_fn, max_pending=2):
+        self.evaluate_fn = evaluate_fn
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = collections.deque() # (epoch, snapshot, future)
+
+    def submit(self, epoch, model):
+        while len(self.pending) >= self.max_pending and not self.pending[0][2].done():
+            self.pending[0][2].result()
+        snapshot = copy.deepcopy(model)
+        snapshot.requires_grad_(False)
+        self.pending.append((epoch, snapshot, self.executor.submit(self.evaluate_fn, snapshot)))
+
+    def poll(self, wait=False):
+        '''
+        :param wait: wait for all the pending evaluations
+        :return: list of (epoch, snapshot, result) of the finished evaluations
+        '''
+        results = []
+        while self.pending and (wait or self.pending[0][2].done()):
+            epoch, snapshot, future = self.pending.popleft()
+            results.append((epoch, snapshot, future.result()))
+        return results
 
-        # alpha-acc2
-        relative_error = abs(seen_preds - seen_references) / seen_references
-        hit_num = sum(relative_error<=args.alpha2)
-        seen_alpha_acc2 = hit_num / len(seen_references) * 100
+    def shutdown(self):
+        # the pending evaluations are dropped, e.g. after the early stopping
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        self.pending.clear()
 
-        if len(unseen_preds) > 0:
-            relative_error = abs(unseen_preds - unseen_references) / unseen_references
-            hit_num = sum(relative_error<=args.alpha2)
-            unseen_alpha_acc2 = hit_num / len(unseen_references) * 100
-        else:
-            unseen_alpha_acc2 = -10000
 
-        model.train()
-        return  rmse, mae, mape, alpha_acc1, alpha_acc2, unseen_mape, seen_mape, unseen_alpha_acc1, seen_alpha_acc1, unseen_alpha_acc2, seen_alpha_acc2
-    
-    model.train()
-    return rmse, mae, mape, alpha_acc1, alpha_acc2
+def predict_prefixes_baseline(accelerator, model, test_data, cell_batch_size=8):
+    '''
+    Predict all the samples of test_data cell by cell.
+    The samples of one cell only differ in the prefix length, so the intra-cycle embeddings of the cell are computed once
+    and the predictions of all its prefix lengths are made in one pass (see predict_prefixes in the models).
+    :return: transformed preds, transformed labels, dataset_ids, seen_unseen_ids and seen_number_of_cycles in the order of the samples
+    '''
+    std, mean_value = np.sqrt(test_data.label_scaler.var_[-1]), test_data.label_scaler.mean_[-1]
+    unwrapped_model = accelerator.unwrap_model(model)
+    cell_indices = test_data.total_cell_indices
+    sample_indices, preds = [], []
+    model.eval()
+    with torch.no_grad(), accelerator.split_between_processes(np.unique(cell_indices).tolist()) as process_cells:
+        for start in tqdm(range(0, len(process_cells), cell_batch_size)):
+            batch_cells = process_cells[start:start+cell_batch_size]
+            batch_sample_indices = [np.nonzero(cell_indices==cell_index)[0] for cell_index in batch_cells]
+            max_prefix_num = max(len(indices) for indices in batch_sample_indices)
+            prefix_lengths = np.ones((len(batch_cells), max_prefix_num), dtype=np.int64) # padded with the shortest prefix
+            for j, indices in enumerate(batch_sample_indices):
+                prefix_lengths[j, :len(indices)] = test_data.total_prefix_lengths[indices]
+
+            cycle_curve_data = test_data.total_charge_discharge_curves.index_select(0, torch.as_tensor(batch_cells)).to(accelerator.device)
+            prefix_lengths = torch.from_numpy(prefix_lengths).to(accelerator.device)
+            outputs = unwrapped_model.predict_prefixes(cycle_curve_data, prefix_lengths) # [B, P, output_num]
+            outputs = outputs.detach().cpu()
+            for j, indices in enumerate(batch_sample_indices):
+                sample_indices.append(indices)
+                preds.append(outputs[j, :len(indices), 0])
+
+    sample_indices = gather_object([np.concatenate(sample_indices) if sample_indices else np.zeros(0, dtype=np.int64)])
+    preds = gather_object([torch.cat(preds) if preds else torch.zeros(0)])
+    sample_indices = np.concatenate(sample_indices)
+    order = np.argsort(sample_indices)
+    sample_indices = sample_indices[order]
+    preds = torch.cat(preds)[torch.from_numpy(order)]
+
+    labels = torch.Tensor(test_data.total_labels[sample_indices].reshape(-1))
+    transformed_preds = (preds * std + mean_value).numpy()
+    transformed_labels = (labels * std + mean_value).numpy()
+    dataset_ids = np.array(test_data.total_dataset_ids)[sample_indices]
+    seen_unseen_ids = np.array(test_data.total_seen_unseen_IDs)[sample_indices]
+    seen_number_of_cycles = test_data.total_prefix_lengths[sample_indices]
+    return transformed_preds, transformed_labels, dataset_ids, seen_unseen_ids, seen_number_of_cycles
 
 
 def load_content(args):